@@ -2,10 +2,27 @@
 """
 Flask Web应用 - 发票生成器前端
 """
-from flask import Flask, render_template, request, send_file, jsonify, make_response
-from invoice_generator import create_invoice
+from flask import Flask, request, send_file, jsonify, make_response
+from cancellation import CancelToken, RenderCancelled, cancel_scope, socket_disconnected
+from invoice_generator import commit_invoice
+from estimator import CostModel, RenderBudget, RenderBudgetExceeded
+from idempotency import IdempotencyStore, IdempotencyConflict, request_fingerprint
+from memory_guard import MemoryBudgetExceeded, check_memory_budget, track_peak_memory
+from assets import CachedPage, init_assets
+from invoice_model import InvoiceData
+from profiles import ProfileNotFound, ProfileStore
+from profiler import Profiler, focus_stacks, format_collapsed, init_profiler
+from section_cache import SectionCache
+from storage import check_name, is_digest, open_storage
+from text_cache import text_cache
+from render_queue import DEAD, DONE, build_render_job, open_queue
+from tracing import Tracer, annotate, init_tracing, span
+from upload_guard import UploadRejected, init_upload_guard
 from datetime import datetime, timedelta
+from functools import partial
+import math
 import os
+import time
 import uuid
 
 app = Flask(__name__, 
@@ -17,16 +34,75 @@ app.config['SECRET_KEY'] = 'your-secret-key-here'
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 app.config['UPLOAD_FOLDER'] = os.path.join(BASE_DIR, 'generated_invoices')
 app.config['UPLOAD_IMAGES'] = os.path.join(BASE_DIR, 'uploaded_images')
+# 发票PDF存储（本地目录或 file:///、memory:// 地址），默认使用 UPLOAD_FOLDER
+app.config['INVOICE_STORAGE_URL'] = os.environ.get('INVOICE_STORAGE_URL', app.config['UPLOAD_FOLDER'])
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# 单个上传图片的字节和像素上限，在解析请求体时即检查（0 表示不限制）
+app.config['UPLOAD_MAX_IMAGE_BYTES'] = int(os.environ.get('UPLOAD_MAX_IMAGE_KB', 5 * 1024)) * 1024
+app.config['UPLOAD_MAX_IMAGE_PIXELS'] = int(os.environ.get('UPLOAD_MAX_IMAGE_PIXELS', 20 * 1000 * 1000))
+# 公司档案目录（开票方信息和规范化后的 Logo/图章，/generate 用 profile_id 引用）
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', os.path.join(BASE_DIR, 'company_profiles'))
+app.config['IDEMPOTENCY_FOLDER'] = os.path.join(BASE_DIR, 'idempotency_cache')
+app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 600))  # 幂等结果保留时间（秒）
+# 单次渲染的预估内存预算，超出时在渲染前直接拒绝（0 表示不限制）
+app.config['RENDER_MEMORY_BUDGET'] = int(os.environ.get('RENDER_MEMORY_BUDGET_MB', 512)) * 1024 * 1024
+# 用 tracemalloc 采样渲染峰值内存的比例（采样有额外开销，默认只采 1%）
+app.config['MEMORY_TRACE_SAMPLE_RATE'] = float(os.environ.get('MEMORY_TRACE_SAMPLE_RATE', 0.01))
+# 超大发票按页段并行渲染使用的进程数（0 表示不启用）
+app.config['PARALLEL_RENDER_JOBS'] = int(os.environ.get('PARALLEL_RENDER_JOBS', 0))
+# ASGI 部署（asgi.py）：运行 Flask 路由的线程数和渲染进程数（渲染进程中不再按页段并行，0 表示在线程中直接渲染）
+app.config['ASGI_WSGI_THREADS'] = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+app.config['RENDER_PROCESSES'] = int(os.environ.get('RENDER_PROCESSES', os.cpu_count() or 1))
+# 渲染后端：platypus（默认）或 canvas（直接画布绘制，常规发票渲染更快）
+app.config['RENDER_BACKEND'] = os.environ.get('RENDER_BACKEND', 'platypus')
+# 可复现输出：相同输入生成逐字节相同的PDF（固定时间戳，文档信息和ID取自输入）
+app.config['DETERMINISTIC_PDF'] = os.environ.get('DETERMINISTIC_PDF', 'False').lower() == 'true'
+# 线性化PDF（快速 Web 查看）：预估页数不少于 LINEARIZE_MIN_PAGES 的发票在提交前线性化（需要 pikepdf 或 qpdf）
+app.config['LINEARIZE_PDF'] = os.environ.get('LINEARIZE_PDF', 'False').lower() == 'true'
+app.config['LINEARIZE_MIN_PAGES'] = int(os.environ.get('LINEARIZE_MIN_PAGES', 3))
+# /generate 的渲染期限（秒，从收到请求开始计算，应小于 gunicorn 的 timeout 和负载均衡的超时；0 表示不限制）
+# 超过期限或客户端断开时渲染在下一个检查点停止，不写出文件（见 cancellation.py）
+app.config['RENDER_TIMEOUT'] = float(os.environ.get('RENDER_TIMEOUT', 25))
+# 分块 flowable 缓存的条目数（编辑后重新生成时复用未变化的部分；0 表示不启用）
+app.config['SECTION_CACHE_ENTRIES'] = int(os.environ.get('SECTION_CACHE_ENTRIES', 256))
+# 段落解析/换行缓存的条目数（跨请求共享重复文字的排版结果；0 表示不启用）
+app.config['TEXT_CACHE_ENTRIES'] = int(os.environ.get('TEXT_CACHE_ENTRIES', 20000))
+# 渲染队列地址（如 sqlite:///path/render_queue.db）；设置后 /generate 只入队，由渲染工作进程渲染
+app.config['RENDER_QUEUE_URL'] = os.environ.get('RENDER_QUEUE_URL', '')
+# 渲染开销模型文件（python estimator.py calibrate 生成）；为空时使用内置系数
+app.config['RENDER_COST_MODEL'] = os.environ.get('RENDER_COST_MODEL', '')
+# 预估渲染耗时超过该值（毫秒）的发票交给渲染队列，其余在请求进程内渲染（0 表示配置了队列时全部入队）
+app.config['HEAVY_RENDER_MS'] = float(os.environ.get('HEAVY_RENDER_MS', 0))
+# 每个客户端每个时间窗口（秒）可使用的预估渲染耗时（毫秒），超出时返回 429（0 表示不限制）
+app.config['RENDER_BUDGET_MS'] = float(os.environ.get('RENDER_BUDGET_MS', 0))
+app.config['RENDER_BUDGET_WINDOW'] = float(os.environ.get('RENDER_BUDGET_WINDOW', 60))
+# 区分客户端的请求头（没有该请求头时按客户端IP）；预算状态文件在各工作进程间共享
+app.config['RENDER_BUDGET_CLIENT_HEADER'] = os.environ.get('RENDER_BUDGET_CLIENT_HEADER', 'X-Client-Id')
+app.config['RENDER_BUDGET_DB'] = os.environ.get('RENDER_BUDGET_DB', os.path.join(BASE_DIR, 'render_budget.db'))
+# 请求追踪日志（JSON Lines，每个请求一条，包含各阶段耗时）；为空时不追踪
+app.config['TRACE_LOG'] = os.environ.get('TRACE_LOG', '')
+# 追踪记录的写出比例，以及总是写出的慢请求阈值（毫秒，0 表示不启用）
+app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))
+app.config['TRACE_SLOW_MS'] = float(os.environ.get('TRACE_SLOW_MS', 0))
+# 线上采样分析（/debug/profile）的访问令牌，为空时不启用；结果目录需要本机所有工作进程共享
+app.config['DEBUG_PROFILE_TOKEN'] = os.environ.get('DEBUG_PROFILE_TOKEN', '')
+app.config['DEBUG_PROFILE_DIR'] = os.environ.get('DEBUG_PROFILE_DIR', os.path.join(BASE_DIR, 'debug_profiles'))
+# 采样间隔（毫秒）和采样窗口的最长时间（秒，应小于 gunicorn 的 timeout）
+app.config['DEBUG_PROFILE_INTERVAL_MS'] = float(os.environ.get('DEBUG_PROFILE_INTERVAL_MS', 10))
+app.config['DEBUG_PROFILE_MAX_SECONDS'] = float(os.environ.get('DEBUG_PROFILE_MAX_SECONDS', 20))
 
 # 添加响应头以支持Chrome浏览器
 @app.after_request
 def after_request(response):
     """添加必要的HTTP响应头"""
+    # 静态资源的响应头由资源管道设置，不再改写
+    if request.endpoint in ('static', 'asset'):
+        return response
+
     # 允许跨域（如果需要）
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Idempotency-Key'
     
     # 安全策略头
     response.headers['X-Content-Type-Options'] = 'nosniff'
@@ -45,6 +121,64 @@ def after_request(response):
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['UPLOAD_IMAGES'], exist_ok=True)
 
+# 上传图片的流式校验（格式、字节数、像素数），不合格时立即停止读取请求体
+init_upload_guard(app, app.config['UPLOAD_MAX_IMAGE_BYTES'], app.config['UPLOAD_MAX_IMAGE_PIXELS'])
+
+# 静态资源指纹、预压缩和首页缓存
+asset_manifest = init_assets(app)
+index_page = CachedPage('index.html')
+
+# 发票存储（原子写入、按哈希分片、内容相同的PDF只保存一份）
+invoice_storage = open_storage(app.config['INVOICE_STORAGE_URL'])
+
+# 公司档案（跨工作进程共享同一目录）
+profile_store = ProfileStore(app.config['PROFILE_FOLDER'])
+
+# 分块缓存（每个工作进程一份）
+section_cache = None
+if app.config['SECTION_CACHE_ENTRIES'] > 0:
+    section_cache = SectionCache(max_entries=app.config['SECTION_CACHE_ENTRIES'])
+
+# 段落解析/换行缓存（进程内共享，每个工作进程一份）
+text_cache.configure(max_entries=app.config['TEXT_CACHE_ENTRIES'])
+
+# 渲染队列（未配置时在请求进程内直接渲染）
+render_queue = None
+if app.config['RENDER_QUEUE_URL']:
+    render_queue = open_queue(app.config['RENDER_QUEUE_URL'],
+                              max_attempts=int(os.environ.get('RENDER_QUEUE_MAX_ATTEMPTS', 3)))
+
+# 渲染进程池（ASGI 部署时由 asgi.py 设置，为 None 时在请求线程内直接渲染）
+render_pool = None
+
+# 渲染开销模型
+cost_model = CostModel.load(app.config['RENDER_COST_MODEL']) if app.config['RENDER_COST_MODEL'] else CostModel()
+if cost_model.backend != app.config['RENDER_BACKEND']:
+    print(f"Warning: render cost model was calibrated for the {cost_model.backend} backend, "
+          f"but RENDER_BACKEND is {app.config['RENDER_BACKEND']}")
+
+# 按客户端的渲染耗时预算（未配置时不限制）
+render_budget = None
+if app.config['RENDER_BUDGET_MS'] > 0:
+    render_budget = RenderBudget(app.config['RENDER_BUDGET_DB'], app.config['RENDER_BUDGET_MS'],
+                                 window=app.config['RENDER_BUDGET_WINDOW'])
+
+# 请求追踪（写日志在后台线程完成，不增加请求延迟）
+if app.config['TRACE_LOG']:
+    init_tracing(app, Tracer(app.config['TRACE_LOG'],
+                             sample_rate=app.config['TRACE_SAMPLE_RATE'],
+                             slow_threshold_ms=app.config['TRACE_SLOW_MS']))
+
+# 线上采样分析（未配置令牌时不启用，不注册任何请求钩子）
+profiler = None
+if app.config['DEBUG_PROFILE_TOKEN']:
+    profiler = init_profiler(app, Profiler(app.config['DEBUG_PROFILE_DIR'], app.config['DEBUG_PROFILE_TOKEN'],
+                                           interval_ms=app.config['DEBUG_PROFILE_INTERVAL_MS'],
+                                           max_seconds=app.config['DEBUG_PROFILE_MAX_SECONDS']))
+
+# 幂等存储（跨工作进程共享，用于合并重复提交）
+idempotency_store = IdempotencyStore(app.config['IDEMPOTENCY_FOLDER'], ttl=app.config['IDEMPOTENCY_TTL'])
+
 # 允许的图片扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
@@ -55,10 +189,8 @@ def allowed_file(filename):
 
 @app.route('/')
 def index():
-    """首页 - 显示发票表单"""
-    response = make_response(render_template('index.html'))
-    response.headers['Content-Type'] = 'text/html; charset=utf-8'
-    return response
+    """首页 - 显示发票表单（按 ETag 缓存，未变化时返回 304）"""
+    return index_page.serve(refresh=app.debug)
 
 
 @app.route('/health')
@@ -72,216 +204,391 @@ def handle_options(path):
     """处理OPTIONS预检请求"""
     response = make_response()
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Idempotency-Key'
     return response
 
 
-@app.route('/generate', methods=['POST'])
-def generate_invoice():
-    """处理表单提交并生成发票"""
+def _save_upload(files, field, prefix, label):
+    """
+    保存上传的图片文件
+
+    Args:
+        files: 上传文件（request.files）
+        field: 表单字段名
+        prefix: 保存文件名前缀
+        label: 错误信息中使用的名称（logo / stamp）
+
+    Returns:
+        保存后的文件路径，没有上传时返回 None
+    """
+    if field not in files:
+        return None
+    upload = files[field]
+    if not upload or not upload.filename:
+        return None
+
+    # 检查文件扩展名
+    if not allowed_file(upload.filename):
+        raise ValueError(f'Invalid {label} file format. Allowed formats: {", ".join(ALLOWED_EXTENSIONS)}')
+
     try:
-        # 获取表单数据
-        data = request.form
-        
-        # 处理文件上传 - Logo
-        logo_path = None
-        if 'company_logo' in request.files:
-            logo_file = request.files['company_logo']
-            if logo_file and logo_file.filename:
-                # 检查文件扩展名
-                if not allowed_file(logo_file.filename):
-                    return jsonify({
-                        'success': False,
-                        'error': f'Invalid logo file format. Allowed formats: {", ".join(ALLOWED_EXTENSIONS)}'
-                    }), 400
-                
-                try:
-                    logo_filename = f"logo_{uuid.uuid4().hex[:8]}_{logo_file.filename}"
-                    logo_path = os.path.join(app.config['UPLOAD_IMAGES'], logo_filename)
-                    logo_file.save(logo_path)
-                    # 验证文件是否成功保存
-                    if not os.path.exists(logo_path):
-                        logo_path = None
-                        return jsonify({
-                            'success': False,
-                            'error': 'Failed to save logo file'
-                        }), 400
-                except Exception as e:
-                    return jsonify({
-                        'success': False,
-                        'error': f'Error saving logo: {str(e)}'
-                    }), 400
-        
-        # 处理文件上传 - 图章
-        stamp_path = None
-        if 'company_stamp' in request.files:
-            stamp_file = request.files['company_stamp']
-            if stamp_file and stamp_file.filename:
-                # 检查文件扩展名
-                if not allowed_file(stamp_file.filename):
-                    return jsonify({
-                        'success': False,
-                        'error': f'Invalid stamp file format. Allowed formats: {", ".join(ALLOWED_EXTENSIONS)}'
-                    }), 400
-                
-                try:
-                    stamp_filename = f"stamp_{uuid.uuid4().hex[:8]}_{stamp_file.filename}"
-                    stamp_path = os.path.join(app.config['UPLOAD_IMAGES'], stamp_filename)
-                    stamp_file.save(stamp_path)
-                    # 验证文件是否成功保存
-                    if not os.path.exists(stamp_path):
-                        stamp_path = None
-                        return jsonify({
-                            'success': False,
-                            'error': 'Failed to save stamp file'
-                        }), 400
-                except Exception as e:
-                    return jsonify({
-                        'success': False,
-                        'error': f'Error saving stamp: {str(e)}'
-                    }), 400
-        
-        # 公司信息
-        company_info = {
-            'name': data.get('company_name', ''),
-            'address': data.get('company_address', '')
-        }
-        
-        # 发货方信息（必填）
-        shipper_info = {
-            'name': data.get('shipper_name', ''),
-            'address': data.get('shipper_address', ''),
-            'phone': data.get('shipper_phone', '')
-        }
-        
-        # 客户信息（Consignee/Buyer）
-        customer_info = {
-            'name': data.get('customer_name', ''),
-            'address': data.get('customer_address', ''),
-            'phone': data.get('customer_phone', ''),
-            'email': data.get('customer_email', ''),
-            'plant_address': data.get('plant_address', ''),
-            'pin': data.get('pin', ''),
-            'other': data.get('customer_other', '')
-        }
-        
-        # 运输详情（可选）
-        shipping_info = None
-        if data.get('port_of_shipment') or data.get('country_of_origin') or data.get('port_of_destination'):
-            shipping_info = {
-                'port_of_shipment': data.get('port_of_shipment', ''),
-                'country_of_origin': data.get('country_of_origin', ''),
-                'port_of_destination': data.get('port_of_destination', ''),
-                'place_of_destination': data.get('place_of_destination', ''),
-                'shipment_term': data.get('shipment_term', '')
-            }
-        
-        # 获取货币类型
-        currency = data.get('currency', 'CNY').upper()
-        
-        # 发票信息
-        invoice_info = {
-            'number': data.get('invoice_number', ''),
-            'date': data.get('invoice_date', datetime.now().strftime('%Y-%m-%d')),
-            'po_number': data.get('po_number', '')
-        }
-        
-        # 发票项目
-        items = []
-        item_count = int(data.get('item_count', 1))
-        
-        for i in range(item_count):
-            product_name = data.get(f'item_product_name_{i}', '').strip()
-            if product_name:  # 只添加有产品名称的项目（产品名称为必填项）
-                description = data.get(f'item_description_{i}', '')
-                product_number = data.get(f'item_product_number_{i}', '')
-                item_number = data.get(f'item_item_number_{i}', '')
-                hs_code = data.get(f'item_hs_code_{i}', '')
-                quantity = float(data.get(f'item_quantity_{i}', 0) or 0)
-                unit_price = float(data.get(f'item_unit_price_{i}', 0) or 0)
-                amount = float(data.get(f'item_amount_{i}', 0) or (quantity * unit_price))
-                
-                items.append({
-                    'product_name': product_name,
-                    'product_number': product_number,
-                    'item_number': item_number,
-                    'hs_code': hs_code,
-                    'description': description,
-                    'quantity': quantity,
-                    'unit_price': unit_price,
-                    'amount': amount
-                })
+        saved_filename = f"{prefix}_{uuid.uuid4().hex[:8]}_{upload.filename}"
+        saved_path = os.path.join(app.config['UPLOAD_IMAGES'], saved_filename)
+        with span(f'upload_save.{label}'):
+            upload.save(saved_path)
+    except Exception as e:
+        raise ValueError(f'Error saving {label}: {str(e)}')
+
+    # 验证文件是否成功保存
+    if not os.path.exists(saved_path):
+        raise ValueError(f'Failed to save {label} file')
+    image_info = getattr(upload.stream, 'image_info', None) or {}
+    annotate(**{f'{label}_bytes': os.path.getsize(saved_path),
+                f'{label}_size': f"{image_info.get('width', 0)}x{image_info.get('height', 0)}"})
+    return saved_path
+
+
+def _remove_uploads(*paths):
+    """清理上传的临时图片文件"""
+    for path in paths:
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as e:
+                print(f"Warning: Could not remove uploaded file {path}: {e}")
+
+
+def _upload_pixels(files, field):
+    """上传图片的像素数（取自上传校验时解析的文件头），没有上传时返回 None"""
+    upload = files.get(field)
+    if not upload or not upload.filename:
+        return None
+    image_info = getattr(upload.stream, 'image_info', None) or {}
+    return image_info.get('width', 0) * image_info.get('height', 0)
+
+
+def _estimate_render(invoice, files, profile=None):
+    """
+    预估渲染开销并决定处理方式
+
+    Args:
+        invoice: 发票数据（InvoiceData）
+        files: 上传文件
+        profile: 引用的公司档案（没有上传图片时使用档案中的图片）
+
+    Returns:
+        {'pages', 'render_ms', 'output_bytes', 'route'}，route 为 'queue' 或 'inline'
+    """
+    logo_pixels = _upload_pixels(files, 'company_logo')
+    stamp_pixels = _upload_pixels(files, 'company_stamp')
+    if profile is not None:
+        if logo_pixels is None and profile.logo_path:
+            logo_pixels = profile.logo_pixels
+        if stamp_pixels is None and profile.stamp_path:
+            stamp_pixels = profile.stamp_pixels
+    estimate = cost_model.estimate(invoice, (logo_pixels or 0, stamp_pixels or 0),
+                                   has_logo=logo_pixels is not None, has_stamp=stamp_pixels is not None)
+    heavy_ms = app.config['HEAVY_RENDER_MS']
+    queued = render_queue is not None and (heavy_ms <= 0 or estimate['render_ms'] > heavy_ms)
+    estimate['route'] = 'queue' if queued else 'inline'
+    annotate(estimated_pages=estimate['pages'], estimated_ms=estimate['render_ms'], route=estimate['route'])
+    return estimate
+
+
+def _client_id():
+    """渲染预算使用的客户端标识"""
+    header = app.config['RENDER_BUDGET_CLIENT_HEADER']
+    return (header and request.headers.get(header)) or request.remote_addr or 'unknown'
+
+
+def _request_profile():
+    """
+    当前请求引用的公司档案（表单字段或JSON中的 profile_id）
+
+    Returns:
+        档案，没有引用时返回 None
+
+    Raises:
+        ProfileNotFound: 档案不存在
+    """
+    if request.is_json:
+        payload = request.get_json()
+        profile_id = payload.get('profile_id') if isinstance(payload, dict) else None
+    else:
+        profile_id = request.form.get('profile_id')
+    if not profile_id:
+        return None
+    profile = profile_store.get(profile_id)
+    annotate(profile_id=profile.profile_id)
+    return profile
+
+
+def _parse_invoice(profile=None):
+    """
+    从当前请求（表单或JSON）构建发票数据
+
+    Args:
+        profile: 引用的公司档案，请求中为空的开票方、发货方和支付字段取档案中的值
+    """
+    with span('model'):
+        if request.is_json:
+            payload = request.get_json()
+            invoice = InvoiceData.from_json(payload)
+            currency_given = isinstance(payload, dict) and bool(payload.get('currency'))
+        else:
+            invoice = InvoiceData.from_form(request.form)
+            currency_given = bool(request.form.get('currency'))
+        if profile is not None:
+            profile.apply(invoice, use_currency=not currency_given)
+    annotate(items=len(invoice.items))
+    return invoice
+
+
+def _client_disconnected():
+    """
+    当前请求的客户端断开检测
+
+    Returns:
+        返回客户端是否已断开的函数；服务器不提供连接信息时返回 None（只检查渲染期限）
+    """
+    # ASGI 入口在事件循环上等待断开消息（见 asgi.py）
+    event = request.environ.get('invoice.disconnected')
+    if event is not None:
+        return event.is_set
+    # gunicorn 的同步/线程工作进程提供客户端连接
+    sock = request.environ.get('gunicorn.socket')
+    if sock is not None:
+        return partial(socket_disconnected, sock)
+    return None
+
+
+def _generate_invoice(invoice, files, profile=None, cancel=None):
+    """
+    根据发票数据和上传文件实际生成发票
+
+    出错时抛出异常，由调用方转换为错误响应（错误结果不会被幂等存储缓存）
+
+    Args:
+        invoice: 发票数据（InvoiceData）
+        files: 上传文件
+        profile: 引用的公司档案（没有上传 Logo/图章时使用档案中的图片）
+        cancel: 取消令牌（渲染期限、客户端断开），取消时抛出 RenderCancelled
+
+    Returns:
+        成功响应字典
+    """
+    # 渲染前预估开销（只看输入规模），先扣除客户端预算，超出时不保存上传文件
+    with span('estimate'):
+        estimate = _estimate_render(invoice, files, profile)
+    if render_budget is not None:
+        render_budget.charge(_client_id(), estimate['render_ms'])
+
+    uploaded_logo = None
+    uploaded_stamp = None
+    try:
+        # 处理文件上传 - Logo 和图章
+        uploaded_logo = _save_upload(files, 'company_logo', 'logo', 'logo')
+        uploaded_stamp = _save_upload(files, 'company_stamp', 'stamp', 'stamp')
+        # 没有上传时使用档案中已规范化的图片（档案文件不删除）
+        logo_path = uploaded_logo or (profile.logo_path if profile is not None else None)
+        stamp_path = uploaded_stamp or (profile.stamp_path if profile is not None else None)
+
+        # 渲染前预估内存开销，超出预算的输入直接拒绝
+        with span('memory_check'):
+            estimated_memory = check_memory_budget(invoice.items, (logo_path, stamp_path),
+                                                   app.config['RENDER_MEMORY_BUDGET'], app.config['RENDER_BACKEND'])
         
-        # 税费和折扣
-        tax_rate = float(data.get('tax_rate', 0) or 0)
-        discount = float(data.get('discount', 0) or 0)
+        # 生成唯一文件名
+        filename = f"invoice_{invoice.invoice_info['number'] or uuid.uuid4().hex[:8]}.pdf"
+        # 只有多页的大发票值得线性化（单页发票整个文件就是第一页）
+        linearize = app.config['LINEARIZE_PDF'] and estimate['pages'] >= app.config['LINEARIZE_MIN_PAGES']
         
-        # 备注和支付信息
-        notes = data.get('notes', '')
-        payment_info = None
-        if data.get('bank') or data.get('account'):
-            payment_info = {
-                'bank': data.get('bank', ''),
-                'account': data.get('account', ''),
-                'swift': data.get('swift', '')
+        # 需要排队的发票（配置了队列且预估耗时超过阈值）只入队，图片随任务一起发送
+        if estimate['route'] == 'queue':
+            with span('enqueue'):
+                job_id = render_queue.enqueue(build_render_job(
+                    invoice, filename, logo_path, stamp_path, backend=app.config['RENDER_BACKEND'],
+                    deterministic=app.config['DETERMINISTIC_PDF'], linearize=linearize
+                ))
+            annotate(job_id=job_id)
+            return {
+                'success': True,
+                'queued': True,
+                'job_id': job_id,
+                'status_url': f'/jobs/{job_id}',
+                'filename': filename,
+                'download_url': f'/download/{filename}'
             }
         
-        # 生成唯一文件名
-        filename = f"invoice_{invoice_info['number'] or uuid.uuid4().hex[:8]}.pdf"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
         # 生成发票
+        render_kwargs = dict(
+            output_path=filename,
+            invoice=invoice,
+            logo_path=logo_path,
+            stamp_path=stamp_path,
+            parallel_jobs=app.config['PARALLEL_RENDER_JOBS'],
+            backend=app.config['RENDER_BACKEND'],
+            deterministic=app.config['DETERMINISTIC_PDF'],
+            linearize=linearize
+        )
+        if cancel is not None:
+            # 上传较慢时可能已经超过期限或客户端已断开
+            cancel.check()
+        if render_pool is not None:
+            # 在渲染进程中渲染（子进程使用自己的分块缓存，提交到同一个存储）；内存采样只在请求进程内进行
+            with span('render_pool'):
+                digest = render_pool.render(cancel=cancel, **render_kwargs)
+            memory_stats = {}
+        else:
+            with track_peak_memory(app.config['MEMORY_TRACE_SAMPLE_RATE']) as memory_stats, span('render'), \
+                    cancel_scope(cancel):
+                digest = commit_invoice(invoice_storage, render_kwargs.pop('output_path'), section_cache=section_cache,
+                                        **render_kwargs)
+        annotate(output_bytes=invoice_storage.size(filename), backend=app.config['RENDER_BACKEND'])
+        if 'peak_bytes' in memory_stats:
+            print(f"Render memory: {filename} items={len(invoice.items)} "
+                  f"estimated={estimated_memory / 1024 / 1024:.1f}MB "
+                  f"peak={memory_stats['peak_bytes'] / 1024 / 1024:.1f}MB")
+    finally:
+        # 无论成功与否都清理上传的临时图片文件
+        with span('cleanup'):
+            _remove_uploads(uploaded_logo, uploaded_stamp)
+    
+    # 返回下载链接：带上这一次渲染的内容摘要，同一发票号之后重新生成（内容不同）时，
+    # 幂等重放返回的链接仍然下载这一次的PDF
+    return {
+        'success': True,
+        'filename': filename,
+        'digest': digest,
+        'download_url': f'/download/{filename}?v={digest}'
+    }
+
+
+def _result_available(result) -> bool:
+    """幂等结果引用的PDF是否还在存储中（已被 purge 回收时重新渲染）"""
+    digest = result.get('digest')
+    return digest is None or invoice_storage.has_blob(digest)
+
+
+@app.route('/generate', methods=['POST'])
+def generate_invoice():
+    """
+    处理表单提交并生成发票
+
+    支持 Idempotency-Key 请求头：同一个键（或内容完全相同的请求）在 TTL 内
+    只渲染一次，并发的重复请求等待同一次渲染并共享结果
+
+    超过 RENDER_TIMEOUT 或客户端断开时渲染中途停止，返回 503
+    """
+    timeout = app.config['RENDER_TIMEOUT']
+    cancel = CancelToken(deadline=time.time() + timeout if timeout > 0 else None,
+                         disconnected=_client_disconnected())
+    try:
+        # 表单和上传文件在第一次访问时解析
+        with span('parse'):
+            body = request.get_data(cache=True) if request.is_json else b''
+            form, files = request.form, request.files
+        try:
+            profile = _request_profile()
+        except ProfileNotFound as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 404
+        with span('fingerprint'):
+            fingerprint = request_fingerprint(form, files, body)
+            if profile is not None:
+                # 档案修改后同样的请求会生成不同的发票
+                fingerprint = f'{fingerprint}:{profile.revision}'
+        # 键按客户端隔离：不同客户端的 Idempotency-Key 和相同内容的请求互不重放
+        key = IdempotencyStore.make_key(request.headers.get('Idempotency-Key'), fingerprint, scope=_client_id())
         try:
-            create_invoice(
-                output_path=output_path,
-                company_info=company_info,
-                customer_info=customer_info,
-                invoice_info=invoice_info,
-                items=items,
-                shipper_info=shipper_info,
-                tax_rate=tax_rate,
-                discount=discount,
-                notes=notes if notes else None,
-                payment_info=payment_info,
-                logo_path=logo_path,
-                stamp_path=stamp_path,
-                shipping_info=shipping_info,
-                currency=currency
+            result, replayed = idempotency_store.run(
+                key, fingerprint, lambda: _generate_invoice(_parse_invoice(profile), files, profile, cancel),
+                valid=_result_available
             )
-        except Exception as e:
-            # 如果生成失败，清理上传的文件
-            if logo_path and os.path.exists(logo_path):
-                try:
-                    os.remove(logo_path)
-                except:
-                    pass
-            if stamp_path and os.path.exists(stamp_path):
-                try:
-                    os.remove(stamp_path)
-                except:
-                    pass
-            raise e
+        except IdempotencyConflict as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 422
+        except MemoryBudgetExceeded as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 413
+        except RenderCancelled as e:
+            # 客户端断开时这个响应不会被读取，只用于追踪日志
+            annotate(error=str(e), cancelled=e.reason)
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 503
+        except RenderBudgetExceeded as e:
+            annotate(error=str(e))
+            response = jsonify({
+                'success': False,
+                'error': str(e)
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+            return response
         
-        # 清理上传的临时图片文件（在PDF生成成功后）
-        if logo_path and os.path.exists(logo_path):
-            try:
-                os.remove(logo_path)
-            except Exception as e:
-                print(f"Warning: Could not remove logo file {logo_path}: {e}")
-        if stamp_path and os.path.exists(stamp_path):
-            try:
-                os.remove(stamp_path)
-            except Exception as e:
-                print(f"Warning: Could not remove stamp file {stamp_path}: {e}")
+        # 入队的任务返回 202，客户端通过 status_url 查询进度
+        with span('response'):
+            response = jsonify(result)
+        if result.get('queued'):
+            response.status_code = 202
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+            annotate(replayed=True)
+        return response
         
-        # 返回下载链接
+    except UploadRejected as e:
+        # 上传图片在解析请求体时被拒绝，请求体剩余部分没有读取
+        annotate(error=str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
+    except Exception as e:
+        annotate(error=str(e))
         return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+
+@app.route('/estimate', methods=['POST'])
+def estimate_invoice():
+    """
+    预估渲染开销（不渲染）
+
+    请求体与 /generate 相同（表单或JSON，可带图片）。返回预估的页数、渲染耗时和输出大小，
+    /generate 对这张发票的处理方式（inline 直接渲染 / queue 入队），以及客户端剩余的渲染预算
+    """
+    try:
+        profile = _request_profile()
+        invoice = _parse_invoice(profile)
+        with span('estimate'):
+            estimate = _estimate_render(invoice, request.files, profile)
+        response = {
             'success': True,
-            'filename': filename,
-            'download_url': f'/download/{filename}'
-        })
-        
+            'pages': estimate['pages'],
+            'render_ms': estimate['render_ms'],
+            'output_bytes': estimate['output_bytes'],
+            'route': estimate['route']
+        }
+        if render_budget is not None:
+            response['budget_remaining_ms'] = round(render_budget.remaining(_client_id()))
+        return jsonify(response)
+
+    except UploadRejected as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
     except Exception as e:
         return jsonify({
             'success': False,
@@ -289,60 +596,215 @@ def generate_invoice():
         }), 400
 
 
+# 表单字段 -> 档案字段
+PROFILE_FORM_FIELDS = {
+    'company_info': {'name': 'company_name', 'address': 'company_address'},
+    'shipper_info': {'name': 'shipper_name', 'address': 'shipper_address', 'phone': 'shipper_phone'},
+    'payment_info': {'bank': 'bank', 'account': 'account', 'swift': 'swift'},
+}
+
+
+def _profile_request():
+    """
+    从当前请求读取档案内容和图片
+
+    表单（multipart）字段与 /generate 相同，Logo/图章通过 company_logo / company_stamp 上传，
+    remove_logo / remove_stamp 为 true 时删除已保存的图片；JSON 请求体为
+    {'company_info', 'shipper_info', 'payment_info', 'currency'}（不含图片）。
+    只有请求中出现的部分会被更新。
+
+    Returns:
+        (档案内容, {'logo': 图片内容或 None, 'stamp': ...})
+    """
+    data = {}
+    images = {'logo': None, 'stamp': None}
+    if request.is_json:
+        payload = request.get_json()
+        if not isinstance(payload, dict):
+            raise ValueError('Request body must be a JSON object')
+        for key in ('company_info', 'shipper_info', 'payment_info', 'currency'):
+            if key in payload:
+                data[key] = payload[key]
+        return data, images
+
+    form = request.form
+    for key, fields in PROFILE_FORM_FIELDS.items():
+        if any(name in form for name in fields.values()):
+            data[key] = {field: form.get(name, '') for field, name in fields.items()}
+    if 'payment_info' in data and not any(data['payment_info'].values()):
+        data['payment_info'] = None
+    if 'currency' in form:
+        data['currency'] = form.get('currency', '')
+    for kind, field in (('logo', 'company_logo'), ('stamp', 'company_stamp')):
+        upload = request.files.get(field)
+        if upload and upload.filename:
+            if not allowed_file(upload.filename):
+                raise ValueError(f'Invalid {kind} file format. Allowed formats: {", ".join(ALLOWED_EXTENSIONS)}')
+            images[kind] = upload.read()
+        elif form.get(f'remove_{kind}', '').lower() == 'true':
+            images[kind] = b''
+    return data, images
+
+
+@app.route('/profiles', methods=['POST'])
+def create_profile():
+    """创建公司档案，返回 profile_id"""
+    try:
+        data, images = _profile_request()
+        profile = profile_store.save(data, images)
+    except UploadRejected as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'profile': profile.to_json()}), 201
+
+
+@app.route('/profiles/<profile_id>', methods=['GET', 'PUT', 'DELETE'])
+def manage_profile(profile_id):
+    """查询、更新（只更新请求中出现的部分）或删除公司档案"""
+    try:
+        if request.method == 'DELETE':
+            if not profile_store.delete(profile_id):
+                raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+            return jsonify({'success': True})
+        if request.method == 'PUT':
+            data, images = _profile_request()
+            profile = profile_store.save(data, images, profile_id=profile_id)
+        else:
+            profile = profile_store.get(profile_id)
+    except ProfileNotFound as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except UploadRejected as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'profile': profile.to_json()})
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """查询渲染任务状态"""
+    if render_queue is None:
+        return jsonify({'success': False, 'error': 'Render queue is not enabled'}), 404
+    status = render_queue.status(job_id)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    
+    response = {
+        'success': status['state'] != DEAD,
+        'job_id': job_id,
+        'state': status['state'],
+        'attempts': status['attempts']
+    }
+    if status['state'] == DONE:
+        filename = status['result']['filename']
+        digest = status['result'].get('digest')
+        response['filename'] = filename
+        # 旧版本工作进程的结果没有内容摘要
+        response['download_url'] = f'/download/{filename}?v={digest}' if digest else f'/download/{filename}'
+    elif status['error']:
+        response['error'] = status['error']
+    return jsonify(response)
+
+
 @app.route('/download/<filename>')
 def download_invoice(filename):
     """下载生成的发票PDF"""
     # 安全检查：防止路径遍历攻击
-    if '..' in filename or '/' in filename or '\\' in filename:
+    try:
+        check_name(filename)
+    except ValueError:
         return "无效的文件名", 400
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return send_file(file_path, as_attachment=True, download_name=filename)
+    # /generate 返回的链接带内容摘要（v）：读取那一次渲染的PDF，同名文件之后被重新生成也不受影响
+    digest = request.args.get('v')
+    if digest is not None and not is_digest(digest):
+        return "无效的版本", 400
+
+    # 存储中只有完整提交的文件，不会读到渲染到一半的PDF
+    if digest is not None:
+        file_path = invoice_storage.blob_path(digest)
+        file_path = file_path if file_path is not None and os.path.isfile(file_path) else None
     else:
-        return "文件不存在", 404
+        file_path = invoice_storage.path(filename)
+    if file_path is not None:
+        return send_file(file_path, as_attachment=True, download_name=filename)
+    pdf_file = invoice_storage.open_blob(digest) if digest is not None else invoice_storage.open(filename)
+    if pdf_file is not None:
+        return send_file(pdf_file, mimetype='application/pdf', as_attachment=True, download_name=filename)
+    return "文件不存在", 404
+
+
+def _stacks_response(counts, **headers):
+    """折叠栈文本响应（focus 参数只保留经过该函数的栈）"""
+    focus = request.args.get('focus')
+    if focus:
+        counts = focus_stacks(counts, focus)
+    response = make_response(format_collapsed(counts))
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    for name, value in headers.items():
+        response.headers[name] = str(value)
+    return response
+
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    采样分析：本机所有工作进程在 seconds 秒（默认10）内处理请求的调用栈，返回折叠栈（可直接生成火焰图）
+
+    需要 X-Debug-Token 请求头（或 token 参数）与 DEBUG_PROFILE_TOKEN 一致；未配置令牌时不存在该端点
+    """
+    if profiler is None:
+        return "Not Found", 404
+    if not profiler.check_token(request.headers.get('X-Debug-Token') or request.args.get('token')):
+        return "Forbidden", 403
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return "Invalid seconds", 400
+    window = profiler.start_window(seconds)
+    counts, workers, samples = profiler.collect_window(window)
+    return _stacks_response(counts, **{'X-Profile-Workers': workers, 'X-Profile-Samples': samples})
+
+
+@app.route('/debug/profile/requests/<result_id>')
+def debug_request_profile(result_id):
+    """单个请求（带 X-Profile-Request 请求头）的采样结果"""
+    if profiler is None:
+        return "Not Found", 404
+    if not profiler.check_token(request.headers.get('X-Debug-Token') or request.args.get('token')):
+        return "Forbidden", 403
+    counts = profiler.read_request_profile(result_id)
+    if counts is None:
+        return "Not Found", 404
+    return _stacks_response(counts)
 
 
 @app.route('/preview', methods=['POST'])
 def preview_invoice():
-    """预览发票（返回JSON数据）"""
+    """
+    预览发票（返回JSON数据）
+
+    与 /generate 使用同一个数据模型（表单或JSON），预览的总计与生成的PDF一致
+    """
     try:
-        data = request.form
-        
-        # 计算总计
-        items = []
-        subtotal = 0
-        item_count = int(data.get('item_count', 1))
-        
-        for i in range(item_count):
-            description = data.get(f'item_description_{i}', '')
-            if description:
-                quantity = float(data.get(f'item_quantity_{i}', 0) or 0)
-                unit_price = float(data.get(f'item_unit_price_{i}', 0) or 0)
-                amount = float(data.get(f'item_amount_{i}', 0) or (quantity * unit_price))
-                subtotal += amount
-                
-                items.append({
-                    'description': description,
-                    'quantity': quantity,
-                    'unit_price': unit_price,
-                    'amount': amount
-                })
-        
-        tax_rate = float(data.get('tax_rate', 0) or 0)
-        discount = float(data.get('discount', 0) or 0)
-        tax_amount = subtotal * (tax_rate / 100) if tax_rate > 0 else 0
-        total = subtotal - discount + tax_amount
+        invoice = _parse_invoice(_request_profile())
+        totals = invoice.totals()
         
         return jsonify({
             'success': True,
-            'subtotal': subtotal,
-            'tax_amount': tax_amount,
-            'discount': discount,
-            'total': total,
-            'items': items
+            'subtotal': totals['subtotal'],
+            'tax_amount': totals['tax_amount'],
+            'discount': totals['discount'],
+            'total': totals['total'],
+            'items': invoice.items.to_dicts()
         })
         
+    except UploadRejected as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
     except Exception as e:
         return jsonify({
             'success': False,
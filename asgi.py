@@ -0,0 +1,435 @@
+"""
+ASGI 入口 - 慢速客户端不占用渲染能力
+
+- 请求体（表单、上传图片、JSON）在事件循环上异步读取，读完后才交给 Flask 处理；
+  上传很慢的客户端只占用一个连接，不占用线程或渲染进程。较大的请求体暂存到临时文件。
+  multipart 请求中的上传图片在读取时逐块校验（见 upload_guard.MultipartImageValidator），
+  与 WSGI 部署一样，不合格的上传在请求体读完之前被拒绝
+- /health 和 /download 直接在事件循环上处理，下载按块流式发送，慢速下载不占用线程；
+  /download 支持单个 Range 请求（配合线性化PDF，浏览器先取第一页所需的部分），ETag 为文件内容的 SHA-256
+- 其他路由在有界线程池中运行原有的 Flask 应用，路由、校验和响应与 WSGI 部署完全相同；
+  Flask 处理期间在事件循环上等待客户端断开，断开时通过 environ['invoice.disconnected'] 通知渲染停止
+- create_invoice 交给有界的渲染进程池（见 render_pool.py），同时渲染的发票数不超过进程数
+
+启动（需要 ASGI 服务器，如 uvicorn；每个服务器进程一个事件循环和一个渲染进程池）：
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+
+import app as app_module
+from render_pool import RenderPool
+from storage import check_name, is_digest
+from upload_guard import MultipartImageValidator, UploadRejected
+
+# 请求体超过这个大小时暂存到临时文件
+BODY_SPOOL_BYTES = 1024 * 1024
+# /download 每次读取和发送的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 与 app.after_request 相同的响应头（事件循环上直接处理的路由不经过 Flask）
+COMMON_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-methods', b'GET, POST, PUT, DELETE, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type, Idempotency-Key'),
+    (b'x-content-type-options', b'nosniff'),
+    (b'x-frame-options', b'SAMEORIGIN'),
+    (b'x-xss-protection', b'1; mode=block'),
+]
+
+
+class RequestTooLarge(Exception):
+    """请求体超过 MAX_CONTENT_LENGTH"""
+
+
+class InvoiceASGI:
+    """发票服务的 ASGI 应用"""
+
+    def __init__(self, flask_app, wsgi_threads: int = 32, render_processes: int = 0):
+        """
+        Args:
+            flask_app: Flask 应用
+            wsgi_threads: 运行 Flask 路由的线程数
+            render_processes: 渲染进程数（0 表示在 Flask 线程中直接渲染）
+        """
+        self.flask_app = flask_app
+        self.wsgi_threads = wsgi_threads
+        self.render_processes = render_processes
+        self.max_body = flask_app.config.get('MAX_CONTENT_LENGTH') or 0
+        self._wsgi_executor = None
+        self.render_pool = None
+
+    # ---- 生命周期 ----
+
+    def startup(self):
+        """创建线程池和渲染进程池（服务器不支持 lifespan 时在第一个请求时调用）"""
+        if self._wsgi_executor is not None:
+            return
+        self._wsgi_executor = ThreadPoolExecutor(max_workers=self.wsgi_threads, thread_name_prefix='wsgi')
+        storage_url = self.flask_app.config['INVOICE_STORAGE_URL']
+        if self.render_processes > 0:
+            if storage_url.startswith('memory://'):
+                print("Warning: render pool disabled, memory:// storage is not shared between processes")
+            else:
+                self.render_pool = RenderPool(
+                    self.render_processes, storage_url,
+                    section_cache_entries=self.flask_app.config['SECTION_CACHE_ENTRIES'],
+                    text_cache_entries=self.flask_app.config['TEXT_CACHE_ENTRIES']
+                )
+                app_module.render_pool = self.render_pool
+
+    def shutdown(self):
+        """等待正在处理的请求和渲染完成后关闭线程池和进程池"""
+        if self._wsgi_executor is not None:
+            self._wsgi_executor.shutdown(wait=True)
+            self._wsgi_executor = None
+        if self.render_pool is not None:
+            app_module.render_pool = None
+            self.render_pool.close()
+            self.render_pool = None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # ---- 请求分派 ----
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        self.startup()
+        method = scope['method']
+        path = scope['path']
+        if method in ('GET', 'HEAD'):
+            if path == '/health':
+                await self._health(send, method == 'HEAD')
+                return
+            if path.startswith('/download/'):
+                await self._download(scope, send, path[len('/download/'):], method == 'HEAD')
+                return
+        await self._wsgi(scope, receive, send)
+
+    async def _health(self, send, head: bool):
+        """健康检查（与 Flask 的 /health 相同，另外返回渲染进程池状态）"""
+        payload = {'status': 'ok', 'message': '服务运行正常'}
+        if self.render_pool is not None:
+            payload['render_pool'] = self.render_pool.stats()
+        await _send_json(send, 200, payload, head)
+
+    async def _download(self, scope, send, filename: str, head: bool):
+        """流式发送存储中的发票PDF（文件读取在线程中进行，发送在事件循环上等待客户端）"""
+        try:
+            check_name(filename)
+        except ValueError:
+            await _send_text(send, 400, '无效的文件名')
+            return
+        # 与 Flask 的 /download 相同：带内容摘要（v）时读取那一次渲染的PDF
+        version = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v', [None])[0]
+        if version is not None and not is_digest(version):
+            await _send_text(send, 400, '无效的版本')
+            return
+        storage = app_module.invoice_storage
+        loop = asyncio.get_running_loop()
+
+        def open_pdf():
+            # 只解析一次别名，按得到的摘要打开 blob：ETag 与发送的内容始终一致，
+            # 即使别名在这之间被重新提交
+            digest = version if version is not None else storage.resolve(filename)
+            if digest is None:
+                # 没有别名：根目录下的旧文件（没有 ETag）
+                return None, storage.open(filename)
+            try:
+                return digest, storage.open_blob(digest)
+            except FileNotFoundError:
+                # blob 已被 purge 回收
+                return digest, None
+
+        digest, pdf_file = await loop.run_in_executor(None, open_pdf)
+        if pdf_file is None:
+            await _send_text(send, 404, '文件不存在')
+            return
+        try:
+            size = await loop.run_in_executor(None, _file_size, pdf_file)
+            etag = f'"{digest}"' if digest else None
+            headers = COMMON_HEADERS + [
+                (b'content-type', b'application/pdf'),
+                (b'content-disposition', _attachment(filename)),
+                (b'accept-ranges', b'bytes'),
+            ]
+            if etag:
+                headers.append((b'etag', etag.encode('latin-1')))
+            status, start, length = 200, 0, size
+            range_header = _header(scope, b'range')
+            if_range = _header(scope, b'if-range')
+            # If-Range 与当前版本不一致时（文件已变化）忽略 Range，返回完整文件
+            if range_header and (if_range is None or (etag is not None and if_range == etag)):
+                try:
+                    byte_range = _parse_range(range_header, size)
+                except ValueError:
+                    await send({'type': 'http.response.start', 'status': 416, 'headers': COMMON_HEADERS + [
+                        (b'content-range', f'bytes */{size}'.encode('latin-1')),
+                        (b'content-length', b'0'),
+                    ]})
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                if byte_range is not None:
+                    start, end = byte_range
+                    status, length = 206, end - start + 1
+                    headers.append((b'content-range', f'bytes {start}-{end}/{size}'.encode('latin-1')))
+            headers.append((b'content-length', str(length).encode('latin-1')))
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            if head or not length:
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            if start:
+                await loop.run_in_executor(None, pdf_file.seek, start)
+            remaining = length
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, pdf_file.read, min(DOWNLOAD_CHUNK_SIZE, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        finally:
+            pdf_file.close()
+
+    async def _wsgi(self, scope, receive, send):
+        """读完请求体后在线程池中运行 Flask 应用"""
+        try:
+            body = await self._read_body(scope, receive)
+        except RequestTooLarge:
+            await _send_json(send, 413, {'success': False, 'error': 'Request body too large'})
+            return
+        except UploadRejected as e:
+            # 与 Flask 路由中的处理相同，请求体剩余部分不再读取
+            await _send_json(send, e.status_code, {'success': False, 'error': str(e)})
+            return
+        if body is None:
+            # 客户端在上传完成前断开
+            return
+        stream, length = body
+        disconnected = threading.Event()
+        watcher = asyncio.ensure_future(_watch_disconnect(receive, disconnected))
+        try:
+            environ = _environ(scope, stream, length)
+            environ['invoice.disconnected'] = disconnected
+            loop = asyncio.get_running_loop()
+            status, headers, chunks = await loop.run_in_executor(self._wsgi_executor, self._call_flask, environ)
+        finally:
+            watcher.cancel()
+            stream.close()
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    async def _read_body(self, scope, receive) -> Optional[Tuple[tempfile.SpooledTemporaryFile, int]]:
+        """
+        在事件循环上读取完整的请求体
+
+        Returns:
+            (请求体文件, 字节数)，客户端中途断开时返回 None
+
+        Raises:
+            RequestTooLarge: 请求体超过 MAX_CONTENT_LENGTH
+            UploadRejected: 上传图片未通过校验
+        """
+        declared = _header(scope, b'content-length')
+        if self.max_body and declared and declared.isdigit() and int(declared) > self.max_body:
+            raise RequestTooLarge()
+        validator = MultipartImageValidator.for_request(_header(scope, b'content-type') or '',
+                                                        self.flask_app.request_class)
+        stream = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+        size = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    stream.close()
+                    return None
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if self.max_body and size > self.max_body:
+                    raise RequestTooLarge()
+                more = message.get('more_body', False)
+                if validator is not None:
+                    validator.feed(chunk, final=not more)
+                stream.write(chunk)
+                if not more:
+                    break
+        except BaseException:
+            stream.close()
+            raise
+        stream.seek(0)
+        return stream, size
+
+    def _call_flask(self, environ: Dict) -> Tuple[int, List[Tuple[bytes, bytes]], List[bytes]]:
+        # 在线程池中运行：调用 WSGI 应用并收集完整响应（/download 之外的响应都很小）
+        response = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return chunks.append
+
+        result = self.flask_app.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    chunks.append(chunk)
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+        status, headers = response
+        return (int(status.split(' ', 1)[0]),
+                [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+                chunks)
+
+
+async def _watch_disconnect(receive, disconnected: threading.Event):
+    # 请求体已经读完，之后 receive 只会收到断开消息
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get('headers', ()):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _environ(scope, stream, length: int) -> Dict:
+    """由 ASGI scope 构建 WSGI environ（PEP 3333）"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').lower()
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析 Range 请求头（只支持单个字节范围）
+
+    Args:
+        header: Range 请求头，如 bytes=0-1023、bytes=1024-、bytes=-500
+        size: 文件大小
+
+    Returns:
+        (起始字节, 结束字节)（包含两端）；请求头无效或包含多个范围时返回 None（返回完整文件）
+
+    Raises:
+        ValueError: 范围完全超出文件（416）
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) \
+            or (last and not last.isdigit()):
+        return None
+    if not first:
+        # 后缀范围：最后 N 个字节
+        if int(last) == 0 or size == 0:
+            raise ValueError('Unsatisfiable range')
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def _file_size(pdf_file) -> int:
+    pdf_file.seek(0, 2)
+    size = pdf_file.tell()
+    pdf_file.seek(0)
+    return size
+
+
+def _attachment(filename: str) -> bytes:
+    try:
+        return f'attachment; filename="{filename}"'.encode('latin-1')
+    except UnicodeEncodeError:
+        from urllib.parse import quote
+        return f"attachment; filename*=UTF-8''{quote(filename)}".encode('latin-1')
+
+
+async def _send_json(send, status: int, payload: Dict, head: bool = False):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await _send(send, status, b'application/json; charset=utf-8', body, head)
+
+
+async def _send_text(send, status: int, text: str):
+    await _send(send, status, b'text/html; charset=utf-8', text.encode('utf-8'))
+
+
+async def _send(send, status: int, content_type: bytes, body: bytes, head: bool = False):
+    headers = COMMON_HEADERS + [(b'content-type', content_type),
+                                (b'content-length', str(len(body)).encode('latin-1'))]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+
+application = InvoiceASGI(
+    app_module.app,
+    wsgi_threads=app_module.app.config['ASGI_WSGI_THREADS'],
+    render_processes=app_module.app.config['RENDER_PROCESSES']
+)
@@ -0,0 +1,232 @@
+"""
+静态资源管道 - 启动时为静态文件生成带内容指纹的URL并预压缩，无需单独的构建步骤
+
+- 指纹URL（/assets/css/style.<hash>.css）内容不变则URL不变，可以长期缓存（immutable）
+- gzip（以及安装了 brotli 时的 br）压缩结果在启动时生成并保存在内存中
+- 首页渲染结果按 ETag 缓存，重复访问只需一次条件请求（304）
+"""
+from typing import Dict, Optional, Tuple
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, abort, render_template, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 参与指纹和预压缩的文件类型
+ASSET_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.ico', '.png', '.jpg', '.jpeg', '.gif', '.webp'}
+# 这些类型本身已压缩，不再做 gzip/br
+PRECOMPRESSED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+# 小于该大小的文件压缩收益很小
+MIN_COMPRESS_SIZE = 256
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _etag_matches(etags) -> bool:
+    """请求的 If-None-Match 是否包含其中任一 ETag"""
+    if_none_match = request.if_none_match
+    return if_none_match.star_tag or any(if_none_match.contains(etag) for etag in etags)
+
+
+def _choose_encoding(variants: Dict[str, bytes]) -> str:
+    """按 Accept-Encoding 选择压缩格式（br 优先于 gzip）"""
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted[encoding]:
+            return encoding
+    return 'identity'
+
+
+def compress_variants(data: bytes, compress: bool = True) -> Dict[str, bytes]:
+    """
+    生成一份内容的各压缩版本
+
+    Args:
+        data: 原始内容
+        compress: 是否压缩
+
+    Returns:
+        {'identity': ..., 'gzip': ..., 'br': ...}，压缩后不更小的版本会被省略
+    """
+    variants = {'identity': data}
+    if not compress or len(data) < MIN_COMPRESS_SIZE:
+        return variants
+    # mtime=0 保证同样的内容得到同样的压缩结果
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        variants['gzip'] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            variants['br'] = compressed
+    return variants
+
+
+def build_response(variants: Dict[str, bytes], content_type: str, etag: str, cache_control: str) -> Response:
+    """
+    根据请求头返回 304 或合适压缩版本的响应
+
+    Args:
+        variants: compress_variants 的结果
+        content_type: Content-Type 响应头
+        etag: 内容的 ETag（不含压缩格式）
+        cache_control: Cache-Control 响应头
+    """
+    encoding = _choose_encoding(variants)
+    # 不同压缩格式的字节不同，ETag 需要区分
+    tagged = etag if encoding == 'identity' else f"{etag}-{encoding}"
+    # 客户端缓存的是任一压缩版本，内容都相同，均可返回 304
+    if _etag_matches([etag] + [f"{etag}-{name}" for name in variants if name != 'identity']):
+        response = Response(status=304)
+    else:
+        response = Response(variants[encoding], content_type=content_type)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(tagged)
+    response.headers['Cache-Control'] = cache_control
+    if len(variants) > 1:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+class AssetManifest:
+    """静态资源清单：逻辑文件名 -> 指纹文件名及预压缩内容"""
+
+    def __init__(self, static_folder: str, url_prefix: str = '/assets'):
+        """
+        初始化并扫描静态目录
+
+        Args:
+            static_folder: 静态文件目录
+            url_prefix: 指纹资源的URL前缀
+        """
+        self.static_folder = static_folder
+        self.url_prefix = url_prefix.rstrip('/')
+        self.files = {}      # 逻辑文件名 -> 指纹文件名
+        self.assets = {}     # 指纹文件名 -> (content_type, etag, variants)
+        self.scan()
+
+    @staticmethod
+    def fingerprinted_name(filename: str, digest: str) -> str:
+        """css/style.css -> css/style.<digest>.css"""
+        root, ext = os.path.splitext(filename)
+        return f"{root}.{digest}{ext}"
+
+    def scan(self):
+        """扫描静态目录，计算指纹并预压缩"""
+        files = {}
+        assets = {}
+        for dirpath, _, filenames in os.walk(self.static_folder):
+            for name in filenames:
+                ext = os.path.splitext(name)[1].lower()
+                if ext not in ASSET_EXTENSIONS:
+                    continue
+                path = os.path.join(dirpath, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                fingerprinted = self.fingerprinted_name(filename, digest)
+                content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+                    content_type += '; charset=utf-8'
+                files[filename] = fingerprinted
+                assets[fingerprinted] = (
+                    content_type,
+                    digest,
+                    compress_variants(data, ext not in PRECOMPRESSED_EXTENSIONS)
+                )
+        self.files = files
+        self.assets = assets
+
+    def url(self, filename: str) -> str:
+        """
+        获取静态文件的指纹URL
+
+        Args:
+            filename: 相对于静态目录的文件名
+
+        Returns:
+            指纹URL；文件不在清单中时退回普通的 /static URL
+        """
+        fingerprinted = self.files.get(filename)
+        if fingerprinted is None:
+            return f"/static/{filename}"
+        return f"{self.url_prefix}/{fingerprinted}"
+
+    def lookup(self, fingerprinted: str) -> Optional[Tuple[str, str, Dict[str, bytes]]]:
+        return self.assets.get(fingerprinted)
+
+    def serve(self, fingerprinted: str) -> Response:
+        """返回指纹资源（长期缓存）"""
+        asset = self.lookup(fingerprinted)
+        if asset is None:
+            abort(404)
+        content_type, digest, variants = asset
+        return build_response(variants, content_type, digest, IMMUTABLE_CACHE_CONTROL)
+
+
+class CachedPage:
+    """渲染一次后缓存的页面（模板只依赖资源URL，内容在进程生命周期内不变）"""
+
+    def __init__(self, template: str):
+        """
+        Args:
+            template: 模板文件名
+        """
+        self.template = template
+        self._rendered = None
+
+    def _render(self, refresh: bool = False) -> Tuple[str, Dict[str, bytes]]:
+        if self._rendered is None or refresh:
+            body = render_template(self.template).encode('utf-8')
+            etag = hashlib.sha256(body).hexdigest()[:16]
+            self._rendered = (etag, compress_variants(body))
+        return self._rendered
+
+    def serve(self, refresh: bool = False) -> Response:
+        """
+        返回页面；客户端缓存仍有效时返回 304
+
+        Args:
+            refresh: 重新渲染模板（调试模式下使用，修改模板后立即生效）
+        """
+        etag, variants = self._render(refresh)
+        # no-cache：可以缓存，但每次使用前需要用 ETag 重新验证
+        return build_response(variants, 'text/html; charset=utf-8', etag, 'no-cache')
+
+
+def init_assets(app, url_prefix: str = '/assets') -> AssetManifest:
+    """
+    为 Flask 应用注册资源路由和模板函数 asset_url
+
+    Args:
+        app: Flask 应用
+        url_prefix: 指纹资源的URL前缀
+
+    Returns:
+        资源清单
+    """
+    manifest = AssetManifest(app.static_folder, url_prefix)
+
+    @app.route(f"{manifest.url_prefix}/<path:filename>", endpoint='asset')
+    def asset(filename):
+        if app.debug:
+            # 调试模式下每次重新扫描，修改静态文件后立即生效
+            manifest.scan()
+        return manifest.serve(filename)
+
+    @app.context_processor
+    def asset_helpers():
+        if app.debug:
+            manifest.scan()
+        return {'asset_url': manifest.url}
+
+    return manifest
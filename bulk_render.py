@@ -0,0 +1,387 @@
+"""
+离线批量渲染 - 从 JSONL 或 CSV 文件读取发票数据，多进程渲染到输出目录，支持断点续跑
+
+入口：
+
+    python -m invoice_generator invoices.jsonl --output out/ --jobs 4
+
+输入格式：
+- JSONL：每行一张发票，字段与 InvoiceData.from_json 相同；可额外带 filename、logo_path、stamp_path
+  （相对路径相对于输入文件所在目录）
+- CSV：每行一个项目，invoice_number 相同的连续行属于同一张发票；列名与网页表单字段相同
+  （company_name、customer_name、invoice_number、currency、tax_rate ...），
+  项目列为 product_name、product_number、item_number、hs_code、quantity、unit_price、amount
+
+断点文件（默认 <output>/.checkpoint.jsonl）每完成一张发票追加一行并落盘。再次运行时，
+按记录内容的哈希跳过已完成且输出文件仍存在的发票；失败的发票会重新渲染。
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Dict, Iterator, List, Optional, Set
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from invoice_model import InvoiceData
+
+CHECKPOINT_NAME = '.checkpoint.jsonl'
+# 进度输出间隔（秒）
+PROGRESS_INTERVAL = 2.0
+
+# CSV 中属于项目的列（其余列为发票级字段）
+CSV_ITEM_COLUMNS = ('product_name', 'product_number', 'item_number', 'hs_code', 'quantity', 'unit_price', 'amount')
+
+_FILENAME_UNSAFE = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+class BulkRecord:
+    """输入文件中的一张发票"""
+
+    __slots__ = ('key', 'line', 'kind', 'data')
+
+    def __init__(self, key: str, line: int, kind: str, data):
+        self.key = key      # 记录内容的哈希，用于断点续跑
+        self.line = line    # 在输入文件中的起始行号（用于错误信息）
+        self.kind = kind    # 'json' 或 'form'
+        self.data = data
+
+
+def _record_key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]
+
+
+def read_jsonl(path: str) -> Iterator[BulkRecord]:
+    """逐行读取 JSONL 输入"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                data = e
+            yield BulkRecord(_record_key(line), line_number, 'json', data)
+
+
+def read_csv(path: str) -> Iterator[BulkRecord]:
+    """读取 CSV 输入，invoice_number 相同的连续行合并为一张发票"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        group = []
+        start_line = 2
+        for row in reader:
+            number = row.get('invoice_number', '')
+            if group and number != group[0].get('invoice_number', ''):
+                yield _csv_record(group, start_line)
+                start_line = reader.line_num
+                group = []
+            group.append(row)
+        if group:
+            yield _csv_record(group, start_line)
+
+
+def _csv_record(rows, start_line: int) -> BulkRecord:
+    """把一组 CSV 行转换为网页表单格式（由 InvoiceData.from_form 解析）"""
+    form = {name: value for name, value in rows[0].items()
+            if name and name not in CSV_ITEM_COLUMNS and value not in (None, '')}
+    for index, row in enumerate(rows):
+        for column in CSV_ITEM_COLUMNS:
+            value = row.get(column)
+            if value not in (None, ''):
+                form[f'item_{column}_{index}'] = value
+    form['item_count'] = str(len(rows))
+    key = _record_key(json.dumps(form, sort_keys=True, ensure_ascii=False))
+    return BulkRecord(key, start_line, 'form', form)
+
+
+def read_records(path: str, input_format: Optional[str] = None) -> Iterator[BulkRecord]:
+    """
+    按格式读取输入文件
+
+    Args:
+        path: 输入文件
+        input_format: 'jsonl' 或 'csv'，为 None 时按扩展名判断
+    """
+    if input_format is None:
+        input_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if input_format == 'csv':
+        return read_csv(path)
+    return read_jsonl(path)
+
+
+def output_filename(invoice: InvoiceData, key: str, requested: Optional[str] = None) -> str:
+    """输出文件名：指定的 filename，否则与网页端相同的 invoice_<发票号>.pdf"""
+    if requested:
+        name = os.path.basename(requested)
+    else:
+        name = f"invoice_{invoice.invoice_info['number'] or key[:12]}.pdf"
+    name = _FILENAME_UNSAFE.sub('_', name)
+    return name if name.lower().endswith('.pdf') else f'{name}.pdf'
+
+
+def render_record(record: BulkRecord, output_dir: str, base_dir: str, logo_path: Optional[str],
+                  stamp_path: Optional[str], backend: str, deterministic: bool = False) -> Dict:
+    """
+    渲染一张发票（在工作进程中执行）
+
+    Returns:
+        {'key', 'filename', 'items', 'seconds', 'warnings'} 或 {'key', 'error', 'warnings'}
+    """
+    from invoice_generator import create_invoice
+
+    started = time.perf_counter()
+    # create_invoice 的输出（每张发票一行"发票已成功生成"）会和进度混在一起，这里只保留警告
+    output = StringIO()
+    try:
+        if isinstance(record.data, Exception):
+            raise ValueError(f'invalid JSON: {record.data}')
+        requested = None
+        if record.kind == 'json':
+            if not isinstance(record.data, dict):
+                raise ValueError('each line must be a JSON object')
+            invoice = InvoiceData.from_json(record.data)
+            requested = record.data.get('filename')
+            logo_path = record.data.get('logo_path') or logo_path
+            stamp_path = record.data.get('stamp_path') or stamp_path
+        else:
+            invoice = InvoiceData.from_form(record.data)
+        filename = output_filename(invoice, record.key, requested)
+        with redirect_stdout(output):
+            create_invoice(
+                os.path.join(output_dir, filename),
+                invoice=invoice,
+                logo_path=os.path.join(base_dir, logo_path) if logo_path else None,
+                stamp_path=os.path.join(base_dir, stamp_path) if stamp_path else None,
+                backend=backend,
+                deterministic=deterministic
+            )
+    except Exception as e:
+        return {'key': record.key, 'line': record.line, 'error': f'{type(e).__name__}: {e}',
+                'warnings': _warnings(output)}
+    return {'key': record.key, 'line': record.line, 'filename': filename, 'items': len(invoice.items),
+            'seconds': round(time.perf_counter() - started, 4), 'warnings': _warnings(output)}
+
+
+def _warnings(output: StringIO) -> List[str]:
+    """create_invoice 输出中的警告行"""
+    return [line for line in output.getvalue().splitlines() if line.startswith('Warning')]
+
+
+class Checkpoint:
+    """只追加的断点文件，每条记录写入后立即落盘"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = {}  # key -> filename
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 崩溃时可能留下不完整的最后一行
+                        continue
+                    if entry.get('status') == 'done':
+                        self.done[entry['key']] = entry['filename']
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # 新记录不能接在不完整的行后面
+                    self._file.write('\n')
+
+    def is_done(self, key: str, output_dir: str) -> bool:
+        filename = self.done.get(key)
+        return filename is not None and os.path.exists(os.path.join(output_dir, filename))
+
+    def record(self, result: Dict):
+        entry = dict(result, status='failed' if 'error' in result else 'done')
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if entry['status'] == 'done':
+            self.done[entry['key']] = entry['filename']
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """吞吐量和剩余时间"""
+
+    def __init__(self, total: int, stream=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._last_report = 0.0
+        self.stream = stream
+
+    def update(self, failed: bool = False):
+        self.done += 1
+        self.failed += failed
+        if time.monotonic() - self._last_report >= PROGRESS_INTERVAL or self.done >= self.total:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        self._last_report = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = (self.total - self.done) / rate if rate > 0 else 0.0
+        print(f"[{self.done}/{self.total}] {rate:.1f} invoices/s, {self.failed} failed, "
+              f"elapsed {_format_seconds(elapsed)}, ETA {_format_seconds(remaining)}", file=self.stream)
+
+
+def _format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def _init_worker():
+    # 工作进程忽略 Ctrl+C，由主进程等待正在渲染的发票完成后再退出；SIGTERM 恢复默认行为
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def run_bulk(input_path: str, output_dir: str, jobs: int = 1, checkpoint_path: Optional[str] = None,
+             input_format: Optional[str] = None, logo_path: Optional[str] = None,
+             stamp_path: Optional[str] = None, backend: str = 'platypus', limit: int = 0,
+             deterministic: bool = False) -> Dict[str, int]:
+    """
+    批量渲染
+
+    Args:
+        input_path: 输入文件（JSONL 或 CSV）
+        output_dir: 输出目录
+        jobs: 工作进程数（1 表示在当前进程内渲染）
+        checkpoint_path: 断点文件，默认 <output_dir>/.checkpoint.jsonl
+        input_format: 'jsonl' / 'csv'，默认按扩展名判断
+        logo_path / stamp_path: 所有发票共用的 Logo 和图章（JSONL 记录中的 logo_path/stamp_path 优先）
+        backend: 渲染后端
+        limit: 本次最多渲染的发票数（0 表示不限制）
+        deterministic: 可复现输出（重新渲染同一输入得到逐字节相同的文件）
+
+    Returns:
+        {'rendered': 成功数, 'failed': 失败数, 'skipped': 之前已完成的数量, 'remaining': 中断时尚未渲染的数量}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(output_dir, CHECKPOINT_NAME))
+
+    # 先扫描一遍确定待渲染数量（用于 ETA）；已完成的记录直接跳过
+    pending_keys: Set[str] = set()
+    skipped = 0
+    for record in read_records(input_path, input_format):
+        if checkpoint.is_done(record.key, output_dir):
+            skipped += 1
+        else:
+            pending_keys.add(record.key)
+    total = len(pending_keys) if limit <= 0 else min(limit, len(pending_keys))
+    if skipped:
+        print(f"Resuming: {skipped} invoices already rendered, {total} to go", file=sys.stderr)
+
+    progress = Progress(total)
+    stopping = []
+
+    def request_stop(signum, frame):
+        if not stopping:
+            print("Stopping after invoices in progress finish...", file=sys.stderr)
+        stopping.append(signum)
+
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+
+    def records_to_render():
+        submitted = set()
+        for record in read_records(input_path, input_format):
+            if stopping or len(submitted) >= total:
+                return
+            # 内容完全相同的记录只渲染一次
+            if record.key in pending_keys and record.key not in submitted:
+                submitted.add(record.key)
+                yield record
+
+    def handle(result: Dict):
+        # 警告只输出，不写入断点文件
+        for warning in result.pop('warnings', ()):
+            print(f"Line {result['line']}: {warning}", file=sys.stderr)
+        checkpoint.record(result)
+        if 'error' in result:
+            print(f"Line {result['line']}: {result['error']}", file=sys.stderr)
+        progress.update(failed='error' in result)
+
+    render_args = (output_dir, base_dir, logo_path, stamp_path, backend, deterministic)
+    try:
+        if jobs <= 1:
+            for record in records_to_render():
+                handle(render_record(record, *render_args))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+                in_flight = set()
+                for record in records_to_render():
+                    in_flight.add(executor.submit(render_record, record, *render_args))
+                    # 限制排队数量，输入文件再大内存占用也不会增长
+                    if len(in_flight) >= jobs * 2:
+                        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            handle(future.result())
+                for future in in_flight:
+                    handle(future.result())
+    finally:
+        checkpoint.close()
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+
+    if progress.done and progress.done < total:
+        progress.report()
+    return {
+        'rendered': progress.done - progress.failed,
+        'failed': progress.failed,
+        'skipped': skipped,
+        'remaining': total - progress.done
+    }
+
+
+def main(argv=None) -> int:
+    """命令行入口"""
+    parser = argparse.ArgumentParser(prog='python -m invoice_generator',
+                                     description='Render invoices in bulk from a JSONL or CSV file')
+    parser.add_argument('input', help='JSONL (one invoice per line) or CSV (one item per row) file')
+    parser.add_argument('--output', '-o', default='generated_invoices', help='output directory')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--checkpoint', help=f'checkpoint file (default: <output>/{CHECKPOINT_NAME})')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help='input format (default: by extension)')
+    parser.add_argument('--logo', help='logo image used for every invoice')
+    parser.add_argument('--stamp', help='stamp image used for every invoice')
+    parser.add_argument('--backend', choices=('platypus', 'canvas'), default='platypus')
+    parser.add_argument('--limit', type=int, default=0, help='render at most this many invoices in this run')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='byte-reproducible output: identical input gives an identical PDF')
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    summary = run_bulk(
+        args.input, args.output, jobs=args.jobs, checkpoint_path=args.checkpoint, input_format=args.format,
+        logo_path=os.path.abspath(args.logo) if args.logo else None,
+        stamp_path=os.path.abspath(args.stamp) if args.stamp else None,
+        backend=args.backend, limit=args.limit, deterministic=args.deterministic
+    )
+    elapsed = time.monotonic() - started
+    print(f"Rendered {summary['rendered']}, failed {summary['failed']}, skipped {summary['skipped']} already done "
+          f"in {_format_seconds(elapsed)} ({summary['rendered'] / elapsed if elapsed else 0:.1f} invoices/s)",
+          file=sys.stderr)
+    if summary['remaining']:
+        print(f"{summary['remaining']} invoices not rendered; run the same command again to resume", file=sys.stderr)
+    return 1 if summary['failed'] or summary['remaining'] else 0
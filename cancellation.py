@@ -0,0 +1,145 @@
+"""
+协作式取消 - 客户端断开或超过渲染期限后尽快停止渲染，释放CPU
+
+- 渲染路径在检查点调用 check_cancelled()：platypus 每个 flowable（包括跨页拆分出的每一段）之前、
+  构建项目表格时每 CANCEL_CHECK_ROWS 行、canvas 后端每次换页、按页段并行时等待页段期间，以及提交文件之前
+- 取消时抛出 RenderCancelled，走渲染失败的清理路径：临时文件删除、存储不提交、借出的分块不归还缓存、
+  上传的图片删除
+- 当前渲染的取消令牌保存在 ContextVar 中（与 tracing 相同），调用方用 cancel_scope 设置；
+  没有令牌时检查点只做一次 ContextVar 查找
+- 期限是绝对时间（time.time()），可以直接传给渲染子进程；断开检测可能需要系统调用或进程间通信，
+  按 DISCONNECT_CHECK_INTERVAL 节流
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+import select
+import socket
+import time
+
+# 断开检测的最小间隔（秒）
+DISCONNECT_CHECK_INTERVAL = 0.1
+# 构建项目表格时每隔多少行检查一次
+CANCEL_CHECK_ROWS = 200
+
+# 取消原因
+DEADLINE = 'deadline'
+DISCONNECTED = 'disconnected'
+
+# 当前渲染的取消令牌
+_current_token = ContextVar('render_cancel_token', default=None)
+
+
+class RenderCancelled(Exception):
+    """渲染被取消（超过渲染期限或客户端已断开）"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+    def __str__(self):
+        if self.reason == DEADLINE:
+            return 'Render deadline exceeded'
+        return 'Client disconnected, render cancelled'
+
+
+class CancelToken:
+    """一次渲染的取消条件"""
+
+    def __init__(self, deadline: Optional[float] = None, disconnected: Optional[Callable[[], bool]] = None):
+        """
+        Args:
+            deadline: 渲染期限（time.time() 的绝对时间），为 None 时不限制
+            disconnected: 返回客户端是否已断开，为 None 时不检测
+        """
+        self.deadline = deadline
+        self.disconnected = disconnected
+        self.reason = None
+        self._next_poll = 0.0
+
+    def cancel(self, reason: str):
+        """主动取消（之后的检查点抛出 RenderCancelled）"""
+        if self.reason is None:
+            self.reason = reason
+
+    def cancelled(self) -> Optional[str]:
+        """
+        检查取消条件
+
+        Returns:
+            取消原因，未取消时返回 None
+        """
+        if self.reason is None:
+            now = time.time()
+            if self.deadline is not None and now >= self.deadline:
+                self.reason = DEADLINE
+            elif self.disconnected is not None and now >= self._next_poll:
+                self._next_poll = now + DISCONNECT_CHECK_INTERVAL
+                if self.disconnected():
+                    self.reason = DISCONNECTED
+        return self.reason
+
+    def check(self):
+        """
+        检查点
+
+        Raises:
+            RenderCancelled: 已取消
+        """
+        reason = self.cancelled()
+        if reason is not None:
+            raise RenderCancelled(reason)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]):
+    """
+    在上下文中设置当前渲染的取消令牌（为 None 时不设置）
+
+    Args:
+        token: 取消令牌
+    """
+    if token is None:
+        yield
+        return
+    reset = _current_token.set(token)
+    try:
+        yield
+    finally:
+        _current_token.reset(reset)
+
+
+def current_token() -> Optional[CancelToken]:
+    """当前渲染的取消令牌"""
+    return _current_token.get()
+
+
+def check_cancelled():
+    """
+    渲染路径上的检查点
+
+    Raises:
+        RenderCancelled: 当前渲染已取消
+    """
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+def socket_disconnected(sock: socket.socket) -> bool:
+    """
+    客户端是否已关闭连接（不读取数据：可读且 peek 到 EOF 才算断开，客户端发来的后续请求保持不动）
+
+    Args:
+        sock: 客户端连接
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ConnectionError:
+        return True
+    except (OSError, ValueError):
+        # 非阻塞套接字暂时没有数据，或套接字已被服务器关闭
+        return False
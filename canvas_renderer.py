@@ -0,0 +1,803 @@
+"""
+直接画布渲染后端 - 按预先计算的坐标把发票直接画到 reportlab.pdfgen.canvas 上
+
+发票版式是固定的（页眉、发货方/收货方两栏、运输详情、项目表格、合计、页脚图章），
+不需要 platypus 的 flowable wrap/split 协商、嵌套 Table 和 TableStyle 解析。
+这里的坐标、字号、行距和内边距与 InvoiceGenerator 的版式保持一致，输出在视觉上等价；
+项目表格超出页面时在行边界处换页，续页重复表头（与 platypus 拆分 repeatRows=1 的表格相同）；
+页脚页码和续页页眉与 InvoiceGenerator 一样由 page_template 绘制。
+
+备注、支付信息和产品描述在 platypus 中按 Paragraph 标记解析，这里支持其中常用的子集
+（<b>/<strong>、<i>/<em>、<br/> 和字符实体，见 parse_markup）；含有其他标记时
+create_invoice 改用 platypus 渲染（见 markup_supported）。
+"""
+from typing import Dict, List, Optional, Tuple
+import functools
+import os
+import re
+import threading
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader
+from reportlab.lib.rl_accel import fp_str
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from cancellation import CANCEL_CHECK_ROWS, check_cancelled
+from invoice_generator import InvoiceGenerator, ITEM_COL_WIDTHS
+from page_template import BOTTOM_MARGIN, LEFT_MARGIN, TOP_MARGIN, CopiesCanvas, PageCountCanvas, draw_page_frame
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+
+# platypus Frame 默认内边距为 6pt，这里使用相同的可用区域
+FRAME_PADDING = 6
+FRAME_X = LEFT_MARGIN + FRAME_PADDING
+FRAME_WIDTH = PAGE_WIDTH - 2 * LEFT_MARGIN - 2 * FRAME_PADDING
+FRAME_TOP = PAGE_HEIGHT - TOP_MARGIN - FRAME_PADDING
+FRAME_BOTTOM = BOTTOM_MARGIN + FRAME_PADDING
+
+# 宽度超过可用宽度的表格（项目表格 19cm）与 platypus 一样居中放置
+ITEMS_TABLE_X = FRAME_X + (FRAME_WIDTH - sum(ITEM_COL_WIDTHS)) / 2
+# 项目表格各列文字的 x 坐标（左内边距 4pt），预先格式化以免每个单元格重复格式化
+ITEM_TEXT_X = [fp_str(ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS[:i]) + 4) for i in range(len(ITEM_COL_WIDTHS))]
+# 16cm 宽的两栏布局表格
+TWO_COLUMN_X = FRAME_X + (FRAME_WIDTH - 16*cm) / 2
+
+REGULAR = 'Helvetica'
+BOLD = 'Helvetica-Bold'
+ITALIC = 'Helvetica-Oblique'
+BOLD_ITALIC = 'Helvetica-BoldOblique'
+GRID_COLOR = colors.grey
+FOOTER_COLOR = colors.HexColor('#666666')
+DESCRIPTION_COLOR = colors.HexColor('#333333')
+TOTAL_COLOR = colors.HexColor('#d32f2f')
+
+# 一行文字由若干 (文本, 字体) 片段组成
+Line = List[Tuple[str, str]]
+
+# (粗体, 斜体) -> 字体（与 Paragraph 对 Helvetica 的 <b>/<i> 映射相同）
+MARKUP_FONTS = {(False, False): REGULAR, (True, False): BOLD, (False, True): ITALIC, (True, True): BOLD_ITALIC}
+MARKUP_TAGS = {'b': 'bold', 'strong': 'bold', 'i': 'italic', 'em': 'italic'}
+MARKUP_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+_MARKUP_TOKEN = re.compile(r'<\s*(/?)\s*([a-zA-Z]+)\s*(/?)\s*>|&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z]+);|[<&]')
+
+
+def parse_markup(text: str, font: str = REGULAR) -> Optional[List[Line]]:
+    """
+    解析 Paragraph 标记的常用子集：<b>/<strong>、<i>/<em>、<br/> 和字符实体
+
+    Args:
+        text: Paragraph 标记文本
+        font: 标记外文字的字体（REGULAR 或 BOLD）
+
+    Returns:
+        以 <br/> 分隔的各段，每段为 [(文本, 字体), ...]；含有其他标记、属性、不配对的标签、
+        不换行空格等与 Paragraph 行为不同的内容时返回 None
+    """
+    parts = [[]]
+    state = {'bold': font == BOLD, 'italic': False}
+    stack = []
+    position = 0
+
+    def add(chunk):
+        if chunk:
+            run_font = MARKUP_FONTS[(state['bold'], state['italic'])]
+            part = parts[-1]
+            if part and part[-1][1] == run_font:
+                part[-1] = (part[-1][0] + chunk, run_font)
+            else:
+                part.append((chunk, run_font))
+
+    for match in _MARKUP_TOKEN.finditer(text):
+        add(text[position:match.start()])
+        position = match.end()
+        closing, tag, self_closing, entity = match.groups()
+        if tag is not None:
+            tag = tag.lower()
+            if tag == 'br' and not closing:
+                parts.append([])
+            elif tag in MARKUP_TAGS and not self_closing:
+                if closing:
+                    if not stack or stack[-1][0] != tag:
+                        return None
+                    _, attr, previous = stack.pop()
+                    state[attr] = previous
+                else:
+                    attr = MARKUP_TAGS[tag]
+                    stack.append((tag, attr, state[attr]))
+                    state[attr] = True
+            else:
+                return None
+        elif entity is not None:
+            if entity.startswith('#'):
+                code = int(entity[2:], 16) if entity[1] in 'xX' else int(entity[1:])
+                try:
+                    char = chr(code)
+                except (ValueError, OverflowError):
+                    return None
+                # 不换行空格等特殊空白在 Paragraph 中不参与换行，这里无法等价处理
+                if char.isspace() and char not in ' \t\r\n':
+                    return None
+            else:
+                char = MARKUP_ENTITIES.get(entity)
+                if char is None:
+                    return None
+            add(char)
+        else:
+            # 不成对的 < 或 &
+            return None
+    add(text[position:])
+    if stack or any(char.isspace() and char not in ' \t\r\n' for char in text):
+        return None
+    return parts
+
+
+def _footer_markup(notes: Optional[str], payment_info: Optional[Dict[str, str]]) -> Optional[str]:
+    """页脚左栏的 Paragraph 标记（与 InvoiceGenerator.add_footer 相同）"""
+    content = []
+    if notes:
+        content.append(f"<b>Notes:</b> {notes}")
+    if payment_info:
+        content.append("<b>Payment Information:</b>")
+        content.append(f"Bank: {payment_info.get('bank', '')}")
+        content.append(f"Account: {payment_info.get('account', '')}")
+        if payment_info.get('swift'):
+            content.append(f"SWIFT: {payment_info.get('swift', '')}")
+    return '<br/>'.join(content) if content else None
+
+
+def markup_supported(notes: Optional[str] = None, payment_info: Optional[Dict[str, str]] = None,
+                     product_description: Optional[str] = None) -> bool:
+    """按 Paragraph 标记渲染的字段是否都在 parse_markup 支持的范围内"""
+    footer = _footer_markup(notes, payment_info)
+    if footer is not None and parse_markup(footer) is None:
+        return False
+    return not product_description or parse_markup(f"Product Description: {product_description}") is not None
+
+
+# Paragraph 允许每个空格压缩 5% 以便多放一个单词（reportlab 的 spaceShrinkage 默认值）
+SPACE_SHRINKAGE = 0.05
+# 内置字体可打印 ASCII 字符的最大字宽（Helvetica 的 '@'，千分之一字号），用于跳过明显放得下的短文本的测量
+MAX_ASCII_WIDTH = 1015
+
+
+def _split_long_word(word: str, font: str, size: float, width: float, first_width: Optional[float] = None) -> List[str]:
+    """
+    把超过可用宽度的单词按字符拆开（与 Paragraph 的 splitLongWords 行为一致）
+
+    Args:
+        word: 单词
+        font: 字体
+        size: 字号
+        width: 每行可用宽度
+        first_width: 第一段可用宽度（当前行剩余宽度），默认等于 width
+    """
+    pieces = []
+    current = ''
+    limit = width if first_width is None else first_width
+    for char in word:
+        if current and stringWidth(current + char, font, size) > limit:
+            pieces.append(current)
+            current = char
+            limit = width
+        else:
+            current += char
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _split_long_runs(word: Line, size: float, width: float, first_width: float) -> List[Line]:
+    """按字符拆开由多个字体片段组成的长单词（见 _split_long_word）"""
+    pieces = []
+    current = []
+    current_width = 0
+    limit = first_width
+    for text, font in word:
+        for char in text:
+            char_width = stringWidth(char, font, size)
+            if current and current_width + char_width > limit:
+                pieces.append(current)
+                current, current_width, limit = [], 0, width
+            if current and current[-1][1] == font:
+                current[-1] = (current[-1][0] + char, font)
+            else:
+                current.append((char, font))
+            current_width += char_width
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _words(runs: Line) -> List[Line]:
+    """
+    把片段拆成单词，每个单词为 [(文本, 字体), ...]
+
+    标签两侧没有空白时（如 <b>A</b>B），前后片段属于同一个单词，与 Paragraph 一样不在这里断行
+    """
+    words = []
+    joined = False
+    for text, font in runs:
+        pieces = text.split()
+        if pieces and joined and not text[0].isspace():
+            words[-1].append((pieces[0], font))
+            pieces = pieces[1:]
+        words.extend([(piece, font)] for piece in pieces)
+        if text:
+            joined = bool(words) and not text[-1].isspace()
+    return words
+
+
+def wrap_runs(runs: Line, size: float, width: float) -> List[Line]:
+    """
+    按单词贪心换行，支持同一行内混合字体
+
+    Args:
+        runs: [(文本, 字体), ...]
+        size: 字号
+        width: 可用宽度
+
+    Returns:
+        换行后的行列表，每行为 [(文本, 字体), ...]
+    """
+    if len(runs) == 1:
+        # 单一字体的文本通常一行放得下：整体量一次宽度，放不下时才逐词测量
+        text = ' '.join(runs[0][0].split())
+        if stringWidth(text, runs[0][1], size) <= width:
+            return [[(text, runs[0][1])]] if text else []
+    lines = []
+    line = []
+    line_width = 0
+    word_count = 0
+    space = stringWidth(' ', REGULAR, size)
+
+    def append(word, word_width):
+        nonlocal line_width, word_count
+        separator = ' ' if line else ''
+        for text, font in word:
+            if line and line[-1][1] == font:
+                line[-1] = (line[-1][0] + separator + text, font)
+            else:
+                line.append((separator + text, font))
+            separator = ''
+        line_width += (space if word_count else 0) + word_width
+        word_count += 1
+
+    def measure(word):
+        return sum(stringWidth(text, font, size) for text, font in word)
+
+    for word in _words(runs):
+        word_width = measure(word)
+        gap = space if word_count else 0
+        if word_width > width:
+            # 长单词先填满当前行剩余部分，再逐行拆分
+            if len(word) == 1:
+                text, font = word[0]
+                pieces = [[(piece, font)] for piece in
+                          _split_long_word(text, font, size, width, width - line_width - gap)]
+            else:
+                pieces = _split_long_runs(word, size, width, width - line_width - gap)
+            for piece in pieces[:-1]:
+                append(piece, measure(piece))
+                lines.append(line)
+                line, line_width, word_count = [], 0, 0
+            word = pieces[-1]
+            word_width = measure(word)
+            gap = space if word_count else 0
+        limit = width + SPACE_SHRINKAGE * space * word_count
+        if word_count and line_width + gap + word_width > limit:
+            lines.append(line)
+            line, line_width, word_count = [], 0, 0
+        append(word, word_width)
+    if line:
+        lines.append(line)
+    return lines
+
+
+def wrap_chars(text: str, font: str, size: float, width: float) -> List[str]:
+    """按字符换行（对应 wordWrap='CJK' 的单行样式列）"""
+    if not text:
+        return []
+    if (len(text) * size * MAX_ASCII_WIDTH <= width * 1000 and text.isascii()) or stringWidth(text, font, size) <= width:
+        return [text]
+    return _split_long_word(text, font, size, width)
+
+
+@functools.lru_cache(maxsize=32)
+def _items_header(currency: str) -> Tuple[List[List[Line]], float, float]:
+    """项目表格表头的 (单元格, 行高, 上内边距)，只随币种变化，按币种缓存（调用方不得修改）"""
+    texts = ['No.', 'Product Name', 'Product Number', 'Item Number', 'HS Code', 'Quantity',
+             f'Unit Price ({currency})', f'Amount ({currency})']
+    cells = [wrap_runs([(text, BOLD)], 8, width - 8) for text, width in zip(texts, ITEM_COL_WIDTHS)]
+    return cells, max(len(cell) for cell in cells) * 10 + 12, 6
+
+
+class CanvasInvoiceRenderer:
+    """直接画布发票渲染器"""
+
+    def __init__(self, output_path: str, currency: str = 'CNY', document_info: Optional[Dict[str, str]] = None,
+                 copies: Optional[List[str]] = None):
+        """
+        初始化渲染器
+
+        Args:
+            output_path: 输出PDF文件路径
+            currency: 货币类型
+            document_info: PDF文档信息（见 reproducible.document_info），提供时输出可复现
+            copies: 副本标签，提供时排版一次、按副本重复输出全部页面（见 page_template.CopiesCanvas）
+        """
+        self.output_path = output_path
+        self.currency = currency.upper()
+        # 与 InvoiceGenerator.generate 相同：先写临时文件再原子重命名
+        self.tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.reproducible = bool(document_info)
+        invariant = 1 if self.reproducible else None
+        if copies:
+            self.canvas = CopiesCanvas(self.tmp_path, pagesize=A4, invariant=invariant, copies=copies)
+        else:
+            self.canvas = PageCountCanvas(self.tmp_path, pagesize=A4, invariant=invariant)
+        if document_info:
+            self.canvas.setTitle(document_info['title'])
+            self.canvas.setAuthor(document_info['author'])
+            self.canvas.setSubject(document_info['subject'])
+            self.canvas.setKeywords(document_info['keywords'])
+            self.canvas.setCreator(document_info['creator'])
+        self.y = FRAME_TOP
+        self._at_top = True
+        self._text = None
+        self._font = None
+        self._fill = None
+        self.invoice_number = ''  # 续页页眉显示的发票号和收货方
+        self.consignee_name = ''
+
+    # ---- 基础绘制 ----
+
+    def _image(self, path: str):
+        """drawImage 的图片参数：可复现模式下按内容命名（文件路径命名会随上传文件名变化）"""
+        return ImageReader(os.path.abspath(path)) if self.reproducible else os.path.abspath(path)
+
+    def _text_object(self):
+        """当前页共用的文本对象：逐个 drawString 会为每个字符串新建文本对象并重复设置字体"""
+        if self._text is None:
+            self._text = self.canvas.beginText()
+            self._font = None
+            self._fill = None
+        return self._text
+
+    def _flush_text(self):
+        if self._text is not None:
+            self.canvas.drawText(self._text)
+            self._text = None
+
+    def _set_fill(self, color):
+        text = self._text_object()
+        if color is not self._fill:
+            text.setFillColor(color)
+            self._fill = color
+
+    def _draw_page_frame(self):
+        # 页脚页码（总页数在保存时补上）和续页页眉
+        draw_page_frame(self.canvas, self.canvas.getPageNumber(), self.invoice_number, self.consignee_name)
+
+    def _new_page(self):
+        # 每次换页检查渲染是否已取消（见 cancellation.py）
+        check_cancelled()
+        self._flush_text()
+        self.canvas.showPage()
+        self._draw_page_frame()
+        self.y = FRAME_TOP
+        self._at_top = True
+
+    def _ensure(self, height: float):
+        """剩余空间不足时换页"""
+        if not self._at_top and self.y - height < FRAME_BOTTOM:
+            self._new_page()
+
+    def _advance(self, height: float):
+        self.y -= height
+        if height:
+            self._at_top = False
+
+    def _space(self, height: float):
+        """段前间距：页面顶部时忽略（与 Frame 相同）"""
+        if not self._at_top:
+            self.y -= height
+
+    def _lines_fitting(self, leading: float, padding: float = 0) -> int:
+        """当前位置到页面底部还能放下的行数（至少1行）"""
+        return max(1, int((self.y - FRAME_BOTTOM - padding) / leading + 1e-6))
+
+    def _draw_split(self, columns: List[Tuple[List[Line], float]], size: float, leading: float, color,
+                    padding: float = 0, align: str = 'LEFT', width: float = 0):
+        """
+        绘制并排的若干栏文字：放得下一整页时与 platypus 一样整体移到下一页，
+        比一整页还高时在行边界拆分到后续页面（各栏同步换页）
+
+        Args:
+            columns: [(行列表, 左边 x), ...]
+            size: 字号
+            leading: 行距
+            color: 文字颜色
+            padding: 上下内边距之和（上下各一半），每一段都保留
+            align: 对齐方式
+            width: 居中/右对齐时的栏宽
+        """
+        count = max(len(lines) for lines, _ in columns)
+        self._ensure(min(count * leading + padding, FRAME_TOP - FRAME_BOTTOM))
+        start = 0
+        while True:
+            end = start + self._lines_fitting(leading, padding)
+            self._set_fill(color)
+            for lines, x in columns:
+                self._draw_lines(lines[start:end], x, self.y - padding / 2, size, leading, align, width)
+            self._advance((min(end, count) - start) * leading + padding)
+            start = end
+            if start >= count:
+                return
+            self._new_page()
+
+    def _draw_line(self, line: Line, x: float, y: float, size: float, align: str = 'LEFT', width: float = 0):
+        text_object = self._text_object()
+        if align != 'LEFT':
+            line_width = sum(stringWidth(text, font, size) for text, font in line)
+            x = x + (width - line_width) / 2 if align == 'CENTER' else x + width - line_width
+        if line:
+            text_object.setTextOrigin(x, y)
+        for text, font in line:
+            if self._font != (font, size):
+                text_object.setFont(font, size)
+                self._font = (font, size)
+            # 与 textOut 输出相同；Tj 本身会移动文本位置，不需要 textOut 为记录光标再量一次宽度
+            text_object._code.append(text_object._formatText(text))
+
+    def _draw_lines(self, lines: List[Line], x: float, top: float, size: float, leading: float,
+                    align: str = 'LEFT', width: float = 0):
+        """从 top 开始逐行绘制（首行基线在 top - 字号处，与 Paragraph 一致）"""
+        y = top - size
+        for line in lines:
+            self._draw_line(line, x, y, size, align, width)
+            y -= leading
+
+    @staticmethod
+    def _break_lines(parts: List[Line], size: float, width: float) -> List[Line]:
+        """对以 <br/> 分隔的多段文本逐段换行，空段保留为空行"""
+        lines = []
+        for runs in parts:
+            wrapped = wrap_runs(runs, size, width)
+            lines.extend(wrapped or [[]])
+        return lines
+
+    # ---- 各部分 ----
+
+    def _draw_header(self, company_info: Dict[str, str], invoice_info: Dict[str, str], logo_path: Optional[str]):
+        c = self.canvas
+        if logo_path and os.path.exists(os.path.abspath(logo_path)):
+            try:
+                logo_size = 3*cm
+                c.drawImage(self._image(logo_path), (PAGE_WIDTH - logo_size) / 2, self.y - logo_size,
+                            logo_size, logo_size, mask='auto')
+                self._advance(logo_size + 0.2*cm)
+            except Exception as e:
+                print(f"Warning: Could not load logo image: {e}")
+
+        # 公司信息居中显示
+        for text in (company_info.get('name', '') or '', company_info.get('address', '') or ''):
+            lines = wrap_runs([(text, REGULAR)], 11, FRAME_WIDTH)
+            if lines:
+                self._draw_split([(lines, FRAME_X)], 11, 13, colors.black, align='CENTER', width=FRAME_WIDTH)
+        self._advance(0.3*cm)
+
+        # COMMERCIAL INVOICE 标题（Heading1：字号18，行距22，段后15）
+        self._ensure(22)
+        self._set_fill(colors.black)
+        self._draw_lines([[('COMMERCIAL INVOICE', BOLD)]], FRAME_X, self.y, 18, 22, 'CENTER', FRAME_WIDTH)
+        self._advance(22 + 15 + 0.3*cm)
+
+        # 发票信息：左右两列，外层表格默认上下内边距 3、左右内边距 6
+        column_width = 8*cm
+        left = self._break_lines([
+            [(f"Invoice No.: {invoice_info.get('number', '') or ''}", REGULAR)],
+            [(f"Date: {invoice_info.get('date', '') or ''}", REGULAR)],
+        ], 9, column_width)
+        right = self._break_lines([
+            [(f"Purchase Order No.: {invoice_info.get('po_number', '') or ''}", REGULAR)],
+        ], 9, column_width)
+        self._draw_split([(left, TWO_COLUMN_X + 6), (right, TWO_COLUMN_X + column_width + 6)], 9, 11,
+                         colors.black, padding=6)
+        self._advance(0.4*cm)
+
+    def _draw_two_columns(self, left_parts: List[Line], right_parts: List[Line]):
+        """两栏段落布局（无边框、无内边距，每栏 8cm）"""
+        column_width = 8*cm
+        left = self._break_lines(left_parts, 9, column_width)
+        right = self._break_lines(right_parts, 9, column_width)
+        # 比一整页还高的收发货方/运输信息在行边界拆分，不会画出页面底部
+        self._draw_split([(left, TWO_COLUMN_X), (right, TWO_COLUMN_X + column_width)], 9, 11, colors.black)
+        self._advance(0.3*cm)
+
+    def _draw_parties(self, shipper_info: Dict[str, str], customer_info: Dict[str, str]):
+        shipper_parts = [[('Shipper', BOLD)]]
+        for label, key in (('Shipper Name', 'name'), ('Shipper Address', 'address'), ('Shipper Contact', 'phone')):
+            value = shipper_info.get(key, '') or ''
+            if value:
+                shipper_parts.append([(f"{label}: {value}", REGULAR)])
+
+        customer_parts = [[('Consignee/Buyer', BOLD)]]
+        customer_name = customer_info.get('name', '') or ''
+        if customer_name:
+            customer_parts.append([(f"Company Name: {customer_name}", REGULAR)])
+        plant_address = customer_info.get('plant_address', '')
+        for label, value in (
+            ('Plant Address', plant_address),
+            ('Pin', customer_info.get('pin', '')),
+            ('Address', '' if plant_address else customer_info.get('address', '')),
+            ('Contact', customer_info.get('phone', '')),
+            ('Other Information', customer_info.get('email', '')),
+            ('Other', customer_info.get('other', '')),
+        ):
+            if value:
+                customer_parts.append([(f"{label}: {value}", REGULAR)])
+
+        self._draw_two_columns(shipper_parts, customer_parts)
+
+    def _draw_shipping(self, shipping_info: Dict[str, str]):
+        left_parts = [[('Shipping Details', BOLD)]]
+        for label, key in (('Port of Shipment', 'port_of_shipment'), ('Country of Origin', 'country_of_origin')):
+            value = shipping_info.get(key, '')
+            if value:
+                left_parts.append([(f"{label}: {value}", REGULAR)])
+        # 右列首行留空以与左列标题对齐
+        right_parts = [[]]
+        for label, key in (('Port of Destination', 'port_of_destination'),
+                           ('Place of Final Destination', 'place_of_destination'),
+                           ('Shipment Term', 'shipment_term')):
+            value = shipping_info.get(key, '')
+            if value:
+                right_parts.append([(f"{label}: {value}", REGULAR)])
+        if len(left_parts) > 1 or len(right_parts) > 1:
+            self._draw_two_columns(left_parts, right_parts)
+
+    def _draw_items_title(self, product_description: Optional[str]):
+        # Heading2：段前12，字号12，行距18，段后8
+        self._space(12)
+        self._ensure(18)
+        self._set_fill(colors.black)
+        self._draw_lines([[('Product Information', BOLD)]], FRAME_X, self.y, 12, 18, 'CENTER', FRAME_WIDTH)
+        self._advance(18 + 8)
+        if product_description:
+            parts = parse_markup(f"Product Description: {product_description}")
+            if parts is None:
+                # 不支持的标记按原文显示（create_invoice 会先改用 platypus，见 markup_supported）
+                parts = [[(f"Product Description: {product_description}", REGULAR)]]
+            self._draw_split([(self._break_lines(parts, 10, FRAME_WIDTH), FRAME_X)], 10, 12, DESCRIPTION_COLOR)
+            self._advance(8 + 0.2*cm)
+
+    @staticmethod
+    def _item_cells(idx: int, values: tuple) -> Tuple[List[List[Line]], float]:
+        """
+        计算一行项目各单元格的换行结果和行高
+
+        Args:
+            idx: 序号
+            values: InvoiceGenerator.item_values 的返回值
+        """
+        product_name, product_number, item_number, hs_code, quantity, unit_price, amount = values
+        widths = [w - 8 for w in ITEM_COL_WIDTHS]
+        cells = [[[(text, REGULAR)] for text in wrap_chars(str(idx), REGULAR, 8, widths[0])],
+                 wrap_runs([(product_name, REGULAR)], 8, widths[1])]
+        for text, width in zip((product_number, item_number, hs_code, f"{quantity:.0f}",
+                                f"{unit_price:.2f}", f"{amount:,.2f}"), widths[2:]):
+            cells.append([[(line, REGULAR)] for line in wrap_chars(text, REGULAR, 8, width)])
+        lines = max(len(cell) for cell in cells)
+        return cells, lines * 10 + 8
+
+    def _draw_row(self, cells: List[List[Line]], top: float):
+        """
+        绘制表格一行的文字（8pt，行距 10pt，左对齐，单元格的每行只有一种字体）
+
+        每个单元格行输出一段 Tm + Tj，各列 x 坐标预先格式化、各行基线每行只格式化一次；
+        输出内容与逐行调用 _draw_line 相同
+        """
+        text_object = self._text_object()
+        code = text_object._code
+        baselines = []
+        for x, cell in zip(ITEM_TEXT_X, cells):
+            for i, ((text, font),) in enumerate(cell):
+                if i == len(baselines):
+                    baselines.append(fp_str(top - 8 - i * 10))
+                code.append('1 0 0 1 %s %s Tm' % (x, baselines[i]))
+                if self._font != (font, 8):
+                    text_object.setFont(font, 8)
+                    self._font = (font, 8)
+                code.append(text_object._formatText(text))
+
+    def _draw_grid_segment(self, top: float, row_heights: List[float]):
+        """绘制一段表格的网格线（1pt 灰色）"""
+        c = self.canvas
+        c.setStrokeColor(GRID_COLOR)
+        c.setLineWidth(1)
+        bottom = top - sum(row_heights)
+        right = ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS)
+        y = top
+        c.line(ITEMS_TABLE_X, y, right, y)
+        for height in row_heights:
+            y -= height
+            c.line(ITEMS_TABLE_X, y, right, y)
+        x = ITEMS_TABLE_X
+        c.line(x, top, x, bottom)
+        for width in ITEM_COL_WIDTHS:
+            x += width
+            c.line(x, top, x, bottom)
+
+    def _draw_items(self, items: List[Dict[str, any]]) -> Tuple[float, float]:
+        """绘制项目表格，返回 (总金额, 总数量)"""
+        header_row = _items_header(self.currency)
+        rows = [header_row]
+        total_amount = 0
+        total_quantity = 0
+        for idx, item in enumerate(items, 1):
+            values = InvoiceGenerator.item_values(item)
+            total_quantity += values[4]
+            total_amount += values[6]
+            cells, height = self._item_cells(idx, values)
+            rows.append((cells, height, 4))
+            if idx % CANCEL_CHECK_ROWS == 0:
+                check_cancelled()
+
+        total_cells = [[] for _ in ITEM_COL_WIDTHS]
+        total_cells[1] = [[('TOTAL', BOLD)]]
+        if total_quantity > 0:
+            total_cells[5] = [[(f"{total_quantity:.0f}", BOLD)]]
+        total_cells[7] = [[(f"{total_amount:,.2f}", BOLD)]]
+        rows.append((total_cells, 18, 4))
+
+        # 逐行放置，放不下时在行边界换页
+        self._set_fill(colors.black)
+        segment_heights = []
+
+        def place(cells, height, top_padding):
+            self._draw_row(cells, self.y - top_padding)
+            self._advance(height)
+            segment_heights.append(height)
+
+        # 表头至少和第一行数据放在同一页（platypus 拆分 repeatRows=1 的表格时不会只留下表头）
+        self._ensure(header_row[1] + rows[1][1])
+        segment_top = self.y
+        for row in rows:
+            if segment_heights and self.y - row[1] < FRAME_BOTTOM:
+                self._draw_grid_segment(segment_top, segment_heights)
+                self._new_page()
+                self._set_fill(colors.black)
+                segment_top = self.y
+                segment_heights = []
+                # 续页重复表头
+                place(*header_row)
+            place(*row)
+        self._draw_grid_segment(segment_top, segment_heights)
+        self._advance(0.3*cm)
+        return total_amount, total_quantity
+
+    def _draw_total(self, subtotal: float, tax_rate: float, discount: float):
+        """税费/折扣汇总（与 add_total 相同：两者都为0时不显示）"""
+        if tax_rate == 0 and discount == 0:
+            return
+        c = self.canvas
+        tax_amount = subtotal * (tax_rate / 100) if tax_rate > 0 else 0
+        total = subtotal - discount + tax_amount
+        rows = [
+            (f'Subtotal ({self.currency}):', f"{subtotal:,.2f}", REGULAR, 10, colors.black),
+            (f'Discount ({self.currency}):', f"-{discount:,.2f}", REGULAR, 10, colors.black),
+            (f'Tax ({self.currency}):', f"{tax_amount:,.2f}", REGULAR, 10, colors.black),
+            (f'Total Amount ({self.currency}):', f"{total:,.2f}", BOLD, 11, TOTAL_COLOR),
+        ]
+        row_height = 18  # 默认行距12 + 上下内边距各3
+        label_right = ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS[:7]) - 6
+        value_right = ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS) - 6
+        line_left = ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS[:6])
+        line_right = ITEMS_TABLE_X + sum(ITEM_COL_WIDTHS)
+
+        # 与 platypus 拆分表格一样逐行放置，放不下的行移到下一页
+        for row_idx, (label, value, font, size, color) in enumerate(rows):
+            self._ensure(row_height)
+            if row_idx == 0:
+                c.setStrokeColor(GRID_COLOR)
+                c.setLineWidth(1)
+                c.line(line_left, self.y, line_right, self.y)
+            # 默认 VALIGN 为 BOTTOM：基线 = 行底 + 下内边距 + 行距 - 字号
+            baseline = self.y - row_height + 3 + 12 - size
+            self._set_fill(color)
+            self._draw_line([(label, font)], label_right, baseline, size, 'RIGHT')
+            self._draw_line([(value, font)], value_right, baseline, size, 'RIGHT')
+            self._advance(row_height)
+        c.setStrokeColor(TOTAL_COLOR)
+        c.setLineWidth(2)
+        c.line(line_left, self.y, line_right, self.y)
+        self._advance(0.3*cm)
+
+    def _draw_footer(self, notes: Optional[str], payment_info: Optional[Dict[str, str]], stamp_path: Optional[str]):
+        c = self.canvas
+        markup = _footer_markup(notes, payment_info)
+        parts = []
+        if markup is not None:
+            parts = parse_markup(markup)
+            if parts is None:
+                # 不支持的标记按原文显示（create_invoice 会先改用 platypus，见 markup_supported）
+                parts = [[(text, REGULAR)] for text in markup.split('<br/>')]
+
+        stamp = None
+        if stamp_path and os.path.exists(stamp_path):
+            stamp = os.path.abspath(stamp_path)
+        if not parts and not stamp:
+            return
+
+        # 有图章时左 12cm 右 4cm，否则只有 16cm 的左栏；表格默认内边距
+        left_width = 12*cm if stamp else 16*cm
+        lines = self._break_lines(parts, 9, left_width - 12) if parts else []
+        stamp_size = 2.5*cm
+        stamp_height = stamp_size if stamp else 0
+        height = max(len(lines) * 11, stamp_height) + 6
+        self._space(0.3*cm)
+        # 放得下一整页时整体移到下一页，比一整页还高时在行边界拆分到后续页面（图章在第一段）
+        self._ensure(min(height, FRAME_TOP - FRAME_BOTTOM))
+        while True:
+            fitting = self._lines_fitting(11, 6)
+            chunk, lines = lines[:fitting], lines[fitting:]
+            self._set_fill(FOOTER_COLOR)
+            self._draw_lines(chunk, TWO_COLUMN_X + 6, self.y - 3, 9, 11)
+            if stamp:
+                try:
+                    c.drawImage(self._image(stamp), TWO_COLUMN_X + 16*cm - 6 - stamp_size, self.y - 3 - stamp_size,
+                                stamp_size, stamp_size, mask='auto')
+                except Exception as e:
+                    print(f"Warning: Could not load stamp image: {e}")
+            self._advance(max(len(chunk) * 11, stamp_height) + 6)
+            stamp, stamp_height = None, 0
+            if not lines:
+                break
+            self._new_page()
+
+    def render(
+        self,
+        company_info: Dict[str, str],
+        customer_info: Dict[str, str],
+        invoice_info: Dict[str, str],
+        items: List[Dict[str, any]],
+        shipper_info: Dict[str, str],
+        tax_rate: float = 0.0,
+        discount: float = 0.0,
+        notes: Optional[str] = None,
+        payment_info: Optional[Dict[str, str]] = None,
+        logo_path: Optional[str] = None,
+        stamp_path: Optional[str] = None,
+        shipping_info: Optional[Dict[str, str]] = None,
+        product_description: Optional[str] = None
+    ) -> str:
+        """
+        渲染整张发票并保存
+
+        Returns:
+            生成的PDF文件路径
+        """
+        self.invoice_number = (invoice_info or {}).get('number', '') or ''
+        self.consignee_name = (customer_info or {}).get('name', '') or ''
+        try:
+            self._draw_page_frame()
+            self._draw_header(company_info, invoice_info, logo_path)
+            self._draw_parties(shipper_info, customer_info)
+            if shipping_info:
+                self._draw_shipping(shipping_info)
+            self._draw_items_title(product_description)
+            subtotal, _ = self._draw_items(items)
+            self._draw_total(subtotal, tax_rate, discount)
+            self._draw_footer(notes, payment_info, stamp_path)
+            self._flush_text()
+            check_cancelled()
+            self.canvas.save()
+            os.replace(self.tmp_path, self.output_path)
+        except Exception:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            raise
+        print(f"发票已成功生成: {self.output_path}")
+        return self.output_path
@@ -0,0 +1,479 @@
+"""
+渲染开销预估 - 渲染前根据输入规模预测页数、渲染耗时和输出大小
+
+- 页数：按项目各列的文字长度估算每行的换行行数和行高，按页面可用高度模拟分页
+  （与 InvoiceGenerator 的版式常量一致，不做实际排版）
+- 耗时和输出大小：以行数、换行行数、文字量、页数和图片像素为特征的线性模型，
+  系数由基准渲染标定（python estimator.py calibrate），标定结果保存为 JSON
+- 用途：/estimate 接口；/generate 把预估耗时超过阈值的发票交给渲染队列；
+  按客户端限制单位时间内的预估渲染耗时（RenderBudget，超出时返回 429）
+
+    python estimator.py calibrate --output render_cost.json
+    python estimator.py estimate invoice.json --model render_cost.json
+"""
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+from io import StringIO
+from typing import Dict, Iterable, List, Optional
+import argparse
+import json
+import math
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+
+from invoice_generator import ITEM_COL_WIDTHS
+from invoice_model import InvoiceData, ItemTable
+from page_template import BOTTOM_MARGIN, TOP_MARGIN
+
+# ---- 版式常量（单位 pt，与 InvoiceGenerator / CanvasInvoiceRenderer 一致）----
+
+# 页面可用高度（页边距和 Frame 上下内边距之外）
+FRAME_HEIGHT = A4[1] - TOP_MARGIN - BOTTOM_MARGIN - 12
+# 页眉、发票信息、收发货方和 "Product Information" 标题
+HEAD_HEIGHT = 188
+LOGO_HEIGHT = 3.2*cm
+SHIPPING_HEIGHT = 4 * 11 + 0.3*cm
+# 项目表格表头（续页重复）和总计行
+ITEMS_HEADER_HEIGHT = 32
+SUMMARY_ROW_HEIGHT = 18
+# 税费/折扣汇总（4 行）
+TOTALS_HEIGHT = 4 * 18 + 0.3*cm
+STAMP_HEIGHT = 2.5*cm + 6
+# 8pt Helvetica 的平均字符宽度；项目单元格左右内边距合计 8
+AVG_CHAR_WIDTH = 4.2
+CELL_PADDING = 8
+ROW_LINE_HEIGHT = 10
+# 正文（备注、描述、支付信息）每行字符数和行高
+BODY_CHARS_PER_LINE = 90
+BODY_LINE_HEIGHT = 12
+
+# 数字字符宽度（8pt Helvetica）
+DIGIT_WIDTH = 4.45
+
+# 各文本列（product_name、product_number、item_number、hs_code）每行可容纳的字符数
+_COLUMN_CHARS = tuple(max(1, int((width - CELL_PADDING) / AVG_CHAR_WIDTH)) for width in ITEM_COL_WIDTHS[1:5])
+# 序号列很窄，三位以上的序号会折行
+_INDEX_CHARS = max(1, int((ITEM_COL_WIDTHS[0] - CELL_PADDING) / DIGIT_WIDTH))
+
+# 多份副本时每个重放页面增加的输出大小（一个 form 引用、副本标签和页面对象），重放本身几乎不耗时
+COPY_PAGE_BYTES = 850
+
+# 线性模型的特征
+FEATURES = ('rows', 'extra_lines', 'text_chars', 'pages', 'image_megapixels')
+
+# 内置系数（platypus 后端，在单核开发机上用 calibrate 标定，耗时平均误差约 15%；
+# 部署时建议在目标机器上重新标定，用 RENDER_COST_MODEL 指定结果文件）
+DEFAULT_MODEL = {
+    'backend': 'platypus',
+    'render_ms': {'intercept': 14.4, 'rows': 0.168, 'extra_lines': 0.236, 'text_chars': 0.0,
+                  'pages': 0.0, 'image_megapixels': 53.9},
+    'output_bytes': {'intercept': 2737.0, 'rows': 63.7, 'extra_lines': 10.2, 'text_chars': 0.015,
+                     'pages': 904.0, 'image_megapixels': 24827.0},
+}
+
+
+def _lines(text: str, chars_per_line: int) -> int:
+    return max(1, math.ceil(len(text) / chars_per_line)) if text else 1
+
+
+def _body_height(*texts: Optional[str]) -> float:
+    return sum(_lines(text, BODY_CHARS_PER_LINE) * BODY_LINE_HEIGHT for text in texts if text)
+
+
+def invoice_features(invoice: InvoiceData, image_pixels: Iterable[int] = (),
+                     has_logo: bool = False, has_stamp: bool = False) -> Dict[str, float]:
+    """
+    提取预估所用的输入特征（只看文字长度，不做排版）
+
+    Args:
+        invoice: 发票数据
+        image_pixels: 各图片的像素数（宽 × 高）
+        has_logo: 是否有 Logo（占用页眉高度）
+        has_stamp: 是否有图章（占用页脚高度）
+
+    Returns:
+        {'rows', 'extra_lines', 'text_chars', 'pages', 'image_megapixels'}
+    """
+    items = invoice.items
+    if not isinstance(items, ItemTable):
+        items = ItemTable.from_dicts(items)
+    name_chars, number_chars, item_chars, hs_chars = _COLUMN_CHARS
+
+    # 按页面可用高度模拟分页：行放不下时换页，续页重复表头
+    pages = 1
+    remaining = FRAME_HEIGHT - HEAD_HEIGHT - ITEMS_HEADER_HEIGHT
+    if has_logo:
+        remaining -= LOGO_HEIGHT
+    if invoice.shipping_info:
+        remaining -= SHIPPING_HEIGHT
+    remaining -= _body_height(invoice.product_description)
+    extra_lines = 0
+    for index, (name, number, item_number, hs_code) in enumerate(
+            zip(items.product_names, items.product_numbers, items.item_numbers, items.hs_codes), 1):
+        lines = max(_lines(str(index), _INDEX_CHARS), _lines(name, name_chars), _lines(number, number_chars),
+                    _lines(item_number, item_chars), _lines(hs_code, hs_chars))
+        extra_lines += lines - 1
+        height = lines * ROW_LINE_HEIGHT + 8
+        if height > remaining:
+            pages += 1
+            remaining = FRAME_HEIGHT - ITEMS_HEADER_HEIGHT
+        remaining -= height
+
+    tail = SUMMARY_ROW_HEIGHT + 0.3*cm
+    if invoice.tax_rate or invoice.discount:
+        tail += TOTALS_HEIGHT
+    payment = ' '.join(invoice.payment_info.values()) if invoice.payment_info else ''
+    footer = _body_height(invoice.notes, payment)
+    if footer or has_stamp:
+        tail += max(footer, STAMP_HEIGHT if has_stamp else 0) + 0.3*cm
+    if tail > remaining:
+        pages += 1
+
+    return {
+        'rows': len(items),
+        'extra_lines': extra_lines,
+        'text_chars': items.text_length(),
+        'pages': pages,
+        'image_megapixels': sum(image_pixels) / 1e6,
+    }
+
+
+class CostModel:
+    """渲染耗时和输出大小的线性模型"""
+
+    def __init__(self, coefficients: Optional[Dict] = None):
+        """
+        Args:
+            coefficients: {'backend', 'render_ms': {特征: 系数}, 'output_bytes': {...}}，默认使用 DEFAULT_MODEL
+        """
+        self.coefficients = coefficients or DEFAULT_MODEL
+
+    @classmethod
+    def load(cls, path: str) -> 'CostModel':
+        """读取 calibrate 保存的模型文件"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.coefficients, f, indent=2, ensure_ascii=False)
+
+    @property
+    def backend(self) -> str:
+        return self.coefficients.get('backend', 'platypus')
+
+    def predict(self, features: Dict[str, float]) -> Dict[str, float]:
+        """
+        根据特征预测
+
+        Returns:
+            {'pages', 'render_ms', 'output_bytes'}
+        """
+        result = {'pages': int(features['pages'])}
+        for target in ('render_ms', 'output_bytes'):
+            coefficients = self.coefficients[target]
+            value = coefficients.get('intercept', 0.0)
+            for name in FEATURES:
+                value += coefficients.get(name, 0.0) * features[name]
+            result[target] = max(0, round(value))
+        return result
+
+    def estimate(self, invoice: InvoiceData, image_pixels: Iterable[int] = (),
+                 has_logo: bool = False, has_stamp: bool = False) -> Dict[str, float]:
+        """
+        预估一张发票的渲染开销（多份副本只排版一次，页数按副本数计算）
+
+        Returns:
+            {'pages', 'render_ms', 'output_bytes'}
+        """
+        result = self.predict(invoice_features(invoice, image_pixels, has_logo, has_stamp))
+        copies = len(invoice.copies)
+        if copies:
+            result['output_bytes'] += COPY_PAGE_BYTES * result['pages'] * (copies - 1)
+            result['pages'] *= copies
+        return result
+
+    @classmethod
+    def fit(cls, samples: List[Dict], backend: str = 'platypus') -> 'CostModel':
+        """
+        用基准渲染的结果拟合系数
+
+        按相对误差加权的最小二乘（小发票和大发票同样重要），系数不为负：
+        出现负系数时去掉该特征重新拟合（行数、换行行数和页数高度相关，直接拟合会互相抵消）。
+
+        Args:
+            samples: [{'features': {...}, 'render_ms': 实测耗时, 'output_bytes': 实测大小}, ...]
+            backend: 渲染后端
+
+        Returns:
+            模型
+        """
+        coefficients = {'backend': backend, 'samples': len(samples),
+                        'calibrated_at': datetime.now().isoformat(timespec='seconds')}
+        for target in ('render_ms', 'output_bytes'):
+            targets = [float(sample[target]) for sample in samples]
+            weights = [1.0 / max(value, 1.0) for value in targets]
+            active = list(FEATURES)
+            while True:
+                rows = [[1.0] + [float(sample['features'][name]) for name in active] for sample in samples]
+                solution = _least_squares(rows, targets, weights)
+                fitted = dict(zip(['intercept'] + active, solution))
+                negative = [name for name in active if fitted[name] < 0]
+                if not negative:
+                    break
+                active.remove(min(negative, key=lambda name: fitted[name]))
+            coefficients[target] = {name: fitted.get(name, 0.0) for name in ('intercept',) + FEATURES}
+        return cls(coefficients)
+
+
+def _least_squares(rows: List[List[float]], targets: List[float], weights: List[float]) -> List[float]:
+    """
+    求解 min Σ (w·(Xb - y))²（正规方程 + 高斯消元；特征很少，不需要 numpy）
+
+    样本中不变化的特征（如标定时没有图片）系数为 0。
+    """
+    size = len(rows[0])
+    rows = [[value * weight for value in row] for row, weight in zip(rows, weights)]
+    targets = [target * weight for target, weight in zip(targets, weights)]
+    # 按列缩放，避免各特征量级相差过大导致正规方程病态
+    scales = [max(abs(row[j]) for row in rows) or 1.0 for j in range(size)]
+    scaled = [[row[j] / scales[j] for j in range(size)] for row in rows]
+    matrix = [[sum(row[i] * row[j] for row in scaled) for j in range(size)] for i in range(size)]
+    vector = [sum(row[i] * target for row, target in zip(scaled, targets)) for i in range(size)]
+    for i in range(size):
+        # 轻微的岭正则，保证特征共线时也有解
+        matrix[i][i] += 1e-9
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(matrix[r][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        vector[col], vector[pivot] = vector[pivot], vector[col]
+        for r in range(col + 1, size):
+            factor = matrix[r][col] / matrix[col][col]
+            for c in range(col, size):
+                matrix[r][c] -= factor * matrix[col][c]
+            vector[r] -= factor * vector[col]
+    solution = [0.0] * size
+    for r in range(size - 1, -1, -1):
+        value = vector[r] - sum(matrix[r][c] * solution[c] for c in range(r + 1, size))
+        solution[r] = value / matrix[r][r]
+    return [round(value / scale, 6) for value, scale in zip(solution, scales)]
+
+
+class RenderBudgetExceeded(Exception):
+    """客户端在当前时间窗口内的预估渲染耗时超出预算"""
+
+    def __init__(self, client: str, cost_ms: float, retry_after: float):
+        self.client = client
+        self.cost_ms = cost_ms
+        self.retry_after = retry_after
+        super().__init__(
+            f'Render budget exceeded: this invoice needs about {cost_ms / 1000:.1f}s of render time, '
+            f'retry after {math.ceil(retry_after)}s'
+        )
+
+
+class RenderBudget:
+    """
+    按客户端的渲染耗时预算（令牌桶）
+
+    每个客户端每个时间窗口可使用 budget_ms 毫秒的预估渲染耗时，按时间连续恢复。
+    桶满时总是放行（单张超过整个预算的发票也能渲染，之后需要等待更久）。
+    状态保存在 SQLite 文件中，同一主机上的所有工作进程共享。
+    """
+
+    def __init__(self, path: str, budget_ms: float, window: float = 60.0):
+        """
+        Args:
+            path: 数据库文件路径
+            budget_ms: 每个时间窗口的预算（毫秒）
+            window: 时间窗口（秒）
+        """
+        self.path = path
+        self.budget_ms = budget_ms
+        self.window = window
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS budgets '
+                         '(client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+
+    @contextmanager
+    def _connection(self):
+        # 与 SQLiteRenderQueue 相同：每次操作使用独立连接，事务自己控制
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _tokens(self, conn, client: str, now: float) -> float:
+        row = conn.execute('SELECT tokens, updated_at FROM budgets WHERE client = ?', (client,)).fetchone()
+        if row is None:
+            return self.budget_ms
+        tokens, updated_at = row
+        return min(self.budget_ms, tokens + max(0.0, now - updated_at) * self.budget_ms / self.window)
+
+    def remaining(self, client: str) -> float:
+        """客户端当前剩余的预算（毫秒，可能为负）"""
+        with self._connection() as conn:
+            return self._tokens(conn, client, time.time())
+
+    def charge(self, client: str, cost_ms: float) -> float:
+        """
+        扣除一次渲染的预估耗时
+
+        Args:
+            client: 客户端标识
+            cost_ms: 预估渲染耗时（毫秒）
+
+        Returns:
+            扣除后剩余的预算
+
+        Raises:
+            RenderBudgetExceeded: 预算不足
+        """
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                tokens = self._tokens(conn, client, now)
+                needed = min(cost_ms, self.budget_ms)
+                if tokens < needed:
+                    conn.execute('ROLLBACK')
+                    retry_after = (needed - tokens) * self.window / self.budget_ms
+                    raise RenderBudgetExceeded(client, cost_ms, retry_after)
+                tokens -= cost_ms
+                conn.execute('INSERT OR REPLACE INTO budgets (client, tokens, updated_at) VALUES (?, ?, ?)',
+                             (client, tokens, now))
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+        return tokens
+
+
+# ---- 标定 ----
+
+# 基准发票规模：(行数, 产品名长度, 是否带图片)
+CALIBRATION_GRID = [(rows, name_length, with_images)
+                    for rows in (1, 20, 100, 400, 1500)
+                    for name_length in (12, 70)
+                    for with_images in (False, True)]
+
+
+def _calibration_invoice(rows: int, name_length: int) -> Dict:
+    items = []
+    for i in range(rows):
+        # 每行文字不同，避免段落缓存命中使耗时偏低
+        name = (f'Item {i} ' + 'Stainless Steel Hydraulic Assembly ' * 3)[:name_length]
+        items.append({'product_name': name, 'product_number': f'PN-{i:06d}', 'item_number': f'IT-{i:05d}',
+                      'hs_code': '84139100', 'quantity': i % 7 + 1, 'unit_price': 12.5})
+    return {
+        'company_info': {'name': 'Calibration Trading Co., Ltd.', 'address': '1 Harbour Road'},
+        'shipper_info': {'name': 'Calibration Shipper', 'address': 'Warehouse 3', 'phone': '+86 21 5555 0000'},
+        'customer_info': {'name': 'Benchmark Buyer GmbH', 'address': 'Industriestrasse 5'},
+        'invoice_info': {'number': f'CAL-{rows}-{name_length}', 'date': '2024-01-01'},
+        'shipping_info': {'port_of_shipment': 'Shanghai', 'port_of_destination': 'Hamburg'},
+        'items': items,
+        'tax_rate': 13.0,
+    }
+
+
+def calibrate(backend: str = 'platypus', repeat: int = 3, grid=None, log=print) -> CostModel:
+    """
+    渲染一组基准发票，拟合耗时和输出大小模型
+
+    每次计时前清空段落缓存（按缓存全部未命中估计，预估偏保守）。
+
+    Args:
+        backend: 渲染后端
+        repeat: 每个规模渲染的次数（取中位数）
+        grid: 基准规模列表，默认 CALIBRATION_GRID
+        log: 进度输出函数
+
+    Returns:
+        拟合的模型
+    """
+    from invoice_generator import create_invoice
+    from memory_guard import image_pixel_count
+    from synthetic_images import synthetic_image
+    from text_cache import text_cache
+
+    workdir = tempfile.mkdtemp(prefix='invoice_calibrate_')
+    samples = []
+    try:
+        logo_path = os.path.join(workdir, 'logo.png')
+        stamp_path = os.path.join(workdir, 'stamp.png')
+        with open(logo_path, 'wb') as f:
+            f.write(synthetic_image('logo', (800, 600)))
+        with open(stamp_path, 'wb') as f:
+            f.write(synthetic_image('stamp', (600, 600)))
+        output_path = os.path.join(workdir, 'invoice.pdf')
+        for rows, name_length, with_images in grid or CALIBRATION_GRID:
+            payload = _calibration_invoice(rows, name_length)
+            invoice = InvoiceData.from_json(payload)
+            images = (logo_path, stamp_path) if with_images else (None, None)
+            timings = []
+            for _ in range(repeat):
+                text_cache.clear()
+                start = time.perf_counter()
+                with redirect_stdout(StringIO()):
+                    create_invoice(output_path, invoice=invoice, logo_path=images[0], stamp_path=images[1],
+                                   backend=backend)
+                timings.append((time.perf_counter() - start) * 1000)
+            features = invoice_features(invoice, [image_pixel_count(path) for path in images],
+                                        has_logo=with_images, has_stamp=with_images)
+            samples.append({'features': features, 'render_ms': statistics.median(timings),
+                            'output_bytes': os.path.getsize(output_path)})
+            log(f"rows={rows:<5} name={name_length:<3} images={'yes' if with_images else 'no ':<3} "
+                f"pages={features['pages']:<3} {samples[-1]['render_ms']:8.1f}ms "
+                f"{samples[-1]['output_bytes']:>9} bytes")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    model = CostModel.fit(samples, backend=backend)
+    for target in ('render_ms', 'output_bytes'):
+        errors = [abs(model.predict(sample['features'])[target] - sample[target]) / max(sample[target], 1)
+                  for sample in samples]
+        log(f"{target}: mean error {statistics.mean(errors) * 100:.1f}%, max {max(errors) * 100:.1f}%")
+    return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Invoice render cost estimator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='Fit the cost model from benchmark renders')
+    calibrate_parser.add_argument('--backend', default=os.environ.get('RENDER_BACKEND', 'platypus'),
+                                  choices=('platypus', 'canvas'))
+    calibrate_parser.add_argument('--repeat', type=int, default=3, help='Renders per benchmark size')
+    calibrate_parser.add_argument('--output', default='render_cost.json', help='Model file to write')
+
+    estimate_parser = subparsers.add_parser('estimate', help='Estimate the cost of an invoice JSON file')
+    estimate_parser.add_argument('invoice', help='Invoice JSON (same fields as InvoiceData.from_json)')
+    estimate_parser.add_argument('--model', default=os.environ.get('RENDER_COST_MODEL', ''),
+                                 help='Model file written by calibrate (default: built-in coefficients)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'calibrate':
+        model = calibrate(backend=args.backend, repeat=args.repeat)
+        model.save(args.output)
+        print(f"Cost model written to {args.output}")
+        return 0
+
+    model = CostModel.load(args.model) if args.model else CostModel()
+    with open(args.invoice, 'r', encoding='utf-8') as f:
+        invoice = InvoiceData.from_json(json.load(f))
+    print(json.dumps(model.estimate(invoice), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -15,6 +15,13 @@ worker_connections = 1000
 timeout = 30
 keepalive = 2
 
+# 工作进程回收：处理一定数量的请求后重启，抖动避免所有进程同时重启
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# 工作进程常驻内存（RSS）上限（MB），超过后在当前请求结束后优雅重启（0 表示不限制）
+worker_max_rss_mb = int(os.environ.get('WORKER_MAX_RSS_MB', 512))
+
 # 日志
 accesslog = '-'
 errorlog = '-'
@@ -32,6 +39,21 @@ user = None
 group = None
 tmp_upload_dir = None
 
+
+def post_request(worker, req, environ, resp):
+    """请求结束后检查工作进程 RSS，超过上限时让工作进程优雅退出并由 master 重新拉起"""
+    if worker_max_rss_mb <= 0:
+        return
+    from memory_guard import current_rss
+    rss_mb = current_rss() / 1024 / 1024
+    if rss_mb > worker_max_rss_mb:
+        worker.log.info(
+            "Worker %s RSS %.1fMB exceeds %dMB, recycling after current request",
+            worker.pid, rss_mb, worker_max_rss_mb
+        )
+        worker.alive = False
+
+
 # SSL (如果需要)
 # keyfile = None
 # certfile = None
@@ -0,0 +1,211 @@
+"""
+幂等键与单飞（single-flight）合并 - 避免重复提交触发重复渲染
+
+同一个键的并发请求通过文件锁串行化：第一个请求负责渲染，其余请求等待锁，
+拿到锁后直接读取已保存的结果。文件锁基于 fcntl.flock，因此对 gunicorn 的
+多个工作进程同样有效；在不支持 fcntl 的平台（Windows）上退化为进程内锁。
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class IdempotencyConflict(Exception):
+    """同一个 Idempotency-Key 被用于不同的请求内容"""
+
+
+class IdempotencyStore:
+    """基于文件系统的幂等结果存储"""
+
+    def __init__(self, root: str, ttl: float = 600.0):
+        """
+        初始化幂等存储
+
+        Args:
+            root: 存放锁文件和结果文件的目录
+            ttl: 已保存结果的有效期（秒）
+        """
+        self.root = root
+        self.ttl = ttl
+        self._local_locks = {}
+        self._local_locks_guard = threading.Lock()
+        self._puts = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def make_key(idempotency_key: Optional[str], fingerprint: str, scope: str = '') -> str:
+        """
+        生成存储键
+
+        Args:
+            idempotency_key: 客户端提供的 Idempotency-Key（可选）
+            fingerprint: 请求内容指纹
+            scope: 键的作用域（如客户端标识），不同作用域的相同键互不影响
+
+        Returns:
+            可以安全用作文件名的键
+        """
+        if idempotency_key:
+            raw = f"key:{idempotency_key}"
+        else:
+            raw = f"req:{fingerprint}"
+        return hashlib.sha256(f"{scope}\0{raw}".encode('utf-8')).hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.root, f"{key}{suffix}")
+
+    @contextmanager
+    def lock(self, key: str):
+        """对键加跨进程排他锁"""
+        if fcntl is None:
+            with self._local_locks_guard:
+                local_lock = self._local_locks.setdefault(key, threading.Lock())
+            with local_lock:
+                yield
+            return
+
+        lock_path = self._path(key, '.lock')
+        with open(lock_path, 'a') as lock_file:
+            # 刷新修改时间，让 purge_expired 不会删除正在使用的锁文件
+            os.utime(lock_path, None)
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """读取未过期的结果，不存在或已过期时返回 None"""
+        result_path = self._path(key, '.json')
+        try:
+            with open(result_path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - record.get('created', 0) > self.ttl:
+            self._remove(key)
+            return None
+        return record
+
+    def put(self, key: str, fingerprint: str, response: Dict):
+        """原子地保存结果（先写临时文件再重命名）"""
+        record = {
+            'created': time.time(),
+            'fingerprint': fingerprint,
+            'response': response
+        }
+        result_path = self._path(key, '.json')
+        tmp_path = f"{result_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, result_path)
+
+        # 偶尔清理一次过期结果，避免目录无限增长
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self.purge_expired()
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self._path(key, '.json'))
+        except OSError:
+            pass
+
+    def purge_expired(self):
+        """删除所有过期的结果文件"""
+        now = time.time()
+        for name in os.listdir(self.root):
+            if name.endswith('.json'):
+                max_age = self.ttl
+            elif name.endswith('.lock'):
+                # 锁文件多保留一段时间，避免删掉其他进程刚打开的锁
+                max_age = self.ttl * 2
+            else:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def run(self, key: str, fingerprint: str, func: Callable[[], Dict],
+            valid: Optional[Callable[[Dict], bool]] = None) -> Tuple[Dict, bool]:
+        """
+        单飞执行：同一个键同一时间只执行一次 func，其余调用共享结果
+
+        Args:
+            key: 存储键（由 make_key 生成）
+            fingerprint: 请求内容指纹，用于检测键被复用于不同内容
+            func: 实际执行渲染的函数，返回可 JSON 序列化的响应字典
+            valid: 检查已保存的响应是否仍然可用（如引用的文件还在），返回 False 时视为没有结果、重新执行
+
+        Returns:
+            (响应字典, 是否为重放结果)
+        """
+        record = self._get_valid(key, fingerprint, valid)
+        if record is None:
+            with self.lock(key):
+                # 拿到锁后再检查一次：等待期间可能已有其他请求完成渲染
+                record = self._get_valid(key, fingerprint, valid)
+                if record is None:
+                    response = func()
+                    self.put(key, fingerprint, response)
+                    return response, False
+
+        if record.get('fingerprint') != fingerprint:
+            raise IdempotencyConflict('Idempotency-Key has already been used with a different request')
+        return record['response'], True
+
+    def _get_valid(self, key: str, fingerprint: str, valid: Optional[Callable[[Dict], bool]]) -> Optional[Dict]:
+        # 内容不同的记录留给 run 报告冲突，不做可用性检查；不可用的记录由重新执行的结果覆盖
+        record = self.get(key)
+        if record is not None and valid is not None and record.get('fingerprint') == fingerprint \
+                and not valid(record['response']):
+            return None
+        return record
+
+
+def request_fingerprint(form, files, body: bytes = b'') -> str:
+    """
+    计算请求内容指纹（表单字段 + 上传文件内容 + JSON请求体）
+
+    Args:
+        form: 表单数据（MultiDict）
+        files: 上传文件（MultiDict of FileStorage）
+        body: JSON 请求的原始请求体（表单请求为空）
+
+    Returns:
+        十六进制 SHA-256 摘要
+    """
+    digest = hashlib.sha256()
+    for name in sorted(form.keys()):
+        for value in form.getlist(name):
+            digest.update(name.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+    for name in sorted(files.keys()):
+        for storage in files.getlist(name):
+            if not storage or not storage.filename:
+                continue
+            digest.update(name.encode('utf-8'))
+            digest.update(storage.filename.encode('utf-8'))
+            stream = storage.stream
+            stream.seek(0)
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                digest.update(chunk)
+            stream.seek(0)
+    if body:
+        digest.update(b'body\0')
+        digest.update(body)
+    return digest.hexdigest()
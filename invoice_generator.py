@@ -9,39 +9,126 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import partial
+from io import BytesIO
+from time import perf_counter
+from typing import Callable, List, Dict, Optional
 from xml.sax.saxutils import escape
 import os
+import threading
+
+from cancellation import CANCEL_CHECK_ROWS, check_cancelled
+from invoice_model import InvoiceData, ItemTable
+from layout_profiler import LayoutProfile
+from linearize import linearize_pdf
+from section_cache import SectionCache, read_image
+from page_template import BOTTOM_MARGIN, LEFT_MARGIN, TOP_MARGIN, CopiesCanvas, PageCountCanvas, draw_page_frame
+from reproducible import document_info, input_fingerprint
+from storage import InvoiceStorage
+from text_cache import CachedParagraph, text_cache
+from tracing import annotate, span
+
+
+# 项目表格列宽
+# A4宽度21cm，减去左右边距2cm，可用宽度19cm
+# 列宽分配：No.(0.7) + Product Name(4.5) + Product No.(3.0) + Item No.(3.0) + HS Code(2.0) + Quantity(1.2) + Unit Price(2.0) + Amount(2.6) = 19cm
+ITEM_COL_WIDTHS = [0.7*cm, 4.5*cm, 3.0*cm, 3.0*cm, 2.0*cm, 1.2*cm, 2.0*cm, 2.6*cm]
+
+
+def _cancel_checkpoint(flowables):
+    # 用作 SimpleDocTemplate.filterFlowables：只检查，不修改 flowables
+    check_cancelled()
 
 
 class InvoiceGenerator:
     """PDF发票生成器类"""
     
-    def __init__(self, output_path: str = "invoice.pdf"):
+    def __init__(self, output_path: str = "invoice.pdf", section_cache: Optional[SectionCache] = None,
+                 document_info: Optional[Dict[str, str]] = None):
         """
         初始化发票生成器
         
         Args:
             output_path: 输出PDF文件路径
+            section_cache: 分块 flowable 缓存（可选，见 add_section）
+            document_info: PDF文档信息（见 reproducible.document_info），提供时输出可复现
         """
         self.output_path = output_path
+        self.document_info = document_info
         self.doc = SimpleDocTemplate(
             output_path,
             pagesize=A4,
-            rightMargin=1.0*cm,
-            leftMargin=1.0*cm,
-            topMargin=1.5*cm,
-            bottomMargin=1.5*cm
+            rightMargin=LEFT_MARGIN,
+            leftMargin=LEFT_MARGIN,
+            topMargin=TOP_MARGIN,
+            bottomMargin=BOTTOM_MARGIN,
+            **(dict(document_info, invariant=1) if document_info else {})
         )
+        # 每个 flowable（包括跨页拆分出的每一段）排版之前检查渲染是否已取消（见 cancellation.py）
+        self.doc.filterFlowables = _cancel_checkpoint
         self.story = []
         self.styles = getSampleStyleSheet()
         self._total_amount = 0
         self._total_quantity = 0
         self.currency = 'CNY'  # 默认货币
+        self._cell_styles = None
+        self.section_cache = section_cache
+        self.section_hits = []
+        self._sections = []    # 本次使用的缓存分块 (key, flowables)，生成成功后归还
+        self._section_starts = []  # (分块第一个 flowable 在 story 中的位置, 分块名)，用于排版分析的标注
+        self.layout_profile = None
+        self._image_data = {}  # 图片绝对路径 -> 内容（缓存的 flowable 不能引用会被删除的上传文件）
+        self.invoice_number = ''  # 续页页眉显示的发票号和收货方
+        self.consignee_name = ''
         
         # 注册中文字体（如果系统有的话）
         self._setup_fonts()
     
+    def keep_image(self, path: Optional[str]) -> Optional[bytes]:
+        """
+        把图片读入内存，之后该路径的 Image flowable 使用内存中的数据
+
+        Args:
+            path: 图片路径
+
+        Returns:
+            图片内容，没有图片时返回 None
+        """
+        data = read_image(path)
+        if data is not None:
+            self._image_data[os.path.abspath(path)] = data
+        return data
+
+    def _image_source(self, abs_path: str):
+        """Image flowable 的数据来源：已读入内存的图片用 BytesIO，否则用文件路径"""
+        data = self._image_data.get(abs_path)
+        return BytesIO(data) if data is not None else abs_path
+
+    def add_section(self, section: str, inputs: tuple, build: Callable[[], None], cacheable: bool = True):
+        """
+        添加一个分块，输入未变化时复用缓存的 flowable
+
+        Args:
+            section: 分块名
+            inputs: 分块的全部输入（用于计算缓存键）
+            build: 未命中时调用的构建函数（向 story 追加 flowable）
+            cacheable: 是否缓存该分块
+        """
+        self._section_starts.append((len(self.story), section))
+        if self.section_cache is None or not cacheable:
+            build()
+            return
+        key = self.section_cache.make_key(section, *inputs)
+        flowables = self.section_cache.checkout(section, key)
+        if flowables is None:
+            start = len(self.story)
+            build()
+            flowables = self.story[start:]
+        else:
+            self.story.extend(flowables)
+            self.section_hits.append(section)
+        self._sections.append((key, flowables))
+
     def _setup_fonts(self):
         """设置字体支持中文"""
         try:
@@ -60,6 +147,7 @@ class InvoiceGenerator:
             invoice_info: 发票信息字典 {'number': '', 'date': '', 'po_number': ''}
             logo_path: 公司Logo图片路径（可选）
         """
+        self.invoice_number = invoice_info.get('number', '') or ''
         # 如果有Logo，先显示Logo（居中显示）
         if logo_path:
             try:
@@ -74,7 +162,7 @@ class InvoiceGenerator:
                         logo_path = None
                 
                 if logo_path and os.path.exists(abs_logo_path):
-                    logo_img = Image(abs_logo_path, width=3*cm, height=3*cm)
+                    logo_img = Image(self._image_source(abs_logo_path), width=3*cm, height=3*cm)
                     # 使用表格来居中显示logo
                     logo_table = Table([[logo_img]], colWidths=[16*cm])
                     logo_table.setStyle(TableStyle([
@@ -104,8 +192,8 @@ class InvoiceGenerator:
         )
         
         # 公司信息居中显示
-        company_name = Paragraph(escape(company_info.get('name', '') or ''), company_style)
-        company_address = Paragraph(escape(company_info.get('address', '') or ''), company_style)
+        company_name = CachedParagraph(escape(company_info.get('name', '') or ''), company_style)
+        company_address = CachedParagraph(escape(company_info.get('address', '') or ''), company_style)
         
         self.story.append(company_name)
         self.story.append(company_address)
@@ -120,7 +208,7 @@ class InvoiceGenerator:
             alignment=1,  # 居中
             spaceAfter=15
         )
-        title = Paragraph("<b>COMMERCIAL INVOICE</b>", title_style)
+        title = CachedParagraph("<b>COMMERCIAL INVOICE</b>", title_style)
         self.story.append(title)
         self.story.append(Spacer(1, 0.3*cm))
         
@@ -135,14 +223,14 @@ class InvoiceGenerator:
         
         # 左列：Invoice No. 和 Date
         invoice_left_data = [
-            [Paragraph(f"Invoice No.: {escape(invoice_info.get('number', '') or '')}", info_style)],
-            [Paragraph(f"Date: {escape(invoice_info.get('date', '') or '')}", info_style)],
+            [CachedParagraph(f"Invoice No.: {escape(invoice_info.get('number', '') or '')}", info_style)],
+            [CachedParagraph(f"Date: {escape(invoice_info.get('date', '') or '')}", info_style)],
         ]
         
         # 右列：Purchase Order No.
         invoice_right_data = [
-            [Paragraph(f"Purchase Order No.: {escape(invoice_info.get('po_number', '') or '')}", info_style)],
-            [Paragraph('', info_style)],  # 空行以保持对齐
+            [CachedParagraph(f"Purchase Order No.: {escape(invoice_info.get('po_number', '') or '')}", info_style)],
+            [CachedParagraph('', info_style)],  # 空行以保持对齐
         ]
         
         invoice_left_table = Table(invoice_left_data, colWidths=[8*cm])
@@ -181,6 +269,7 @@ class InvoiceGenerator:
             shipper_info: 发货方信息字典 {'name': '', 'address': '', 'phone': ''}（必填）
             customer_info: 客户信息字典
         """
+        self.consignee_name = (customer_info or {}).get('name', '') or ''
         # 创建段落样式，支持自动换行
         title_style = ParagraphStyle(
             'InfoTitle',
@@ -245,8 +334,8 @@ class InvoiceGenerator:
             customer_text_parts.append(f"Other: {escape(other)}")
         
         # 创建段落对象，设置宽度以支持自动换行
-        shipper_para = Paragraph(''.join(shipper_text_parts), info_style)
-        customer_para = Paragraph(''.join(customer_text_parts), info_style)
+        shipper_para = CachedParagraph(''.join(shipper_text_parts), info_style)
+        customer_para = CachedParagraph(''.join(customer_text_parts), info_style)
         
         # 使用表格进行并排布局（无边框，仅用于布局）
         layout_table = Table([
@@ -280,10 +369,10 @@ class InvoiceGenerator:
             textColor=colors.black
         )
         shipper_data = [
-            [Paragraph('<b>Shipper</b>', info_style)],
-            [Paragraph(escape(shipper_info.get('name', '') or ''), info_style)],
-            [Paragraph(escape(shipper_info.get('address', '') or ''), info_style)],
-            [Paragraph(escape(shipper_info.get('phone', '') or ''), info_style)],
+            [CachedParagraph('<b>Shipper</b>', info_style)],
+            [CachedParagraph(escape(shipper_info.get('name', '') or ''), info_style)],
+            [CachedParagraph(escape(shipper_info.get('address', '') or ''), info_style)],
+            [CachedParagraph(escape(shipper_info.get('phone', '') or ''), info_style)],
         ]
         
         shipper_table = Table(shipper_data, colWidths=[8*cm])
@@ -318,37 +407,37 @@ class InvoiceGenerator:
             textColor=colors.black
         )
         customer_data = [
-            [Paragraph('<b>Consignee/Buyer</b>', info_style)],
-            [Paragraph(f"Company Name: {escape(customer_info.get('name', '') or '')}", info_style)],
+            [CachedParagraph('<b>Consignee/Buyer</b>', info_style)],
+            [CachedParagraph(f"Company Name: {escape(customer_info.get('name', '') or '')}", info_style)],
         ]
         
         # 添加Plant Address
         plant_address = customer_info.get('plant_address', '')
         if plant_address:
-            customer_data.append([Paragraph(f"Plant Address: {escape(plant_address)}", info_style)])
+            customer_data.append([CachedParagraph(f"Plant Address: {escape(plant_address)}", info_style)])
         
         # 添加Pin
         pin = customer_info.get('pin', '')
         if pin:
-            customer_data.append([Paragraph(f"Pin: {escape(pin)}", info_style)])
+            customer_data.append([CachedParagraph(f"Pin: {escape(pin)}", info_style)])
         
         # 添加其他基本信息
         address = customer_info.get('address', '')
         if address and not plant_address:
-            customer_data.append([Paragraph(f"Address: {escape(address)}", info_style)])
+            customer_data.append([CachedParagraph(f"Address: {escape(address)}", info_style)])
         
         phone = customer_info.get('phone', '')
         if phone:
-            customer_data.append([Paragraph(f"Contact: {escape(phone)}", info_style)])
+            customer_data.append([CachedParagraph(f"Contact: {escape(phone)}", info_style)])
         
         email = customer_info.get('email', '')
         if email:
-            customer_data.append([Paragraph(f"Other Information: {escape(email)}", info_style)])
+            customer_data.append([CachedParagraph(f"Other Information: {escape(email)}", info_style)])
         
         # 如果有其他内容，添加到列表中
         other = customer_info.get('other', '')
         if other:
-            customer_data.append([Paragraph(f"Other: {escape(other)}", info_style)])
+            customer_data.append([CachedParagraph(f"Other: {escape(other)}", info_style)])
         
         customer_table = Table(customer_data, colWidths=[8*cm])
         customer_table.setStyle(TableStyle([
@@ -412,8 +501,8 @@ class InvoiceGenerator:
         
         # 如果有内容才显示
         if len(shipping_left_parts) > 1 or len(shipping_right_parts) > 1:
-            shipping_left_para = Paragraph(''.join(shipping_left_parts), info_style)
-            shipping_right_para = Paragraph(''.join(shipping_right_parts), info_style)
+            shipping_left_para = CachedParagraph(''.join(shipping_left_parts), info_style)
+            shipping_right_para = CachedParagraph(''.join(shipping_right_parts), info_style)
             
             # 使用表格进行并排布局（无边框，仅用于布局）
             layout_table = Table([
@@ -432,15 +521,40 @@ class InvoiceGenerator:
             self.story.append(layout_table)
             self.story.append(Spacer(1, 0.3*cm))
     
-    def add_items(self, items: List[Dict[str, any]], product_description: Optional[str] = None):
+    def _items_cell_styles(self):
         """
-        添加发票项目列表
+        获取项目表格单元格样式
+
+        Returns:
+            (cell_style, single_line_style)
+        """
+        if self._cell_styles is None:
+            # 创建文本样式用于表格单元格
+            cell_style = ParagraphStyle(
+                'TableCell',
+                parent=self.styles['Normal'],
+                fontSize=8,
+                leading=10,
+                textColor=colors.black
+            )
+            
+            # 创建单行文本样式（用于不允许换行的列）
+            single_line_style = ParagraphStyle(
+                'SingleLineCell',
+                parent=self.styles['Normal'],
+                fontSize=8,
+                leading=10,
+                textColor=colors.black,
+                wordWrap='CJK'  # 允许 CJK 字符换行，但尽量保持单行
+            )
+            self._cell_styles = (cell_style, single_line_style)
+        return self._cell_styles
+    
+    def add_items_title(self, product_description: Optional[str] = None):
+        """
+        添加 "Product Information" 标题和产品总体描述
         
         Args:
-            items: 项目列表，每个项目包含 {
-                'product_name': '', 'product_number': '', 'item_number': '', 'hs_code': '', 
-                'description': '', 'quantity': 0, 'unit_price': 0, 'amount': 0
-            }
             product_description: 产品总体描述（可选）
         """
         # 添加 "Product Information" 标题（居中加粗）
@@ -452,7 +566,7 @@ class InvoiceGenerator:
             alignment=1,  # 居中
             spaceAfter=8
         )
-        title = Paragraph("<b>Product Information</b>", title_style)
+        title = CachedParagraph("<b>Product Information</b>", title_style)
         self.story.append(title)
         
         # 如果有产品总体描述，添加在标题下方
@@ -464,147 +578,160 @@ class InvoiceGenerator:
                 textColor=colors.HexColor('#333333'),
                 spaceAfter=8
             )
-            desc_para = Paragraph(f"Product Description: {product_description}", desc_style)
+            desc_para = CachedParagraph(f"Product Description: {product_description}", desc_style)
             self.story.append(desc_para)
             self.story.append(Spacer(1, 0.2*cm))
+    
+    def items_header_row(self) -> list:
+        """构建项目表格表头行（内容加粗，金额相关列显示货币单位）"""
+        cell_style, _ = self._items_cell_styles()
+        currency_label = self.currency if hasattr(self, 'currency') else 'CNY'
+        return [
+            CachedParagraph('<b>No.</b>', cell_style),
+            CachedParagraph('<b>Product Name</b>', cell_style),
+            CachedParagraph('<b>Product Number</b>', cell_style),
+            CachedParagraph('<b>Item Number</b>', cell_style),
+            CachedParagraph('<b>HS Code</b>', cell_style),
+            CachedParagraph('<b>Quantity</b>', cell_style),
+            CachedParagraph(f'<b>Unit Price ({currency_label})</b>', cell_style),
+            CachedParagraph(f'<b>Amount ({currency_label})</b>', cell_style)
+        ]
+    
+    @staticmethod
+    def item_values(item: Dict[str, any]) -> tuple:
+        """
+        读取单个项目的字段值
         
-        # 创建文本样式用于表格单元格
-        cell_style = ParagraphStyle(
-            'TableCell',
-            parent=self.styles['Normal'],
-            fontSize=8,
-            leading=10,
-            textColor=colors.black
-        )
+        Args:
+            item: 项目字典，或 ItemTable 迭代得到的行元组（已是返回格式，直接返回）
         
-        # 创建单行文本样式（用于不允许换行的列）
-        single_line_style = ParagraphStyle(
-            'SingleLineCell',
-            parent=self.styles['Normal'],
-            fontSize=8,
-            leading=10,
-            textColor=colors.black,
-            wordWrap='CJK'  # 允许 CJK 字符换行，但尽量保持单行
-        )
+        Returns:
+            (product_name, product_number, item_number, hs_code, quantity, unit_price, amount)
+        """
+        if isinstance(item, tuple):
+            return item
+        product_name = item.get('product_name', '') or ''
+        product_number = item.get('product_number', '') or ''
+        item_number = item.get('item_number', '') or ''
+        hs_code = item.get('hs_code', '') or ''
+        description = item.get('description', '') or ''
+        # 如果没有product_name，使用description
+        if not product_name:
+            product_name = description
+        quantity = item.get('quantity', 0)
+        unit_price = item.get('unit_price', 0)
+        amount = item.get('amount', quantity * unit_price)
+        return product_name, product_number, item_number, hs_code, quantity, unit_price, amount
+    
+    def build_item_row(self, idx: int, item: Dict[str, any]) -> tuple:
+        """
+        构建单个项目的数据行，并同时算出行高
         
-        # 表头 - 添加Product Name列，金额相关列显示货币单位
-        # 表头内容加粗并居中显示
-        currency_label = self.currency if hasattr(self, 'currency') else 'CNY'
-        table_data = [[
-            Paragraph('<b>No.</b>', cell_style),
-            Paragraph('<b>Product Name</b>', cell_style),
-            Paragraph('<b>Product Number</b>', cell_style),
-            Paragraph('<b>Item Number</b>', cell_style),
-            Paragraph('<b>HS Code</b>', cell_style),
-            Paragraph('<b>Quantity</b>', cell_style),
-            Paragraph(f'<b>Unit Price ({currency_label})</b>', cell_style),
-            Paragraph(f'<b>Amount ({currency_label})</b>', cell_style)
-        ]]
+        快速路径：能在一行内放下的单元格直接使用字符串（由 Table 按 TableStyle 的字体绘制，
+        宽度用 stringWidth 预先判断），只有真正需要换行的单元格才创建 Paragraph。
+        行高据此直接算出，交给 Table 后无需再逐个单元格计算。
         
-        # 添加项目数据
-        total_amount = 0
-        total_quantity = 0
-        for idx, item in enumerate(items, 1):
-            product_name = item.get('product_name', '') or ''
-            product_number = item.get('product_number', '') or ''
-            item_number = item.get('item_number', '') or ''
-            hs_code = item.get('hs_code', '') or ''
-            description = item.get('description', '') or ''
-            # 如果没有product_name，使用description
-            if not product_name:
-                product_name = description
-            quantity = item.get('quantity', 0)
-            unit_price = item.get('unit_price', 0)
-            amount = item.get('amount', quantity * unit_price)
-            total_amount += amount
-            total_quantity += quantity
-            
-            # 转义HTML特殊字符并创建Paragraph对象
-            # Product Name 允许换行，其他列使用单行样式以确保在一行显示
-            # 所有项目内容普通显示（不加粗，无下划线）
-            table_data.append([
-                Paragraph(str(idx), single_line_style),
-                Paragraph(f"{escape(product_name)}", cell_style),  # Product Name 允许换行
-                Paragraph(f"{escape(product_number)}", single_line_style),
-                Paragraph(f"{escape(item_number)}", single_line_style),
-                Paragraph(f"{escape(hs_code)}", single_line_style),
-                Paragraph(f"{quantity:.0f}", single_line_style),
-                Paragraph(f"{unit_price:.2f}", single_line_style),
-                Paragraph(f"{amount:,.2f}", single_line_style)
-            ])
+        Args:
+            idx: 序号（从1开始）
+            item: 项目字典
         
-        # 创建表格 - 调整列宽以适应新列（包含Product Name）
-        # A4宽度21cm，减去左右边距2cm，可用宽度19cm
-        # 列宽分配：No.(0.7) + Product Name(4.5) + Product No.(3.0) + Item No.(3.0) + HS Code(2.0) + Quantity(1.2) + Unit Price(2.0) + Amount(2.6) = 19cm
-        # Product Name 允许换行，其他列增加宽度以确保单行显示
-        items_table = Table(
-            table_data,
-            colWidths=[0.7*cm, 4.5*cm, 3.0*cm, 3.0*cm, 2.0*cm, 1.2*cm, 2.0*cm, 2.6*cm]
+        Returns:
+            (行数据, 行高（含上下内边距）)
+        """
+        cell_style, single_line_style = self._items_cell_styles()
+        product_name, product_number, item_number, hs_code, quantity, unit_price, amount = self.item_values(item)
+        
+        # Product Name 允许换行，其他列使用单行样式以确保在一行显示
+        # 所有项目内容普通显示（不加粗，无下划线）
+        texts = (
+            (str(idx), single_line_style),
+            (product_name, cell_style),  # Product Name 允许换行
+            (product_number, single_line_style),
+            (item_number, single_line_style),
+            (hs_code, single_line_style),
+            (f"{quantity:.0f}", single_line_style),
+            (f"{unit_price:.2f}", single_line_style),
+            (f"{amount:,.2f}", single_line_style),
         )
+        row = []
+        height = 0
+        for (text, style), col_width in zip(texts, ITEM_COL_WIDTHS):
+            cell, cell_height = self._fast_cell(text, style, col_width)
+            row.append(cell)
+            if cell_height > height:
+                height = cell_height
+        return row, height + 8  # 上下内边距各 4
+    
+    def items_data_row(self, idx: int, item: Dict[str, any]) -> list:
+        """
+        构建单个项目的数据行
         
-        # 设置表格样式
-        items_table.setStyle(TableStyle([
-            # 表头样式
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4a90e2')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 9),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
-            ('TOPPADDING', (0, 0), (-1, 0), 6),
-            
-            # 数据行样式
-            ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),  # 改为TOP以便多行文本正确显示
-            ('ALIGN', (0, 1), (-1, -1), 'CENTER'),  # 所有数据列居中
-            ('LEFTPADDING', (0, 0), (-1, -1), 4),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 4),
-            ('TOPPADDING', (0, 1), (-1, -1), 4),
-            ('BOTTOMPADDING', (0, 1), (-1, -1), 4),
-        ]))
+        Args:
+            idx: 序号（从1开始）
+            item: 项目字典
+        """
+        return self.build_item_row(idx, item)[0]
+    
+    @staticmethod
+    def _fast_cell(text: str, style: ParagraphStyle, col_width: float) -> tuple:
+        """
+        创建单元格内容并计算其高度（不含内边距），高度与 Table 对该单元格的计算一致
         
-        # 按照图片风格：在表格底部添加总计行
-        # 计算总计（包含税费和折扣）
-        tax_amount = 0  # 税费在add_total中计算
-        total = total_amount  # 暂时使用总金额，实际会在add_total中计算
-        
-        # 添加总计行到表格数据中（去掉货币单位）
-        if total_quantity > 0:
-            table_data.append([
-                Paragraph('', cell_style),
-                Paragraph('<b>TOTAL</b>', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph(f"<b>{total_quantity:.0f}</b>", cell_style),
-                Paragraph('', cell_style),
-                Paragraph(f"<b>{total_amount:,.2f}</b>", cell_style)
-            ])
-        else:
-            table_data.append([
-                Paragraph('', cell_style),
-                Paragraph('<b>TOTAL</b>', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph('', cell_style),
-                Paragraph(f"<b>{total_amount:,.2f}</b>", cell_style)
-            ])
+        Returns:
+            (字符串或 Paragraph, 内容高度)
+        """
+        avail_width = col_width - 8  # 左右内边距各 4
+        if not text:
+            return '', 0
+        if '\n' not in text and pdfmetrics.stringWidth(text, style.fontName, style.fontSize) <= avail_width:
+            return text, style.leading
+        # 需要换行：转义HTML特殊字符并创建Paragraph对象
+        # （解析和换行结果进程内共享，Table 之后按同一宽度 wrap 时直接命中）
+        para = CachedParagraph(escape(text), style)
+        return para, para.wrap(avail_width, 0xfffffff)[1]
+    
+    def measure_item_row(self, idx: int, item: Dict[str, any]) -> float:
+        """
+        计算项目数据行的高度（含上下内边距），结果与 items_data_row 放入表格后的行高一致
         
-        # 重新创建包含总计行的表格
-        items_table = Table(
-            table_data,
-            colWidths=[0.7*cm, 4.5*cm, 3.0*cm, 3.0*cm, 2.0*cm, 1.2*cm, 2.0*cm, 2.6*cm]
-        )
+        Args:
+            idx: 序号（从1开始）
+            item: 项目字典
+        """
+        return self.build_item_row(idx, item)[1]
+
+    def items_summary_row(self, label: str, total_quantity: float, total_amount: float) -> list:
+        """
+        构建汇总行（TOTAL，以及分页渲染时的承前/过次页行）
         
-        # 设置表格样式（包括总计行）
-        total_row_idx = len(table_data) - 1
-        items_table.setStyle(TableStyle([
+        Args:
+            label: 汇总行标签
+            total_quantity: 数量合计（为0时不显示）
+            total_amount: 金额合计
+        """
+        cell_style, _ = self._items_cell_styles()
+        # 空单元格直接用空字符串，无需创建 Paragraph
+        return [
+            '',
+            CachedParagraph(f'<b>{label}</b>', cell_style),
+            '',
+            '',
+            '',
+            CachedParagraph(f"<b>{total_quantity:.0f}</b>", cell_style) if total_quantity > 0 else '',
+            '',
+            CachedParagraph(f"<b>{total_amount:,.2f}</b>", cell_style)
+        ]
+    
+    @staticmethod
+    def items_table_style(total_row_idx: int, summary_rows: tuple = ()) -> TableStyle:
+        """
+        项目表格样式
+        
+        Args:
+            total_row_idx: 最后一行（汇总行）的行号
+            summary_rows: 除最后一行外，其他同样按汇总行加粗显示的行号
+        """
+        commands = [
             # 表头样式 - 白色背景，黑色文字
             ('BACKGROUND', (0, 0), (-1, 0), colors.white),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
@@ -619,18 +746,24 @@ class InvoiceGenerator:
             ('TEXTCOLOR', (0, 1), (-1, total_row_idx-1), colors.black),
             ('FONTNAME', (0, 1), (-1, total_row_idx-1), 'Helvetica'),
             ('FONTSIZE', (0, 1), (-1, total_row_idx-1), 8),
-            
-            # 总计行样式
-            ('BACKGROUND', (0, total_row_idx), (-1, total_row_idx), colors.white),
-            ('FONTNAME', (0, total_row_idx), (-1, total_row_idx), 'Helvetica-Bold'),
-            ('FONTSIZE', (1, total_row_idx), (1, total_row_idx), 9),  # TOTAL 字体稍大
-            ('FONTSIZE', (5, total_row_idx), (5, total_row_idx), 9),  # 数量字体
-            ('FONTSIZE', (7, total_row_idx), (7, total_row_idx), 9),  # 金额字体
-            
+        ]
+        
+        # 总计行样式
+        for row_idx in tuple(summary_rows) + (total_row_idx,):
+            commands.extend([
+                ('BACKGROUND', (0, row_idx), (-1, row_idx), colors.white),
+                ('FONTNAME', (0, row_idx), (-1, row_idx), 'Helvetica-Bold'),
+                ('FONTSIZE', (1, row_idx), (1, row_idx), 9),  # TOTAL 字体稍大
+                ('FONTSIZE', (5, row_idx), (5, row_idx), 9),  # 数量字体
+                ('FONTSIZE', (7, row_idx), (7, row_idx), 9),  # 金额字体
+            ])
+        
+        commands.extend([
             # 边框
             ('GRID', (0, 0), (-1, total_row_idx), 1, colors.grey),
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('ALIGN', (0, 1), (-1, total_row_idx-1), 'CENTER'),  # 所有数据列居中
+            # 数据列左对齐：与 Paragraph 单元格（占满列宽，文字靠左）的显示效果一致
+            ('ALIGN', (0, 1), (-1, total_row_idx-1), 'LEFT'),
             ('ALIGN', (1, total_row_idx), (1, total_row_idx), 'LEFT'),  # TOTAL 左对齐
             ('ALIGN', (0, total_row_idx), (0, total_row_idx), 'CENTER'),  # 总计行其他列居中
             ('ALIGN', (2, total_row_idx), (4, total_row_idx), 'CENTER'),  # 总计行其他列居中
@@ -640,7 +773,55 @@ class InvoiceGenerator:
             ('RIGHTPADDING', (0, 0), (-1, -1), 4),
             ('TOPPADDING', (0, 1), (-1, -1), 4),
             ('BOTTOMPADDING', (0, 1), (-1, -1), 4),
-        ]))
+            # 字符串单元格的行距与 Paragraph 单元格样式（leading=10）一致
+            ('LEADING', (0, 1), (-1, -1), 10),
+        ])
+        return TableStyle(commands)
+    
+    def add_items(self, items: List[Dict[str, any]], product_description: Optional[str] = None):
+        """
+        添加发票项目列表
+        
+        Args:
+            items: 项目列表，每个项目包含 {
+                'product_name': '', 'product_number': '', 'item_number': '', 'hs_code': '', 
+                'description': '', 'quantity': 0, 'unit_price': 0, 'amount': 0
+            }
+            product_description: 产品总体描述（可选）
+        """
+        self.add_items_title(product_description)
+        
+        # 表头 - 添加Product Name列，金额相关列显示货币单位
+        # 表头内容加粗并居中显示
+        table_data = [self.items_header_row()]
+        # 数据行高度在构建时直接算出，表头和总计行由 Table 计算（None）
+        row_heights = [None]
+        
+        # 添加项目数据
+        total_amount = 0
+        total_quantity = 0
+        for idx, item in enumerate(items, 1):
+            _, _, _, _, quantity, _, amount = self.item_values(item)
+            total_amount += amount
+            total_quantity += quantity
+            row, row_height = self.build_item_row(idx, item)
+            table_data.append(row)
+            row_heights.append(row_height)
+            if idx % CANCEL_CHECK_ROWS == 0:
+                check_cancelled()
+        
+        # 按照图片风格：在表格底部添加总计行（去掉货币单位）
+        # 税费和折扣在add_total中计算
+        table_data.append(self.items_summary_row('TOTAL', total_quantity, total_amount))
+        row_heights.append(None)
+        
+        # 创建表格 - 列宽见 ITEM_COL_WIDTHS
+        # Product Name 允许换行，其他列增加宽度以确保单行显示
+        # 表头行在续页重复
+        items_table = Table(table_data, colWidths=ITEM_COL_WIDTHS, rowHeights=row_heights, repeatRows=1)
+        
+        # 设置表格样式（包括总计行）
+        items_table.setStyle(self.items_table_style(len(table_data) - 1))
         
         self.story.append(items_table)
         self.story.append(Spacer(1, 0.3*cm))
@@ -682,13 +863,10 @@ class InvoiceGenerator:
             ['', '', '', '', '', '', f'Subtotal ({currency_label}):', f"{subtotal:,.2f}"],
             ['', '', '', '', '', '', f'Discount ({currency_label}):', f"-{discount:,.2f}"],
             ['', '', '', '', '', '', f'Tax ({currency_label}):', f"{tax_amount:,.2f}"],
-            ['', '', '', '', '', '', f'<b>Total Amount ({currency_label}):</b>', f"<b>{total:,.2f}</b>"],
+            ['', '', '', '', '', '', f'Total Amount ({currency_label}):', f"{total:,.2f}"],
         ])
         
-        total_table = Table(
-            total_data,
-            colWidths=[0.7*cm, 4.5*cm, 3.0*cm, 3.0*cm, 2.0*cm, 1.2*cm, 2.0*cm, 2.6*cm]
-        )
+        total_table = Table(total_data, colWidths=ITEM_COL_WIDTHS)
         
         total_table.setStyle(TableStyle([
             ('ALIGN', (6, 0), (-1, -1), 'RIGHT'),  # 金额列右对齐
@@ -733,7 +911,7 @@ class InvoiceGenerator:
             try:
                 abs_stamp_path = os.path.abspath(stamp_path)
                 if os.path.exists(abs_stamp_path):
-                    stamp_img = Image(abs_stamp_path, width=2.5*cm, height=2.5*cm)
+                    stamp_img = Image(self._image_source(abs_stamp_path), width=2.5*cm, height=2.5*cm)
                     right_content = stamp_img
             except Exception as e:
                 print(f"Warning: Could not load stamp image: {e}")
@@ -773,19 +951,88 @@ class InvoiceGenerator:
             self.story.append(Spacer(1, 0.3*cm))
             self.story.append(footer_table)
     
-    def generate(self):
-        """生成PDF发票"""
-        self.doc.build(self.story)
+    def _draw_page(self, canvas, doc):
+        # 页面模板回调：页脚页码（总页数在保存时补上）和续页页眉
+        draw_page_frame(canvas, canvas.getPageNumber(), self.invoice_number, self.consignee_name)
+
+    def _story_labels(self) -> List[str]:
+        """story 中每个 flowable 的标注："分块[序号] 类型"""
+        labels = []
+        starts = self._section_starts + [(len(self.story), '')]
+        section, start = '-', 0
+        bounds = iter(starts)
+        next_start, next_section = next(bounds)
+        for index, flowable in enumerate(self.story):
+            while index >= next_start:
+                section, start = next_section, next_start
+                next_start, next_section = next(bounds)
+            labels.append(f"{section}[{index - start}] {type(flowable).__name__}")
+        return labels
+
+    def generate(self, copies: Optional[List[str]] = None, profile=False, linearize: bool = False):
+        """
+        生成PDF发票
+
+        先写入同目录下的临时文件，再原子地重命名为目标文件，
+        避免并发渲染同一发票号时互相覆盖写到一半的文件
+
+        Args:
+            copies: 副本标签（如 ['ORIGINAL', 'DUPLICATE']），提供时排版一次、按副本重复输出全部页面
+            profile: 为 True 时统计每个 flowable 的 wrap/split/draw 次数、耗时和所在页，结果保存在
+                self.layout_profile 并输出报告（见 layout_profiler.py）；也可以传入 LayoutProfile，由调用方输出报告
+            linearize: 输出线性化PDF（快速 Web 查看，见 linearize.py），在重命名之前改写临时文件
+        """
+        tmp_path = f"{self.output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.doc.filename = tmp_path
+        canvasmaker = partial(CopiesCanvas, copies=copies) if copies else PageCountCanvas
+        draw_page = self._draw_page
+        layout_profile = None
+        if profile:
+            layout_profile = LayoutProfile() if profile is True else profile
+            layout_profile.instrument(self.story, self._story_labels())
+            draw_page = layout_profile.page_callback(draw_page)
+        try:
+            # build 包含排版和写出临时文件
+            with span('build'):
+                start = perf_counter()
+                self.doc.build(self.story, onFirstPage=draw_page, onLaterPages=draw_page,
+                               canvasmaker=canvasmaker)
+                if layout_profile is not None:
+                    layout_profile.build_ms = (perf_counter() - start) * 1000
+            # 已取消的渲染不再线性化和提交
+            check_cancelled()
+            if linearize:
+                with span('linearize'):
+                    linearize_pdf(tmp_path, deterministic=self.document_info is not None)
+            with span('rename'):
+                os.replace(tmp_path, self.output_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            self.doc.filename = self.output_path
+            if layout_profile is not None:
+                # 归还缓存的分块之前移除计时方法
+                layout_profile.restore()
+        if layout_profile is not None:
+            self.layout_profile = layout_profile
+            if profile is True:
+                print(f"排版分析: {self.output_path}\n{layout_profile.format()}")
+        # 生成成功后归还借出的分块（失败时丢弃，避免复用状态异常的 flowable）
+        for key, flowables in self._sections:
+            self.section_cache.checkin(key, flowables)
+        self._sections = []
         print(f"发票已成功生成: {self.output_path}")
 
 
 def create_invoice(
     output_path: str,
-    company_info: Dict[str, str],
-    customer_info: Dict[str, str],
-    invoice_info: Dict[str, str],
-    items: List[Dict[str, any]],
-    shipper_info: Dict[str, str],
+    company_info: Optional[Dict[str, str]] = None,
+    customer_info: Optional[Dict[str, str]] = None,
+    invoice_info: Optional[Dict[str, str]] = None,
+    items: Optional[List[Dict[str, any]]] = None,
+    shipper_info: Optional[Dict[str, str]] = None,
     tax_rate: float = 0.0,
     discount: float = 0.0,
     notes: Optional[str] = None,
@@ -794,7 +1041,16 @@ def create_invoice(
     stamp_path: Optional[str] = None,
     shipping_info: Optional[Dict[str, str]] = None,
     product_description: Optional[str] = None,
-    currency: str = 'CNY'
+    currency: str = 'CNY',
+    parallel_jobs: int = 0,
+    backend: str = 'platypus',
+    invoice: Optional[InvoiceData] = None,
+    section_cache: Optional[SectionCache] = None,
+    storage: Optional[InvoiceStorage] = None,
+    deterministic: bool = False,
+    copies: Optional[List[str]] = None,
+    layout_profile: Optional[LayoutProfile] = None,
+    linearize: bool = False
 ) -> str:
     """
     创建发票的便捷函数
@@ -804,7 +1060,7 @@ def create_invoice(
         company_info: 公司信息（Issuer）
         customer_info: 客户信息（Consignee/Buyer）
         invoice_info: 发票信息（包含 po_number）
-        items: 项目列表（包含 product_name）
+        items: 项目列表（包含 product_name），也可以是 ItemTable
         tax_rate: 税率（百分比）
         discount: 折扣金额
         notes: 备注
@@ -814,33 +1070,256 @@ def create_invoice(
         shipper_info: 发货方信息（必填）
         shipping_info: 运输详情（可选）
         product_description: 产品总体描述（可选）
+        currency: 货币类型
+        parallel_jobs: 大于1时，对超过 PARALLEL_MIN_ITEMS 行的发票按页段多进程并行渲染
+        backend: 渲染后端，'platypus'（默认）或 'canvas'（直接画布绘制，适合常规行数的发票；
+            备注等字段含有不支持的 Paragraph 标记时改用 platypus，见 canvas_renderer.markup_supported）
+        invoice: 已解析的发票数据（InvoiceData），提供时替代上面的各信息参数（同时提供这些参数时抛出 TypeError）；
+            copies 参数仍然有效（invoice 已设置不同的副本标签时抛出 TypeError）
+        section_cache: 分块 flowable 缓存，提供时输入未变化的分块直接复用（仅 platypus 后端）
+        storage: 发票存储，提供时 output_path 是存储中的文件名，渲染完成后原子地提交
+        deterministic: 可复现输出，相同输入得到逐字节相同的PDF（固定时间戳，文档信息和ID取自输入，见 reproducible.py）
+        copies: 副本标签（如 ['ORIGINAL', 'DUPLICATE', 'TRIPLICATE']），提供时只排版一次，
+            同一文件中按顺序输出每份副本并在页脚标注（见 page_template.CopiesCanvas）；不使用并行渲染
+        layout_profile: 提供时记录每个 flowable 的排版统计（见 layout_profiler.py；仅 platypus 后端，不使用并行渲染）
+        linearize: 输出线性化PDF（快速 Web 查看，见 linearize.py；所有后端，没有可用的线性化工具时输出普通PDF）
     
     Returns:
-        生成的PDF文件路径
+        生成的PDF文件路径（使用 storage 时为文件名）
     """
-    generator = InvoiceGenerator(output_path)
+    if storage is not None:
+        # 渲染到存储内的临时文件，成功后才以文件名提交（见 commit_invoice）
+        commit_invoice(
+            storage,
+            output_path,
+            company_info=company_info,
+            customer_info=customer_info,
+            invoice_info=invoice_info,
+            items=items,
+            shipper_info=shipper_info,
+            tax_rate=tax_rate,
+            discount=discount,
+            notes=notes,
+            payment_info=payment_info,
+            logo_path=logo_path,
+            stamp_path=stamp_path,
+            shipping_info=shipping_info,
+            product_description=product_description,
+            currency=currency,
+            parallel_jobs=parallel_jobs,
+            backend=backend,
+            invoice=invoice,
+            section_cache=section_cache,
+            deterministic=deterministic,
+            copies=copies,
+            layout_profile=layout_profile,
+            linearize=linearize
+        )
+        return output_path
+
+    if invoice is not None:
+        # invoice 替代各信息参数：同时提供时不能静默忽略其中一方
+        conflicting = [name for name, value, default in (
+            ('company_info', company_info, None),
+            ('customer_info', customer_info, None),
+            ('invoice_info', invoice_info, None),
+            ('items', items, None),
+            ('shipper_info', shipper_info, None),
+            ('tax_rate', tax_rate, 0.0),
+            ('discount', discount, 0.0),
+            ('notes', notes, None),
+            ('payment_info', payment_info, None),
+            ('shipping_info', shipping_info, None),
+            ('product_description', product_description, None),
+            ('currency', currency, 'CNY')
+        ) if value != default]
+        invoice_kwargs = invoice.render_kwargs()
+        if copies:
+            # 副本标签可以单独提供，与 invoice 中的不一致时同样报错
+            if invoice_kwargs['copies'] and invoice_kwargs['copies'] != list(copies):
+                conflicting.append('copies')
+            invoice_kwargs['copies'] = list(copies)
+        if conflicting:
+            raise TypeError(f"create_invoice() got both invoice and {', '.join(conflicting)}")
+        return create_invoice(
+            output_path,
+            logo_path=logo_path,
+            stamp_path=stamp_path,
+            parallel_jobs=parallel_jobs,
+            backend=backend,
+            section_cache=section_cache,
+            deterministic=deterministic,
+            layout_profile=layout_profile,
+            linearize=linearize,
+            **invoice_kwargs
+        )
+
+    info = None
+    if deterministic:
+        # 副本标签只在提供时参与指纹，不改变原有输入的指纹
+        extra = {'copies': list(copies)} if copies else {}
+        fingerprint = input_fingerprint(
+            logo_path, stamp_path,
+            company_info=company_info,
+            customer_info=customer_info,
+            invoice_info=invoice_info,
+            items=items,
+            shipper_info=shipper_info,
+            tax_rate=tax_rate,
+            discount=discount,
+            notes=notes,
+            payment_info=payment_info,
+            shipping_info=shipping_info,
+            product_description=product_description,
+            currency=currency,
+            backend=backend,
+            **extra
+        )
+        info = document_info(fingerprint, invoice_info, company_info)
+
+    if layout_profile is not None and backend != 'platypus':
+        raise ValueError("Layout profiling requires the platypus backend")
+
+    if parallel_jobs > 1 and not copies and layout_profile is None:
+        from parallel_render import PARALLEL_MIN_ITEMS, create_invoice_parallel
+        if len(items) >= PARALLEL_MIN_ITEMS:
+            with span('parallel_render'):
+                create_invoice_parallel(
+                    output_path,
+                    jobs=parallel_jobs,
+                    company_info=company_info,
+                    customer_info=customer_info,
+                    invoice_info=invoice_info,
+                    items=items,
+                    shipper_info=shipper_info,
+                    tax_rate=tax_rate,
+                    discount=discount,
+                    notes=notes,
+                    payment_info=payment_info,
+                    logo_path=logo_path,
+                    stamp_path=stamp_path,
+                    shipping_info=shipping_info,
+                    product_description=product_description,
+                    currency=currency,
+                    document_info=info
+                )
+            if linearize:
+                with span('linearize'):
+                    linearize_pdf(output_path, deterministic=deterministic)
+            return output_path
+    
+    if backend == 'canvas':
+        from canvas_renderer import CanvasInvoiceRenderer, markup_supported
+        if not markup_supported(notes, payment_info, product_description):
+            # 备注/支付信息/产品描述含有 canvas 后端不支持的 Paragraph 标记，改用 platypus 保持输出一致
+            backend = 'platypus'
+    if backend == 'canvas':
+        renderer = CanvasInvoiceRenderer(output_path, currency=currency, document_info=info, copies=copies)
+        with span('canvas_render'):
+            renderer.render(
+                company_info=company_info,
+                customer_info=customer_info,
+                invoice_info=invoice_info,
+                items=items,
+                shipper_info=shipper_info,
+                tax_rate=tax_rate,
+                discount=discount,
+                notes=notes,
+                payment_info=payment_info,
+                logo_path=logo_path,
+                stamp_path=stamp_path,
+                shipping_info=shipping_info,
+                product_description=product_description
+            )
+        if linearize:
+            with span('linearize'):
+                linearize_pdf(output_path, deterministic=deterministic)
+        return output_path
+    if backend != 'platypus':
+        raise ValueError(f"Unknown render backend: {backend}")
+
+    generator = InvoiceGenerator(output_path, section_cache=section_cache, document_info=info)
     generator.currency = currency.upper()  # 保存货币类型
-    generator.add_header(company_info, invoice_info, logo_path)
+    # 分块缓存命中时不会调用 add_header 等方法，页眉信息在这里设置
+    generator.invoice_number = (invoice_info or {}).get('number', '') or ''
+    generator.consignee_name = (customer_info or {}).get('name', '') or ''
+    logo_data = stamp_data = None
+    if section_cache is not None or deterministic:
+        # 图片按内容参与缓存键；可复现模式下图片也按内容命名
+        logo_data = generator.keep_image(logo_path)
+        stamp_data = generator.keep_image(stamp_path)
+    with span('header'):
+        generator.add_section('header', (company_info, invoice_info, logo_data),
+                              lambda: generator.add_header(company_info, invoice_info, logo_path))
     
     # 添加发货方和收货方信息（并排显示）
-    generator.add_shipper_and_consignee(shipper_info, customer_info)
+    with span('parties'):
+        generator.add_section('parties', (shipper_info, customer_info),
+                              lambda: generator.add_shipper_and_consignee(shipper_info, customer_info))
     
     # 添加运输详情
     if shipping_info:
-        generator.add_shipping_details(shipping_info)
+        with span('shipping'):
+            generator.add_section('shipping', (shipping_info,),
+                                  lambda: generator.add_shipping_details(shipping_info))
     
     # 添加产品项目和描述
-    generator.add_items(items, product_description=product_description)
+    with span('items'):
+        generator.add_section(
+            'items', (items, product_description, generator.currency),
+            lambda: generator.add_items(items, product_description=product_description),
+            cacheable=section_cache is not None and section_cache.cacheable(items)
+        )
     
     # 计算小计和总数量
-    subtotal = sum(item.get('amount', item.get('quantity', 0) * item.get('unit_price', 0)) 
-                   for item in items)
-    total_quantity = sum(item.get('quantity', 0) for item in items)
+    if isinstance(items, ItemTable):
+        subtotal = items.subtotal()
+        total_quantity = items.total_quantity()
+    else:
+        subtotal = sum(item.get('amount', item.get('quantity', 0) * item.get('unit_price', 0)) 
+                       for item in items)
+        total_quantity = sum(item.get('quantity', 0) for item in items)
     
-    generator.add_total(subtotal, tax_rate, discount, total_quantity=total_quantity)
-    generator.add_footer(notes, payment_info, stamp_path)
-    generator.generate()
+    with span('total'):
+        generator.add_section('total', (subtotal, tax_rate, discount, total_quantity, generator.currency),
+                              lambda: generator.add_total(subtotal, tax_rate, discount, total_quantity=total_quantity))
+    with span('footer'):
+        generator.add_section('footer', (notes, payment_info, stamp_data),
+                              lambda: generator.add_footer(notes, payment_info, stamp_path))
+    generator.generate(copies=copies, profile=layout_profile or False, linearize=linearize)
+    if layout_profile is not None:
+        annotate(layout_profile=[(stats.label, round(stats.total_ms, 2)) for stats in
+                                 sorted(layout_profile.elements, key=lambda stats: -stats.total_ms)[:5]])
+    if section_cache is not None:
+        annotate(section_cache_hits=generator.section_hits)
+    if text_cache.max_entries > 0:
+        text_stats = text_cache.stats()
+        annotate(text_cache_hit_rate={kind: text_stats[kind]['hit_rate'] for kind in ('parse', 'wrap')})
     
     return output_path
 
 
+def commit_invoice(storage: InvoiceStorage, name: str, **kwargs) -> str:
+    """
+    渲染发票并提交到存储
+
+    渲染到存储内的临时文件，成功后才以文件名提交，读者看不到写到一半的PDF
+
+    Args:
+        storage: 发票存储
+        name: 存储中的文件名
+        **kwargs: create_invoice 的其他参数（不包括 output_path 和 storage）
+
+    Returns:
+        这一次渲染的内容摘要（SHA-256）；同名文件之后被其他渲染覆盖时，仍可用它读取这一次的结果
+    """
+    write = storage.writer(name)
+    with write as tmp_path:
+        create_invoice(tmp_path, **kwargs)
+    return write.digest
+
+
+if __name__ == '__main__':
+    # 批量渲染命令行：python -m invoice_generator invoices.jsonl --output out/ --jobs 4
+    from bulk_render import main
+    raise SystemExit(main())
@@ -0,0 +1,389 @@
+"""
+发票数据模型 - 表单/JSON 输入只解析一次，预览和各渲染后端直接使用
+
+- 各信息块（公司、发货方、客户、运输、支付）在构建时统一为字符串字典（None -> ''），
+  渲染时不再需要逐层做类型转换
+- 项目按列存储：文本列为字符串列表，数量/单价/金额为 array('d')，
+  不再为每一行保存一个字典（10k 行时内存约为字典列表的一半）
+- 迭代项目表得到与 InvoiceGenerator.item_values 相同格式的元组，现有渲染代码可直接使用
+"""
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import sys
+
+COMPANY_FIELDS = ('name', 'address')
+SHIPPER_FIELDS = ('name', 'address', 'phone')
+CUSTOMER_FIELDS = ('name', 'address', 'phone', 'email', 'plant_address', 'pin', 'other')
+SHIPPING_FIELDS = ('port_of_shipment', 'country_of_origin', 'port_of_destination', 'place_of_destination',
+                   'shipment_term')
+PAYMENT_FIELDS = ('bank', 'account', 'swift')
+INVOICE_FIELDS = ('number', 'date', 'po_number')
+
+# 一次请求最多输出的副本数（ORIGINAL / DUPLICATE / TRIPLICATE ...）
+MAX_COPIES = 10
+
+# (product_name, product_number, item_number, hs_code, quantity, unit_price, amount)
+ItemRow = Tuple[str, str, str, str, float, float, float]
+
+
+def _text(value) -> str:
+    """None -> ''，其他值转为字符串"""
+    if value is None:
+        return ''
+    return value if isinstance(value, str) else str(value)
+
+
+def _section(values: Optional[Dict], fields: Tuple[str, ...]) -> Dict[str, str]:
+    """
+    把一个信息块统一为只包含已知字段的字符串字典
+
+    Args:
+        values: 输入字典
+        fields: 字段名
+
+    Returns:
+        {字段: 字符串}
+    """
+    if values is None:
+        values = {}
+    elif not isinstance(values, dict):
+        raise ValueError('Invoice sections must be objects')
+    return {field: _text(values.get(field)) for field in fields}
+
+
+def _copies(value) -> Tuple[str, ...]:
+    """
+    解析副本标签：列表或逗号分隔的字符串，忽略空标签
+
+    Raises:
+        ValueError: 格式错误或副本数超过 MAX_COPIES
+    """
+    if value is None or value == '':
+        return ()
+    if isinstance(value, str):
+        value = value.split(',')
+    elif not isinstance(value, (list, tuple)):
+        raise ValueError('copies must be a list of labels')
+    labels = tuple(label for label in (_text(v).strip() for v in value) if label)
+    if len(labels) > MAX_COPIES:
+        raise ValueError(f'At most {MAX_COPIES} copies are allowed')
+    return labels
+
+
+class ItemTable:
+    """按列存储的发票项目表"""
+
+    __slots__ = ('product_names', 'product_numbers', 'item_numbers', 'hs_codes',
+                 'quantities', 'unit_prices', 'amounts')
+
+    def __init__(self):
+        self.product_names = []
+        self.product_numbers = []
+        self.item_numbers = []
+        self.hs_codes = []
+        self.quantities = array('d')
+        self.unit_prices = array('d')
+        self.amounts = array('d')
+
+    def append(self, product_name: str, product_number: str = '', item_number: str = '', hs_code: str = '',
+               quantity: float = 0.0, unit_price: float = 0.0, amount: Optional[float] = None):
+        """
+        追加一行
+
+        Args:
+            amount: 金额，为 None 时按 数量 × 单价 计算
+        """
+        quantity = float(quantity)
+        unit_price = float(unit_price)
+        self.product_names.append(product_name)
+        self.product_numbers.append(product_number)
+        self.item_numbers.append(item_number)
+        # HS 编码在大发票中大量重复，驻留后各行共享同一个字符串对象
+        self.hs_codes.append(sys.intern(hs_code))
+        self.quantities.append(quantity)
+        self.unit_prices.append(unit_price)
+        self.amounts.append(quantity * unit_price if amount is None else float(amount))
+
+    @classmethod
+    def from_dicts(cls, items: Iterable[Dict]) -> 'ItemTable':
+        """
+        从项目字典列表构建（字段含义与 create_invoice 的 items 相同）
+
+        Args:
+            items: 项目字典列表
+        """
+        table = cls()
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError('Each item must be an object')
+            quantity = float(item.get('quantity', 0) or 0)
+            unit_price = float(item.get('unit_price', 0) or 0)
+            amount = item.get('amount')
+            table.append(
+                # 没有 product_name 时使用 description
+                _text(item.get('product_name')) or _text(item.get('description')),
+                _text(item.get('product_number')),
+                _text(item.get('item_number')),
+                _text(item.get('hs_code')),
+                quantity,
+                unit_price,
+                None if amount is None else float(amount)
+            )
+        return table
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+    def row(self, index: int) -> ItemRow:
+        """第 index 行（与 InvoiceGenerator.item_values 返回格式相同）"""
+        return (self.product_names[index], self.product_numbers[index], self.item_numbers[index],
+                self.hs_codes[index], self.quantities[index], self.unit_prices[index], self.amounts[index])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            part = ItemTable()
+            for name in self.__slots__:
+                setattr(part, name, getattr(self, name)[index])
+            return part
+        return self.row(index)
+
+    def __iter__(self) -> Iterator[ItemRow]:
+        return zip(self.product_names, self.product_numbers, self.item_numbers, self.hs_codes,
+                   self.quantities, self.unit_prices, self.amounts)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
+    def subtotal(self) -> float:
+        return sum(self.amounts)
+
+    def total_quantity(self) -> float:
+        return sum(self.quantities)
+
+    def text_length(self) -> int:
+        """所有文本列的总字符数（用于内存预估）"""
+        return sum(sum(map(len, column)) for column in
+                   (self.product_names, self.product_numbers, self.item_numbers, self.hs_codes))
+
+    def digest(self) -> bytes:
+        """项目表内容的 SHA-256 摘要（用于缓存键）"""
+        digest = hashlib.sha256()
+        for column in (self.product_names, self.product_numbers, self.item_numbers, self.hs_codes):
+            for value in column:
+                digest.update(value.encode('utf-8'))
+                digest.update(b'\0')
+            digest.update(b'\1')
+        for column in (self.quantities, self.unit_prices, self.amounts):
+            digest.update(column.tobytes())
+        return digest.digest()
+
+    def to_dicts(self) -> List[Dict]:
+        """转换为项目字典列表（用于JSON输出）"""
+        return [
+            {
+                'product_name': product_name,
+                'product_number': product_number,
+                'item_number': item_number,
+                'hs_code': hs_code,
+                'quantity': quantity,
+                'unit_price': unit_price,
+                'amount': amount
+            }
+            for product_name, product_number, item_number, hs_code, quantity, unit_price, amount in self
+        ]
+
+
+class InvoiceData:
+    """一张发票的全部输入数据"""
+
+    __slots__ = ('company_info', 'shipper_info', 'customer_info', 'invoice_info', 'shipping_info',
+                 'payment_info', 'items', 'tax_rate', 'discount', 'notes', 'currency', 'product_description',
+                 'copies')
+
+    def __init__(
+        self,
+        company_info: Dict[str, str],
+        shipper_info: Dict[str, str],
+        customer_info: Dict[str, str],
+        invoice_info: Dict[str, str],
+        items: ItemTable,
+        shipping_info: Optional[Dict[str, str]] = None,
+        payment_info: Optional[Dict[str, str]] = None,
+        tax_rate: float = 0.0,
+        discount: float = 0.0,
+        notes: Optional[str] = None,
+        currency: str = 'CNY',
+        product_description: Optional[str] = None,
+        copies: Tuple[str, ...] = ()
+    ):
+        self.company_info = company_info
+        self.shipper_info = shipper_info
+        self.customer_info = customer_info
+        self.invoice_info = invoice_info
+        self.items = items
+        self.shipping_info = shipping_info
+        self.payment_info = payment_info
+        self.tax_rate = tax_rate
+        self.discount = discount
+        self.notes = notes or None
+        self.currency = (currency or 'CNY').upper()
+        self.product_description = product_description or None
+        self.copies = tuple(copies)
+
+    @classmethod
+    def from_form(cls, data) -> 'InvoiceData':
+        """
+        从 /generate 表单构建
+
+        Args:
+            data: 表单数据（MultiDict）
+
+        Returns:
+            发票数据
+        """
+        shipping_info = None
+        if data.get('port_of_shipment') or data.get('country_of_origin') or data.get('port_of_destination'):
+            shipping_info = {field: data.get(field, '') for field in SHIPPING_FIELDS}
+
+        payment_info = None
+        if data.get('bank') or data.get('account'):
+            payment_info = {field: data.get(field, '') for field in PAYMENT_FIELDS}
+
+        items = ItemTable()
+        item_count = int(data.get('item_count', 1))
+        for i in range(item_count):
+            product_name = data.get(f'item_product_name_{i}', '').strip()
+            if product_name:  # 只添加有产品名称的项目（产品名称为必填项）
+                quantity = float(data.get(f'item_quantity_{i}', 0) or 0)
+                unit_price = float(data.get(f'item_unit_price_{i}', 0) or 0)
+                items.append(
+                    product_name,
+                    data.get(f'item_product_number_{i}', ''),
+                    data.get(f'item_item_number_{i}', ''),
+                    data.get(f'item_hs_code_{i}', ''),
+                    quantity,
+                    unit_price,
+                    float(data.get(f'item_amount_{i}', 0) or (quantity * unit_price))
+                )
+
+        return cls(
+            company_info={
+                'name': data.get('company_name', ''),
+                'address': data.get('company_address', '')
+            },
+            shipper_info={
+                'name': data.get('shipper_name', ''),
+                'address': data.get('shipper_address', ''),
+                'phone': data.get('shipper_phone', '')
+            },
+            customer_info={
+                'name': data.get('customer_name', ''),
+                'address': data.get('customer_address', ''),
+                'phone': data.get('customer_phone', ''),
+                'email': data.get('customer_email', ''),
+                'plant_address': data.get('plant_address', ''),
+                'pin': data.get('pin', ''),
+                'other': data.get('customer_other', '')
+            },
+            invoice_info={
+                'number': data.get('invoice_number', ''),
+                'date': data.get('invoice_date', datetime.now().strftime('%Y-%m-%d')),
+                'po_number': data.get('po_number', '')
+            },
+            items=items,
+            shipping_info=shipping_info,
+            payment_info=payment_info,
+            tax_rate=float(data.get('tax_rate', 0) or 0),
+            discount=float(data.get('discount', 0) or 0),
+            notes=data.get('notes', ''),
+            currency=data.get('currency', 'CNY'),
+            copies=_copies(data.get('copies'))
+        )
+
+    @classmethod
+    def from_json(cls, payload: Dict) -> 'InvoiceData':
+        """
+        从JSON构建（字段与 create_invoice 的参数相同）
+
+        Args:
+            payload: {'company_info': {...}, 'items': [...], ...}
+
+        Returns:
+            发票数据
+        """
+        if not isinstance(payload, dict):
+            raise ValueError('Request body must be a JSON object')
+        invoice_info = _section(payload.get('invoice_info'), INVOICE_FIELDS)
+        if not invoice_info['date']:
+            invoice_info['date'] = datetime.now().strftime('%Y-%m-%d')
+        shipping_info = payload.get('shipping_info')
+        payment_info = payload.get('payment_info')
+        return cls(
+            company_info=_section(payload.get('company_info'), COMPANY_FIELDS),
+            shipper_info=_section(payload.get('shipper_info'), SHIPPER_FIELDS),
+            customer_info=_section(payload.get('customer_info'), CUSTOMER_FIELDS),
+            invoice_info=invoice_info,
+            items=ItemTable.from_dicts(payload.get('items') or []),
+            shipping_info=_section(shipping_info, SHIPPING_FIELDS) if shipping_info else None,
+            payment_info=_section(payment_info, PAYMENT_FIELDS) if payment_info else None,
+            tax_rate=float(payload.get('tax_rate', 0) or 0),
+            discount=float(payload.get('discount', 0) or 0),
+            notes=_text(payload.get('notes')),
+            currency=_text(payload.get('currency')) or 'CNY',
+            product_description=_text(payload.get('product_description')),
+            copies=_copies(payload.get('copies'))
+        )
+
+    def totals(self) -> Dict[str, float]:
+        """计算小计、税额和总计"""
+        subtotal = self.items.subtotal()
+        tax_amount = subtotal * (self.tax_rate / 100) if self.tax_rate > 0 else 0
+        return {
+            'subtotal': subtotal,
+            'tax_amount': tax_amount,
+            'discount': self.discount,
+            'total': subtotal - self.discount + tax_amount,
+            'total_quantity': self.items.total_quantity()
+        }
+
+    def to_json(self) -> Dict:
+        """转换为可 JSON 序列化的字典（from_json 的逆操作，用于渲染队列）"""
+        return {
+            'company_info': self.company_info,
+            'shipper_info': self.shipper_info,
+            'customer_info': self.customer_info,
+            'invoice_info': self.invoice_info,
+            'items': self.items.to_dicts(),
+            'shipping_info': self.shipping_info,
+            'payment_info': self.payment_info,
+            'tax_rate': self.tax_rate,
+            'discount': self.discount,
+            'notes': self.notes,
+            'currency': self.currency,
+            'product_description': self.product_description,
+            'copies': list(self.copies)
+        }
+
+    def render_kwargs(self) -> Dict:
+        """转换为 create_invoice 的参数"""
+        return {
+            'company_info': self.company_info,
+            'customer_info': self.customer_info,
+            'invoice_info': self.invoice_info,
+            'items': self.items,
+            'shipper_info': self.shipper_info,
+            'tax_rate': self.tax_rate,
+            'discount': self.discount,
+            'notes': self.notes,
+            'payment_info': self.payment_info,
+            'shipping_info': self.shipping_info,
+            'product_description': self.product_description,
+            'currency': self.currency,
+            'copies': list(self.copies) or None
+        }
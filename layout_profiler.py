@@ -0,0 +1,235 @@
+"""
+排版分析 - 统计 InvoiceGenerator 的 story 中每个 flowable 的 wrap/split/draw 次数和耗时
+
+- 只在 generate(profile=True) 时启用：在每个顶层 flowable 实例上临时替换 wrap、split 和 drawOn，
+  生成结束后恢复（缓存的分块 flowable 归还时不带任何分析代码），未启用时没有任何开销
+- 跨页拆分出的片段计入原 flowable，同时记录它绘制在哪些页上
+- 计时是包含式的：嵌套的表格、段落和图片计入所在的顶层 flowable；同一 flowable 的
+  split 内部再调用 wrap 时只计外层
+- 每个 flowable 按 "分块[序号] 类型" 标注（分块名见 InvoiceGenerator.add_section），
+  页眉页脚回调和写出文件的时间分别列出
+
+命令行（分析一张真实发票，JSON 格式同 InvoiceData.from_json）：
+
+    python layout_profiler.py invoice.json --logo logo.png --stamp stamp.png
+"""
+from contextlib import redirect_stdout
+from io import StringIO
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# 被替换的方法
+_PATCHED = ('wrap', 'split', 'drawOn', '_layout_stats')
+
+
+class FlowableStats:
+    """一个顶层 flowable（包括拆分出的片段）的统计"""
+
+    __slots__ = ('label', 'wrap_calls', 'wrap_ms', 'split_calls', 'split_ms', 'split_parts',
+                 'draw_calls', 'draw_ms', 'pages', '_depth')
+
+    def __init__(self, label: str):
+        self.label = label
+        self.wrap_calls = 0
+        self.wrap_ms = 0.0
+        self.split_calls = 0
+        self.split_ms = 0.0
+        self.split_parts = 0
+        self.draw_calls = 0
+        self.draw_ms = 0.0
+        self.pages = []
+        self._depth = 0
+
+    @property
+    def total_ms(self) -> float:
+        return self.wrap_ms + self.split_ms + self.draw_ms
+
+    def to_json(self) -> Dict:
+        return {
+            'label': self.label,
+            'wrap_calls': self.wrap_calls,
+            'wrap_ms': round(self.wrap_ms, 3),
+            'split_calls': self.split_calls,
+            'split_ms': round(self.split_ms, 3),
+            'split_parts': self.split_parts,
+            'draw_calls': self.draw_calls,
+            'draw_ms': round(self.draw_ms, 3),
+            'total_ms': round(self.total_ms, 3),
+            'pages': list(self.pages)
+        }
+
+
+class LayoutProfile:
+    """一次渲染的排版分析结果"""
+
+    def __init__(self):
+        self.elements = []   # FlowableStats，按 story 顺序
+        self.page_calls = 0  # 页眉页脚回调
+        self.page_ms = 0.0
+        self.build_ms = 0.0  # doc.build 总耗时
+        self._patched = []
+
+    # ---- 安装和恢复 ----
+
+    def instrument(self, flowables: List, labels: List[str]):
+        """
+        在 flowable 实例上安装计时
+
+        Args:
+            flowables: 顶层 flowable（story）
+            labels: 对应的标注
+        """
+        for flowable, label in zip(flowables, labels):
+            stats = FlowableStats(label)
+            self.elements.append(stats)
+            self._instrument(flowable, stats)
+
+    def _instrument(self, flowable, stats: FlowableStats):
+        if flowable.__dict__.get('_layout_stats') is not None:
+            # split 用 copy 生成的片段会带上原 flowable 的计时方法，替换为绑定到片段自身的方法
+            for name in _PATCHED:
+                flowable.__dict__.pop(name, None)
+        wrap, split, draw_on = flowable.wrap, flowable.split, flowable.drawOn
+
+        def timed_wrap(available_width, available_height):
+            if stats._depth:
+                return wrap(available_width, available_height)
+            stats._depth += 1
+            start = perf_counter()
+            try:
+                return wrap(available_width, available_height)
+            finally:
+                stats.wrap_ms += (perf_counter() - start) * 1000
+                stats.wrap_calls += 1
+                stats._depth -= 1
+
+        def timed_split(available_width, available_height):
+            if stats._depth:
+                return split(available_width, available_height)
+            stats._depth += 1
+            start = perf_counter()
+            try:
+                parts = split(available_width, available_height)
+            finally:
+                stats.split_ms += (perf_counter() - start) * 1000
+                stats.split_calls += 1
+                stats._depth -= 1
+            stats.split_parts += len(parts)
+            for part in parts:
+                if part is not flowable:
+                    self._instrument(part, stats)
+            return parts
+
+        def timed_draw_on(canvas, x, y, _sW=0):
+            page = canvas.getPageNumber()
+            if not stats.pages or stats.pages[-1] != page:
+                stats.pages.append(page)
+            stats._depth += 1
+            start = perf_counter()
+            try:
+                return draw_on(canvas, x, y, _sW)
+            finally:
+                stats.draw_ms += (perf_counter() - start) * 1000
+                stats.draw_calls += 1
+                stats._depth -= 1
+
+        flowable.wrap = timed_wrap
+        flowable.split = timed_split
+        flowable.drawOn = timed_draw_on
+        flowable._layout_stats = stats
+        self._patched.append(flowable)
+
+    def restore(self):
+        """移除安装的计时方法"""
+        for flowable in self._patched:
+            for name in _PATCHED:
+                flowable.__dict__.pop(name, None)
+        self._patched = []
+
+    def page_callback(self, callback: Callable) -> Callable:
+        """为页眉页脚回调计时"""
+        def timed(canvas, doc):
+            start = perf_counter()
+            try:
+                return callback(canvas, doc)
+            finally:
+                self.page_ms += (perf_counter() - start) * 1000
+                self.page_calls += 1
+        return timed
+
+    # ---- 报告 ----
+
+    @property
+    def other_ms(self) -> float:
+        """flowable 和页面回调之外的时间（帧布局、写出PDF）"""
+        return max(0.0, self.build_ms - sum(stats.total_ms for stats in self.elements) - self.page_ms)
+
+    def to_json(self) -> Dict:
+        return {
+            'build_ms': round(self.build_ms, 3),
+            'page_callbacks': {'calls': self.page_calls, 'ms': round(self.page_ms, 3)},
+            'other_ms': round(self.other_ms, 3),
+            'elements': [stats.to_json() for stats in self.elements]
+        }
+
+    def format(self, limit: Optional[int] = None) -> str:
+        """
+        文本报告，按总耗时从高到低排列
+
+        Args:
+            limit: 最多列出的 flowable 数
+        """
+        rows = sorted(self.elements, key=lambda stats: -stats.total_ms)
+        if limit:
+            rows = rows[:limit]
+        lines = [f"{'flowable':<32} {'total ms':>9} {'wrap':>5} {'ms':>8} {'split':>5} {'ms':>8} "
+                 f"{'draw':>5} {'ms':>8}  pages"]
+        for stats in rows:
+            pages = ','.join(str(page) for page in stats.pages)
+            lines.append(f"{stats.label[:32]:<32} {stats.total_ms:>9.2f} {stats.wrap_calls:>5} {stats.wrap_ms:>8.2f} "
+                         f"{stats.split_calls:>5} {stats.split_ms:>8.2f} {stats.draw_calls:>5} {stats.draw_ms:>8.2f}  "
+                         f"{pages}")
+        lines.append(f"{'(page header/footer)':<32} {self.page_ms:>9.2f} {'':>5} {'':>8} {'':>5} {'':>8} "
+                     f"{self.page_calls:>5}")
+        lines.append(f"{'(frames, PDF output)':<32} {self.other_ms:>9.2f}")
+        lines.append(f"{'build total':<32} {self.build_ms:>9.2f}")
+        return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """命令行：渲染一张发票并输出排版分析报告"""
+    from invoice_generator import create_invoice
+    from invoice_model import InvoiceData
+
+    parser = argparse.ArgumentParser(description='Per-flowable layout profile of one invoice')
+    parser.add_argument('invoice', help='invoice JSON (same fields as InvoiceData.from_json)')
+    parser.add_argument('--logo', help='logo image path')
+    parser.add_argument('--stamp', help='stamp image path')
+    parser.add_argument('--output', help='keep the rendered PDF at this path')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.invoice, 'r', encoding='utf-8') as f:
+        invoice = InvoiceData.from_json(json.load(f))
+    output = args.output or os.path.join(tempfile.mkdtemp(prefix='layout_profile_'), 'invoice.pdf')
+    profile = LayoutProfile()
+    # create_invoice 的进度输出不混入报告
+    with redirect_stdout(StringIO()):
+        create_invoice(output, invoice=invoice, logo_path=args.logo, stamp_path=args.stamp, layout_profile=profile)
+    if args.json:
+        print(json.dumps(profile.to_json(), indent=2))
+    else:
+        print(profile.format())
+    if not args.output:
+        os.remove(output)
+        os.rmdir(os.path.dirname(output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
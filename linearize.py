@@ -0,0 +1,81 @@
+"""
+线性化PDF（"快速 Web 查看"）- 大发票下载完第一页所需的部分即可开始显示
+
+- 线性化把第一页用到的对象和提示表（hint table）放在文件开头，配合 /download 的 Range 请求，
+  浏览器先显示第一页，其余页面边下载边显示
+- 渲染完成后、提交到存储之前改写文件，所有渲染后端（platypus、canvas、按页段并行）都适用
+- 依赖 pikepdf（可选），未安装时使用 PATH 中的 qpdf 命令；两者都没有时输出警告并保持原文件
+- 可复现模式下使用确定性的文件ID（qpdf --deterministic-id），相同输入仍得到逐字节相同的PDF
+"""
+from typing import Optional
+import os
+import shutil
+import subprocess
+import threading
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+# 判断是否已线性化时读取的文件开头字节数（线性化参数字典必须在文件的前 1024 字节内）
+LINEARIZED_HEADER_BYTES = 1024
+
+_warned = False
+
+
+def linearizer() -> Optional[str]:
+    """可用的线性化工具：'pikepdf'、'qpdf'，都不可用时返回 None"""
+    if pikepdf is not None:
+        return 'pikepdf'
+    if shutil.which('qpdf'):
+        return 'qpdf'
+    return None
+
+
+def is_linearized(path: str) -> bool:
+    """文件是否已线性化（检查开头的线性化参数字典）"""
+    with open(path, 'rb') as f:
+        return b'/Linearized' in f.read(LINEARIZED_HEADER_BYTES)
+
+
+def linearize_pdf(path: str, deterministic: bool = False) -> bool:
+    """
+    原地线性化PDF（写入同目录下的临时文件后原子地替换）
+
+    Args:
+        path: PDF文件路径
+        deterministic: 使用由内容计算的确定性文件ID
+
+    Returns:
+        是否已线性化（没有可用的线性化工具时返回 False，文件不变）
+
+    Raises:
+        RuntimeError: qpdf 处理失败
+    """
+    global _warned
+    tool = linearizer()
+    if tool is None:
+        if not _warned:
+            _warned = True
+            print("Warning: neither pikepdf nor qpdf is available, PDFs are not linearized")
+        return False
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.linearized"
+    try:
+        if tool == 'pikepdf':
+            with pikepdf.open(path) as pdf:
+                pdf.save(tmp_path, linearize=True, deterministic_id=deterministic)
+        else:
+            command = ['qpdf', '--linearize']
+            if deterministic:
+                command.append('--deterministic-id')
+            result = subprocess.run(command + [path, tmp_path], capture_output=True, text=True)
+            # 退出码 3 表示有警告但输出文件可用
+            if result.returncode not in (0, 3):
+                raise RuntimeError(f"qpdf --linearize failed: {result.stderr.strip()}")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
@@ -0,0 +1,524 @@
+"""
+压测工具 - 对运行中的服务回放录制的或合成的 /generate、/preview、/download 流量
+
+- 流量来源：JSON Lines 录制文件（--capture），或按 --mix 比例合成的表单（含 Logo/图章上传）
+- 并发与到达率：--concurrency 个客户端线程；--rate 大于0时按泊松到达的开环模式发送
+  （延迟从计划发送时间算起，包含排队时间），否则每个线程收到响应后立即发下一个请求（闭环）
+- 报告吞吐量、各端点 p50/p95/p99 延迟、错误率，以及（指定 --server-pid 时）各工作进程的 CPU 占用
+
+录制文件每行一个请求：
+
+    {"method": "POST", "path": "/generate", "form": {...}, "files": {"company_logo": "logo"}}
+    {"method": "POST", "path": "/preview", "json": {...}}
+    {"method": "GET", "path": "/download"}
+
+files 的值为 "logo" / "stamp"（使用合成图片）或图片文件路径；/download 不带文件名时
+下载本次压测中已生成的发票。缺少 path 的行会被跳过。
+
+示例：
+
+    python loadtest.py http://127.0.0.1:5000 --concurrency 8 --duration 60 --rate 20 \\
+        --server-pid $(cat gunicorn.pid)
+"""
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import argparse
+import http.client
+import json
+import math
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+from synthetic_images import synthetic_image
+
+DEFAULT_MIX = 'generate=6,preview=3,download=1'
+
+PRODUCT_NAMES = ('Stainless Steel Bolt', 'Hydraulic Pump Assembly', 'Copper Wire 2.5mm', 'LED Panel 600x600',
+                 'Industrial Bearing 6205', 'PVC Pipe DN50', 'Control Valve', 'Aluminium Profile 6063')
+
+
+def encode_multipart(form: Dict[str, str], files: Dict[str, Tuple[str, bytes]]) -> Tuple[bytes, str]:
+    """
+    编码 multipart/form-data 请求体
+
+    Args:
+        form: 表单字段
+        files: {字段名: (文件名, 内容)}
+
+    Returns:
+        (请求体, Content-Type)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in form.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode('utf-8'))
+        parts.append(str(value).encode('utf-8') + b'\r\n')
+    for name, (filename, data) in files.items():
+        content_type = 'image/png' if filename.lower().endswith('.png') else 'application/octet-stream'
+        parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                      f'Content-Type: {content_type}\r\n\r\n').encode('utf-8'))
+        parts.append(data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def synthetic_form(rng: random.Random, min_items: int, max_items: int) -> Dict[str, str]:
+    """生成一份 /generate 表单（字段与页面表单相同）"""
+    count = rng.randint(min_items, max_items)
+    form = {
+        'company_name': 'Load Test Trading Co., Ltd.',
+        'company_address': 'No. 88 Industrial Road, Shanghai, China',
+        'shipper_name': 'Load Test Shipper',
+        'shipper_address': 'Warehouse 3, Port Area',
+        'customer_name': f'Customer {rng.randrange(1000)}',
+        'customer_address': '221B Baker Street, London',
+        'invoice_number': f'LT-{uuid.uuid4().hex[:10]}',
+        'currency': rng.choice(('USD', 'EUR', 'CNY')),
+        'tax_rate': str(rng.choice((0, 6, 13))),
+        'notes': 'Generated by loadtest.py',
+        'item_count': str(count),
+    }
+    for i in range(count):
+        form[f'item_product_name_{i}'] = rng.choice(PRODUCT_NAMES)
+        form[f'item_product_number_{i}'] = f'P{rng.randrange(100000):05d}'
+        form[f'item_hs_code_{i}'] = rng.choice(('7318.15', '8413.60', '8544.49'))
+        form[f'item_quantity_{i}'] = str(rng.randint(1, 500))
+        form[f'item_unit_price_{i}'] = f'{rng.uniform(0.5, 300):.2f}'
+    return form
+
+
+class TrafficSource:
+    """按录制文件或合成比例产生请求描述"""
+
+    def __init__(self, capture: Optional[str] = None, mix: str = DEFAULT_MIX, items: Tuple[int, int] = (1, 30),
+                 logo_size: Tuple[int, int] = (600, 200), stamp_size: Tuple[int, int] = (400, 400),
+                 upload_ratio: float = 0.5, seed: Optional[int] = None):
+        """
+        Args:
+            capture: 录制文件路径（JSON Lines），为 None 时合成流量
+            mix: 合成流量的端点比例，如 generate=6,preview=3,download=1
+            items: 合成发票的项目数范围
+            logo_size / stamp_size: 合成图片尺寸
+            upload_ratio: 合成的 /generate 请求中带 Logo 和图章的比例
+            seed: 随机种子
+        """
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.items = items
+        self.upload_ratio = upload_ratio
+        self.images = {
+            'logo': ('logo.png', synthetic_image('logo', logo_size)),
+            'stamp': ('stamp.png', synthetic_image('stamp', stamp_size)),
+        }
+        self.records = []
+        self.position = 0
+        self.skipped = 0
+        if capture:
+            self._load(capture)
+        endpoints = []
+        for part in mix.split(','):
+            name, _, weight = part.partition('=')
+            endpoints.append((name.strip(), float(weight or 1)))
+        self.endpoints = [name for name, _ in endpoints]
+        self.weights = [weight for _, weight in endpoints]
+
+    def _load(self, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.skipped += 1
+                    continue
+                if not isinstance(record, dict) or not str(record.get('path', '')).startswith('/'):
+                    self.skipped += 1
+                    continue
+                self.records.append(record)
+        if not self.records:
+            raise ValueError(f'No replayable requests in {path} ({self.skipped} lines skipped)')
+
+    def _file(self, value) -> Tuple[str, bytes]:
+        if value in self.images:
+            return self.images[value]
+        with open(value, 'rb') as f:
+            return os.path.basename(value), f.read()
+
+    def next(self) -> Dict:
+        """下一个请求：{'endpoint', 'method', 'path', 'form', 'json', 'files'}"""
+        with self.lock:
+            if self.records:
+                record = self.records[self.position % len(self.records)]
+                self.position += 1
+                return {
+                    'endpoint': record['path'].split('/')[1] or 'index',
+                    'method': record.get('method', 'POST' if record.get('form') or record.get('json') else 'GET'),
+                    'path': record['path'],
+                    'form': record.get('form'),
+                    'json': record.get('json'),
+                    'files': {name: self._file(value) for name, value in (record.get('files') or {}).items()},
+                }
+            endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+            if endpoint == 'download':
+                return {'endpoint': 'download', 'method': 'GET', 'path': '/download'}
+            form = synthetic_form(self.rng, *self.items)
+            files = {}
+            if endpoint == 'generate' and self.rng.random() < self.upload_ratio:
+                files = {'company_logo': self.images['logo'], 'company_stamp': self.images['stamp']}
+            return {'endpoint': endpoint, 'method': 'POST', 'path': f'/{endpoint}', 'form': form, 'files': files}
+
+
+class Client:
+    """每个线程一个保持连接的 HTTP 客户端"""
+
+    def __init__(self, base_url: str, timeout: float):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]) -> Tuple[int, bytes]:
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self._connect()
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.conn.close()
+                    self.conn = None
+                return response.status, data
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # 服务端关闭了保持的连接，重连后重试一次
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        raise RuntimeError('unreachable')
+
+
+def read_cpu_seconds(pid: int) -> Optional[float]:
+    """读取 /proc/<pid>/stat 中进程的用户态 + 内核态 CPU 时间（秒）"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # ')' 之后第 12、13 个字段为 utime、stime（时钟周期）
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def worker_pids(server_pid: int) -> List[int]:
+    """服务主进程的子进程（gunicorn 工作进程）；没有子进程时返回主进程本身（python app.py）"""
+    children = []
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [server_pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == server_pid:
+            children.append(int(entry))
+    return sorted(children) or [server_pid]
+
+
+class CpuMonitor:
+    """统计压测期间各工作进程的 CPU 时间（工作进程被回收重启时按新进程单独统计）"""
+
+    def __init__(self, server_pid: Optional[int], interval: float = 1.0):
+        self.server_pid = server_pid
+        self.interval = interval
+        self.first = {}
+        self.last = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        for pid in worker_pids(self.server_pid):
+            seconds = read_cpu_seconds(pid)
+            if seconds is None:
+                continue
+            self.first.setdefault(pid, seconds)
+            self.last[pid] = seconds
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        if self.server_pid is None:
+            return
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[int, float]:
+        """停止采样，返回 {pid: CPU 秒数}"""
+        if self._thread is None:
+            return {}
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return {pid: self.last[pid] - self.first[pid] for pid in self.last}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近秩百分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LoadTest:
+    """发送请求并收集结果"""
+
+    def __init__(self, base_url: str, source: TrafficSource, concurrency: int = 4, rate: float = 0.0,
+                 duration: float = 30.0, requests: int = 0, timeout: float = 60.0):
+        """
+        Args:
+            base_url: 服务地址
+            source: 流量来源
+            concurrency: 客户端线程数
+            rate: 每秒到达的请求数（0 表示闭环）
+            duration: 压测时长（秒）
+            requests: 请求总数（大于0时优先于 duration）
+            timeout: 单个请求超时（秒）
+        """
+        self.base_url = base_url
+        self.source = source
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.total_requests = requests
+        self.timeout = timeout
+        self.results = []           # (endpoint, 状态码, 延迟秒数, 错误)
+        self.downloads = []         # 已生成可下载的文件名
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.deadline = 0.0
+
+    def _claim(self) -> bool:
+        with self.lock:
+            if self.total_requests > 0:
+                if self.sent >= self.total_requests:
+                    return False
+            elif time.monotonic() >= self.deadline:
+                return False
+            self.sent += 1
+            return True
+
+    def _build(self, spec: Dict) -> Tuple[str, str, str, Optional[bytes], Dict[str, str]]:
+        path = spec['path']
+        headers = {}
+        body = None
+        if spec['endpoint'] == 'download' and path.rstrip('/') == '/download':
+            with self.lock:
+                filename = random.choice(self.downloads) if self.downloads else None
+            if filename is None:
+                # 还没有生成过发票，先发一个生成请求
+                spec = dict(spec, endpoint='generate', method='POST', path='/generate',
+                            form=synthetic_form(random.Random(), 1, 5), files={})
+                return self._build(spec)
+            path = f'/download/{filename}'
+        if spec.get('json') is not None:
+            body = json.dumps(spec['json']).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif spec.get('form') is not None or spec.get('files'):
+            body, headers['Content-Type'] = encode_multipart(spec.get('form') or {}, spec.get('files') or {})
+        return spec['endpoint'], spec['method'], path, body, headers
+
+    def _send(self, client: Client, scheduled: float):
+        spec = self.source.next()
+        endpoint, method, path, body, headers = self._build(spec)
+        error = None
+        status = 0
+        try:
+            status, data = client.request(method, path, body, headers)
+            if endpoint == 'generate' and status == 200:
+                filename = json.loads(data).get('filename')
+                if filename:
+                    with self.lock:
+                        self.downloads.append(filename)
+            elif status >= 400:
+                error = data[:200].decode('utf-8', 'replace')
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        latency = time.monotonic() - scheduled
+        with self.lock:
+            self.results.append((endpoint, status, latency, error))
+
+    def _closed_loop(self):
+        client = Client(self.base_url, self.timeout)
+        while self._claim():
+            self._send(client, time.monotonic())
+
+    def _open_loop_worker(self, arrivals: queue.Queue):
+        client = Client(self.base_url, self.timeout)
+        while True:
+            scheduled = arrivals.get()
+            if scheduled is None:
+                return
+            self._send(client, scheduled)
+
+    def run(self) -> float:
+        """执行压测，返回实际耗时（秒）"""
+        started = time.monotonic()
+        self.deadline = started + self.duration
+        if self.rate > 0:
+            arrivals = queue.Queue()
+            threads = [threading.Thread(target=self._open_loop_worker, args=(arrivals,), daemon=True)
+                       for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            next_arrival = started
+            while self._claim():
+                delay = next_arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                arrivals.put(next_arrival)
+                next_arrival += random.expovariate(self.rate)
+            for _ in threads:
+                arrivals.put(None)
+        else:
+            threads = [threading.Thread(target=self._closed_loop, daemon=True) for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def report(self, elapsed: float, cpu: Dict[int, float]) -> Dict:
+        """汇总结果"""
+        by_endpoint = {}
+        for endpoint, status, latency, error in self.results:
+            by_endpoint.setdefault(endpoint, []).append((status, latency, error))
+
+        def summarize(rows):
+            latencies = sorted(latency for _, latency, _ in rows)
+            errors = [row for row in rows if row[2] is not None]
+            statuses = {}
+            for status, _, _ in rows:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            return {
+                'requests': len(rows),
+                'throughput_rps': round(len(rows) / elapsed, 2) if elapsed else 0.0,
+                'error_rate': round(len(errors) / len(rows), 4) if rows else 0.0,
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'max_ms': round(latencies[-1] * 1000, 1) if latencies else 0.0,
+                'statuses': statuses,
+                'sample_errors': sorted({error for _, _, error in errors})[:3],
+            }
+
+        all_rows = [row for rows in by_endpoint.values() for row in rows]
+        return {
+            'target': self.base_url,
+            'mode': f'open-loop {self.rate}/s' if self.rate > 0 else 'closed-loop',
+            'concurrency': self.concurrency,
+            'elapsed_s': round(elapsed, 2),
+            'total': summarize(all_rows),
+            'endpoints': {endpoint: summarize(rows) for endpoint, rows in sorted(by_endpoint.items())},
+            'worker_cpu': {
+                str(pid): {'cpu_s': round(seconds, 2), 'cpu_pct': round(seconds / elapsed * 100, 1)}
+                for pid, seconds in sorted(cpu.items())
+            },
+        }
+
+
+def print_report(report: Dict):
+    """以表格形式输出报告"""
+    print(f"Target: {report['target']}  mode: {report['mode']}  concurrency: {report['concurrency']}  "
+          f"elapsed: {report['elapsed_s']}s")
+    header = f"{'endpoint':<12}{'requests':>9}{'rps':>9}{'errors':>9}{'p50 ms':>10}{'p95 ms':>10}" \
+             f"{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    rows = list(report['endpoints'].items()) + [('TOTAL', report['total'])]
+    for endpoint, stats in rows:
+        print(f"{endpoint:<12}{stats['requests']:>9}{stats['throughput_rps']:>9}"
+              f"{stats['error_rate'] * 100:>8.1f}%{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    for endpoint, stats in rows:
+        for error in stats['sample_errors']:
+            print(f"  {endpoint} error: {error}")
+    if report['worker_cpu']:
+        print('Worker CPU:')
+        for pid, usage in report['worker_cpu'].items():
+            print(f"  pid {pid}: {usage['cpu_s']}s ({usage['cpu_pct']}% of one core)")
+        total_cpu = sum(usage['cpu_s'] for usage in report['worker_cpu'].values())
+        invoices = report['endpoints'].get('generate', {}).get('requests', 0)
+        if invoices:
+            print(f"  {total_cpu / invoices * 1000:.1f} CPU ms per /generate request (all endpoints included)")
+
+
+def _size(value: str) -> Tuple[int, int]:
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height or width)
+
+
+def _range(value: str) -> Tuple[int, int]:
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='Replay invoice traffic against a running server')
+    parser.add_argument('url', help='server base URL, e.g. http://127.0.0.1:5000')
+    parser.add_argument('--capture', help='JSON Lines file of recorded requests to replay')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'synthetic endpoint weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--items', type=_range, default=(1, 30), help='synthetic item count range (default: 1-30)')
+    parser.add_argument('--logo-size', type=_size, default=(600, 200))
+    parser.add_argument('--stamp-size', type=_size, default=(400, 400))
+    parser.add_argument('--upload-ratio', type=float, default=0.5,
+                        help='share of synthetic /generate requests with logo and stamp uploads')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.0, help='arrivals per second (default: closed loop)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--server-pid', type=int, help='gunicorn master (or app.py) PID for per-worker CPU')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', dest='json_output', help='also write the report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    source = TrafficSource(args.capture, args.mix, args.items, args.logo_size, args.stamp_size,
+                           args.upload_ratio, args.seed)
+    if source.skipped:
+        print(f"Skipped {source.skipped} lines without a replayable request in {args.capture}")
+    test = LoadTest(args.url, source, args.concurrency, args.rate, args.duration, args.requests, args.timeout)
+    monitor = CpuMonitor(args.server_pid)
+    monitor.start()
+    elapsed = test.run()
+    report = test.report(elapsed, monitor.stop())
+    print_report(report)
+    if args.json_output:
+        with open(args.json_output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['total']['requests'] == 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,171 @@
+"""
+渲染内存管理 - 渲染前的内存预估、渲染中的峰值采样和工作进程 RSS 查询
+"""
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+import os
+import random
+import threading
+import tracemalloc
+
+from PIL import Image as PILImage
+
+from invoice_model import ItemTable
+
+# 预估系数，按渲染后端区分（tracemalloc 实测整次 create_invoice 的峰值后线性拟合，取整留出余量）：
+# 1000~12000 行、每行 40~140 个字符时，platypus 每行约 6.0KB、每字符约 27 字节（单元格中只有商品名称
+# 是 Paragraph，其余为纯文本及其换行结果）；canvas 不创建 flowable，每行约 2.3KB、每字符约 9 字节。
+# 按页段并行渲染时请求进程只保留排版规划和合并结果，峰值约为 platypus 的 1/3，按 platypus 估计偏保守。
+# 默认 512MB 预算下，每行 40 个字符的发票 platypus 约 6.5 万行、canvas 约 16 万行以内可以渲染
+ROW_BASE_BYTES = {'platypus': 6656, 'canvas': 2560}
+BYTES_PER_CHAR = {'platypus': 28, 'canvas': 12}
+# 图片在 ReportLab 中以解码后的 RGBA 像素保存
+BYTES_PER_PIXEL = 4
+# 页眉、各信息块、页脚等固定开销
+DOCUMENT_BASE_BYTES = 2 * 1024 * 1024
+
+ITEM_TEXT_FIELDS = ('product_name', 'product_number', 'item_number', 'hs_code', 'description')
+
+_tracemalloc_lock = threading.Lock()
+
+
+class MemoryBudgetExceeded(Exception):
+    """渲染前预估的内存开销超过预算"""
+
+    def __init__(self, estimated: int, budget: int):
+        self.estimated = estimated
+        self.budget = budget
+        super().__init__(
+            f'Invoice is too large to render: estimated memory {estimated / 1024 / 1024:.1f}MB '
+            f'exceeds budget {budget / 1024 / 1024:.1f}MB'
+        )
+
+
+def image_pixel_count(path: Optional[str]) -> int:
+    """
+    读取图片像素数（只解析文件头，不解码像素数据）
+
+    Args:
+        path: 图片路径
+
+    Returns:
+        宽 × 高，无法读取时返回 0
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    try:
+        with PILImage.open(path) as img:
+            width, height = img.size
+        return width * height
+    except Exception:
+        return 0
+
+
+def estimate_render_memory(items: Iterable[Dict], image_paths: Iterable[Optional[str]] = (),
+                           backend: str = 'platypus') -> int:
+    """
+    根据输入规模预估一次渲染的内存开销
+
+    Args:
+        items: 发票项目列表（字典列表或 ItemTable）
+        image_paths: Logo、图章等图片路径
+        backend: 渲染后端（'platypus' 或 'canvas'）
+
+    Returns:
+        预估字节数
+    """
+    row_bytes = ROW_BASE_BYTES.get(backend, ROW_BASE_BYTES['platypus'])
+    char_bytes = BYTES_PER_CHAR.get(backend, BYTES_PER_CHAR['platypus'])
+    total = DOCUMENT_BASE_BYTES
+    if isinstance(items, ItemTable):
+        total += len(items) * row_bytes + items.text_length() * char_bytes
+        items = ()
+    for item in items:
+        chars = 0
+        for field in ITEM_TEXT_FIELDS:
+            chars += len(item.get(field, '') or '')
+        total += row_bytes + chars * char_bytes
+    for path in image_paths:
+        total += image_pixel_count(path) * BYTES_PER_PIXEL
+    return total
+
+
+def check_memory_budget(items, image_paths: Iterable[Optional[str]], budget: int, backend: str = 'platypus') -> int:
+    """
+    检查输入的预估内存是否在预算内
+
+    Args:
+        items: 发票项目列表（字典列表或 ItemTable）
+        image_paths: 图片路径
+        budget: 预算字节数，0 或负数表示不限制
+        backend: 渲染后端（'platypus' 或 'canvas'）
+
+    Returns:
+        预估字节数
+
+    Raises:
+        MemoryBudgetExceeded: 超出预算
+    """
+    estimated = estimate_render_memory(items, image_paths, backend)
+    if budget > 0 and estimated > budget:
+        raise MemoryBudgetExceeded(estimated, budget)
+    return estimated
+
+
+@contextmanager
+def track_peak_memory(sample_rate: float = 0.0):
+    """
+    按采样率用 tracemalloc 记录一次渲染的峰值内存
+
+    tracemalloc 对分配有明显开销，因此只对部分渲染开启；tracemalloc 是进程级的，
+    同一时间只允许一个渲染被采样，其余渲染直接跳过。
+
+    Args:
+        sample_rate: 采样率（0~1）
+
+    Yields:
+        结果字典，采样时退出后包含 'peak_bytes'
+    """
+    stats = {}
+    sampled = (
+        sample_rate > 0
+        and random.random() < sample_rate
+        and not tracemalloc.is_tracing()
+        and _tracemalloc_lock.acquire(blocking=False)
+    )
+    if not sampled:
+        yield stats
+        return
+
+    try:
+        tracemalloc.start()
+        try:
+            yield stats
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats['peak_bytes'] = peak
+    finally:
+        _tracemalloc_lock.release()
+
+
+def current_rss() -> int:
+    """
+    获取当前进程的常驻内存（RSS）字节数
+
+    Linux 上读取 /proc/self/statm；其他平台退化为 resource 的峰值 RSS。
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        import sys
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 返回字节，Linux 返回 KB
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+    except Exception:
+        return 0
@@ -0,0 +1,174 @@
+"""
+页面模板 - 多页发票的页眉页脚，排版时由每页的回调绘制
+
+- 页脚：每页底部居中 "Page X of Y"
+- 续页页眉：第二页起顶部显示 "Invoice No.: ... (continued)" 和收货方名称
+- 总页数只排版一遍就能得到：页脚中的总页数画成一个 PDF form（XObject）的引用，
+  PageCountCanvas 在保存文件时才定义这个 form，此时总页数已知；所有页面共用同一个 form
+- 多份副本（ORIGINAL / DUPLICATE / TRIPLICATE ...）：CopiesCanvas 把排版得到的每一页保存为 form，
+  保存文件时为每份副本重放全部页面并加上副本标签，排版只做一次，每份副本每页只增加几十字节
+"""
+from typing import Optional
+
+from reportlab.lib import colors
+from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas as pdfcanvas
+
+# 与 InvoiceGenerator / CanvasInvoiceRenderer 的页边距一致
+LEFT_MARGIN = 1.0*cm
+TOP_MARGIN = 1.5*cm
+BOTTOM_MARGIN = 1.5*cm
+
+PAGE_FONT = 'Helvetica'
+PAGE_FONT_SIZE = 8
+
+# 总页数占位 form 的名称
+PAGE_COUNT_FORM = 'invoicePageCount'
+# 多份副本时各页内容 form 的名称前缀
+PAGE_FORM_PREFIX = 'invoicePage'
+
+COPY_LABEL_FONT = 'Helvetica-Bold'
+COPY_LABEL_FONT_SIZE = 10
+
+
+class PageCountCanvas(pdfcanvas.Canvas):
+    """在保存时补上总页数的 Canvas（用作 doc.build 的 canvasmaker）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.page_count_used = False
+
+    def draw_page_count(self, x: float, y: float):
+        """在 (x, y) 处绘制总页数（保存时才确定）"""
+        self.saveState()
+        self.translate(x, y)
+        self.doForm(PAGE_COUNT_FORM)
+        self.restoreState()
+        self.page_count_used = True
+
+    def page_count(self) -> int:
+        """总页数（保存时使用）"""
+        return self.getPageNumber() - 1
+
+    def save(self):
+        if self._code:
+            # 与 Canvas.save 相同：最后一页还没结束时先结束它，页数才完整
+            self.showPage()
+        if self.page_count_used:
+            self.beginForm(PAGE_COUNT_FORM)
+            self.setFont(PAGE_FONT, PAGE_FONT_SIZE)
+            self.drawString(0, 0, str(self.page_count()))
+            self.endForm()
+        super().save()
+
+
+class CopiesCanvas(PageCountCanvas):
+    """
+    一次排版输出多份副本的 Canvas
+
+    排版期间 showPage 不输出页面，而是把当前页的内容保存为 form；保存文件时按副本顺序
+    重放全部页面（每页一个 form 引用）并绘制副本标签。页脚中的 "Page X of Y" 是每份副本内的页码。
+    """
+
+    def __init__(self, *args, copies=(), **kwargs):
+        """
+        Args:
+            copies: 副本标签，如 ['ORIGINAL', 'DUPLICATE']（至少一个）
+        """
+        super().__init__(*args, **kwargs)
+        if not copies:
+            raise ValueError('At least one copy label is required')
+        self.copies = list(copies)
+        self._layout_pages = []
+        self._capturing = True
+
+    def showPage(self):
+        if not self._capturing:
+            super().showPage()
+            return
+        # 与 beginForm/endForm 相同的处理，只是内容取自已经画好的当前页
+        name = f'{PAGE_FORM_PREFIX}{len(self._layout_pages) + 1}'
+        self.push_state_stack()
+        self._formData = (name, 0, 0, None, None)
+        self.endForm()
+        self._layout_pages.append(name)
+        # 与 Canvas._startPage 相同：页码加一，下一页从初始图形状态开始
+        self._pageNumber += 1
+        self.init_graphics_state()
+        self.state_stack = []
+
+    def page_count(self) -> int:
+        return len(self._layout_pages)
+
+    def save(self):
+        if self._code:
+            self.showPage()
+        self._capturing = False
+        for label in self.copies:
+            for name in self._layout_pages:
+                self.doForm(name)
+                draw_copy_label(self, label)
+                self.showPage()
+        super().save()
+
+
+def draw_copy_label(canvas, label: str):
+    """在页脚右侧绘制带边框的副本标签"""
+    page_width, _ = canvas._pagesize
+    width = stringWidth(label, COPY_LABEL_FONT, COPY_LABEL_FONT_SIZE)
+    x = page_width - LEFT_MARGIN - width
+    y = BOTTOM_MARGIN / 2
+    canvas.saveState()
+    canvas.setFont(COPY_LABEL_FONT, COPY_LABEL_FONT_SIZE)
+    canvas.setFillColor(colors.black)
+    canvas.setStrokeColor(colors.black)
+    canvas.setLineWidth(0.8)
+    canvas.rect(x - 4, y - 3, width + 8, COPY_LABEL_FONT_SIZE + 4)
+    canvas.drawString(x, y, label)
+    canvas.restoreState()
+
+
+def _fit(text: str, width: float) -> str:
+    # 超出宽度时截断并加省略号
+    if stringWidth(text, PAGE_FONT, PAGE_FONT_SIZE) <= width:
+        return text
+    while text and stringWidth(text + '...', PAGE_FONT, PAGE_FONT_SIZE) > width:
+        text = text[:-1]
+    return text + '...'
+
+
+def draw_page_frame(canvas, page_number: int, invoice_number: str = '', consignee: str = '',
+                    total_pages: Optional[int] = None):
+    """
+    绘制一页的页脚和续页页眉
+
+    Args:
+        canvas: 当前页的 Canvas
+        page_number: 页码（从 1 开始）
+        invoice_number: 发票号
+        consignee: 收货方名称（显示在续页页眉右侧）
+        total_pages: 总页数；为 None 时由 PageCountCanvas 在保存时补上
+    """
+    page_width, page_height = canvas._pagesize
+    canvas.saveState()
+    canvas.setFont(PAGE_FONT, PAGE_FONT_SIZE)
+    y = BOTTOM_MARGIN / 2
+    if total_pages is not None:
+        canvas.drawCentredString(page_width / 2, y, f"Page {page_number} of {total_pages}")
+    else:
+        prefix = f"Page {page_number} of "
+        # 总页数的位数未知，按与当前页码相同的位数居中
+        width = stringWidth(prefix + str(page_number), PAGE_FONT, PAGE_FONT_SIZE)
+        x = (page_width - width) / 2
+        canvas.drawString(x, y, prefix)
+        canvas.draw_page_count(x + stringWidth(prefix, PAGE_FONT, PAGE_FONT_SIZE), y)
+
+    if page_number > 1:
+        y = page_height - TOP_MARGIN / 2
+        title = f"Invoice No.: {invoice_number} (continued)"
+        canvas.drawString(LEFT_MARGIN, y, title)
+        if consignee:
+            available = page_width - 2 * LEFT_MARGIN - stringWidth(title, PAGE_FONT, PAGE_FONT_SIZE) - 1*cm
+            canvas.drawRightString(page_width - LEFT_MARGIN, y, _fit(f"Consignee: {consignee}", available))
+    canvas.restoreState()
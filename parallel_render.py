@@ -0,0 +1,441 @@
+"""
+大发票并行分页渲染 - 预先计算分页位置，按页段在多个进程中并行渲染，再合并为一个PDF
+
+适用于几万行项目的发票：单次 doc.build 只能用一个CPU核心，而分页位置可以提前算出
+（行高与 Table 的计算方式一致），因此每个页段可以独立渲染：
+- 每页的项目表格单独成表并重复表头
+- 非最后一页底部显示 "Carried Forward"，续页顶部显示 "Brought Forward"，金额逐页累计
+- 页脚显示全局页码 "Page X of Y"，续页页眉显示发票号和收货方（见 page_template）
+
+合并依赖 pypdf（可选依赖），未安装时退化为普通的串行渲染。
+
+分页规划需要每一行的行高，逐行换行计算约占串行渲染时间的 1/4~1/3，因此也按行段在工作进程中计算，
+请求进程只根据返回的行高累加分页。每个进程（gunicorn 工作进程）只有一个进程池，大小为 jobs，
+第一次并行渲染时创建，之后的渲染（包括同一进程中并发的请求）复用，不再为每个请求启动新进程。
+工作进程用 spawn 启动（与 render_pool 相同）：请求进程是多线程的，fork 出的子进程可能继承
+其他线程正持有的锁（如 text_cache 的锁）而永久阻塞。
+
+实测（8000 行、每行 1~3 行商品名称、2 个工作进程，输出与在请求进程中规划时逐字节相同）：
+请求进程的 CPU 时间从 3.3~3.8s（其中逐行规划约 2.7s）降到约 0.6s（头尾排版、累加分页和 pypdf 合并）；
+串行渲染约 12.5s。测试机器只有一个核心，总耗时不变（12~15s）；多核上行高计算和页段渲染按进程数分摊，
+预计总耗时约为 0.6s + 12s / 进程数（未在多核机器上实测）。
+
+渲染被取消时（见 cancellation.py）主进程停止等待并放弃尚未开始的页段；正在渲染的页段
+在工作进程中只检查渲染期限（客户端断开无法传到工作进程，页段很小，很快就会结束）。
+"""
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+import multiprocessing
+import os
+import threading
+
+from reportlab.lib.units import cm
+from reportlab.platypus import PageBreak, Spacer, Table
+
+from cancellation import DISCONNECT_CHECK_INTERVAL, CancelToken, cancel_scope, check_cancelled, current_token
+from invoice_generator import InvoiceGenerator, ITEM_COL_WIDTHS
+from page_template import draw_page_frame
+from reproducible import pypdf_metadata
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+# 少于该行数时并行带来的进程开销不划算
+PARALLEL_MIN_ITEMS = 2000
+
+# platypus Frame 默认四周内边距
+FRAME_PADDING = 6
+
+# 分页时预留的安全余量（points），避免浮点误差导致表格被拆分
+PAGE_SAFETY_MARGIN = 2
+
+# 尾部内容（税费汇总、备注、图章）与最后一行之间的余量不足该值时，直接换到新页
+TAIL_SAFETY_MARGIN = 20
+
+# 本进程共享的进程池（见 _shared_executor）
+_executor = None
+_executor_workers = 0
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _shared_executor(jobs: int) -> ProcessPoolExecutor:
+    """
+    本进程共享的有界进程池：第一次使用时创建，进程数变化或 fork 之后重新创建
+
+    Args:
+        jobs: 工作进程数
+    """
+    global _executor, _executor_workers, _executor_pid
+    with _executor_lock:
+        if _executor is not None and (_executor_workers != jobs or _executor_pid != os.getpid()):
+            if _executor_pid == os.getpid():
+                # 已提交的任务照常完成，之后的渲染使用新的进程池
+                _executor.shutdown(wait=False)
+            _executor = None
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = jobs
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor):
+    """丢弃已损坏的进程池（工作进程异常退出），下一次渲染重新创建"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _stack_height(flowables: list, avail_width: float, avail_height: float) -> float:
+    """按 Frame 的排版规则（合并相邻的 spaceBefore/spaceAfter）计算一组 flowable 的总高度"""
+    used = 0
+    at_top = True
+    prev_after = 0
+    for flowable in flowables:
+        space = 0
+        if not at_top:
+            space = flowable.getSpaceBefore()
+            if getattr(flowable, '_SPACETRANSFER', False) or getattr(flowable, '_ZEROSIZE', False):
+                space = prev_after
+            space = max(space - prev_after, 0)
+        _, height = flowable.wrap(avail_width, avail_height - used - space)
+        after = flowable.getSpaceAfter()
+        step = space + height + after
+        if getattr(flowable, '_SPACETRANSFER', False):
+            after = prev_after
+        prev_after = after
+        if step:
+            at_top = False
+        used += step
+    return used
+
+
+def _table_row_heights(generator: InvoiceGenerator, rows: list, summary_rows: tuple = ()) -> List[float]:
+    """对少量行（表头、汇总行）直接建表计算行高"""
+    table = Table(rows, colWidths=ITEM_COL_WIDTHS)
+    table.setStyle(generator.items_table_style(len(rows) - 1, summary_rows))
+    table.wrap(sum(ITEM_COL_WIDTHS), 0xfffffff)
+    return table._rowHeights
+
+
+def _frame_size(generator: InvoiceGenerator) -> Tuple[float, float]:
+    doc = generator.doc
+    return doc.width - 2 * FRAME_PADDING, doc.height - 2 * FRAME_PADDING
+
+
+def _add_head_sections(generator: InvoiceGenerator, invoice: Dict):
+    """添加第一页的头部内容（与 create_invoice 的顺序一致）"""
+    generator.add_header(invoice['company_info'], invoice['invoice_info'], invoice.get('logo_path'))
+    generator.add_shipper_and_consignee(invoice['shipper_info'], invoice['customer_info'])
+    if invoice.get('shipping_info'):
+        generator.add_shipping_details(invoice['shipping_info'])
+    generator.add_items_title(invoice.get('product_description'))
+
+
+def _add_tail_sections(generator: InvoiceGenerator, invoice: Dict, subtotal: float, total_quantity: float):
+    """添加最后一页表格之后的内容"""
+    generator.add_total(subtotal, invoice.get('tax_rate', 0.0), invoice.get('discount', 0.0),
+                        total_quantity=total_quantity)
+    generator.add_footer(invoice.get('notes'), invoice.get('payment_info'), invoice.get('stamp_path'))
+
+
+def measure_rows(items, start: int = 1) -> List[float]:
+    """
+    计算一段项目行的行高（含上下内边距，与 InvoiceGenerator.build_item_row 一致）
+
+    Args:
+        items: 项目列表（字典列表或 ItemTable）
+        start: 第一行的序号
+    """
+    probe = InvoiceGenerator(os.devnull)
+    return [probe.measure_item_row(start + offset, item) for offset, item in enumerate(items)]
+
+
+def _measure_chunk(spec: Dict) -> List[float]:
+    """在工作进程中计算一个行段的行高（到达渲染期限时抛出 RenderCancelled）"""
+    # 每个任务设置自己的令牌：进程池是共享的，工作进程依次执行不同请求的任务
+    with cancel_scope(CancelToken(deadline=spec['deadline'])):
+        check_cancelled()
+        return measure_rows(spec['items'], spec['start'])
+
+
+def plan_pages(invoice: Dict, row_heights: Optional[List[float]] = None) -> Optional[Dict]:
+    """
+    预先计算分页：每页放哪些项目行，以及尾部内容是否需要单独换页
+
+    Args:
+        invoice: create_invoice 的参数字典
+        row_heights: 各项目行的行高（见 measure_rows），为 None 时在当前进程中逐行计算
+
+    Returns:
+        分页计划 {'pages': [(start, end), ...], 'tail_on_new_page': bool}，
+        其中 start/end 为 items 的切片下标；头部内容过高无法规划时返回 None
+    """
+    items = invoice['items']
+    probe = InvoiceGenerator(os.devnull)
+    probe.currency = invoice.get('currency', 'CNY').upper()
+    avail_width, frame_height = _frame_size(probe)
+
+    # 第一页头部占用的高度
+    _add_head_sections(probe, invoice)
+    head_height = _stack_height(probe.story, avail_width, frame_height)
+
+    # 表头、承前/过次页、总计行的高度
+    header_h, brought_h, carried_h = _table_row_heights(probe, [
+        probe.items_header_row(),
+        probe.items_summary_row('Brought Forward', 1, 1),
+        probe.items_summary_row('Carried Forward', 1, 1),
+    ], summary_rows=(1,))
+
+    # 最后一页表格之后的内容高度（表格后的间距 + 税费汇总 + 页脚）
+    probe.story = [Spacer(1, 0.3*cm)]
+    _add_tail_sections(probe, invoice, 0.0, 0.0)
+    # 没有税费汇总和页脚时尾部只有间距，不会画出内容，也就不会产生新的一页
+    has_tail = len(probe.story) > 1
+    tail_height = _stack_height(probe.story, avail_width, frame_height)
+
+    pages = []
+    start = 0
+    available = frame_height - head_height - header_h - PAGE_SAFETY_MARGIN
+    if available < carried_h:
+        return None
+    if row_heights is None:
+        row_heights = measure_rows(items)
+    used = 0
+    for i, row_h in enumerate(row_heights):
+        # 每页底部预留一行汇总行（过次页或总计）
+        if used + row_h + carried_h > available and i > start:
+            pages.append((start, i))
+            start = i
+            available = frame_height - header_h - brought_h - PAGE_SAFETY_MARGIN
+            used = 0
+        used += row_h
+    pages.append((start, len(items)))
+
+    tail_on_new_page = has_tail and available - used - carried_h < tail_height + TAIL_SAFETY_MARGIN
+    return {'pages': pages, 'tail_on_new_page': tail_on_new_page}
+
+
+def _render_chunk(spec: Dict) -> Tuple[str, int]:
+    """
+    在工作进程中渲染一个页段（到达渲染期限时抛出 RenderCancelled）
+
+    Args:
+        spec: 页段描述（见 create_invoice_parallel）
+
+    Returns:
+        (部分PDF路径, 实际页数)
+    """
+    # 每个任务设置自己的令牌：进程池是共享的，工作进程依次执行不同请求的任务
+    with cancel_scope(CancelToken(deadline=spec['deadline'])):
+        return _build_chunk(spec)
+
+
+def _build_chunk(spec: Dict) -> Tuple[str, int]:
+    invoice = spec['invoice']
+    generator = InvoiceGenerator(spec['path'], document_info=spec['document_info'])
+    generator.currency = invoice.get('currency', 'CNY').upper()
+    if spec['document_info']:
+        # 可复现模式下图片按内容命名
+        generator.keep_image(invoice.get('logo_path'))
+        generator.keep_image(invoice.get('stamp_path'))
+
+    if spec['first']:
+        _add_head_sections(generator, invoice)
+
+    for page_idx, page in enumerate(spec['pages']):
+        if page_idx > 0:
+            generator.story.append(PageBreak())
+
+        rows = [generator.items_header_row()]
+        row_heights = [None]
+        summary_rows = ()
+        if page['brought'] is not None:
+            rows.append(generator.items_summary_row('Brought Forward', *page['brought']))
+            row_heights.append(None)
+            summary_rows = (1,)
+        for offset, item in enumerate(page['items']):
+            row, row_height = generator.build_item_row(page['start'] + offset, item)
+            rows.append(row)
+            row_heights.append(row_height)
+        if page['total'] is not None:
+            rows.append(generator.items_summary_row('TOTAL', *page['total']))
+        else:
+            rows.append(generator.items_summary_row('Carried Forward', *page['carried']))
+        row_heights.append(None)
+
+        table = Table(rows, colWidths=ITEM_COL_WIDTHS, rowHeights=row_heights)
+        table.setStyle(generator.items_table_style(len(rows) - 1, summary_rows))
+        generator.story.append(table)
+
+    if spec['last']:
+        if spec['tail_on_new_page']:
+            generator.story.append(PageBreak())
+        else:
+            generator.story.append(Spacer(1, 0.3*cm))
+        total_quantity, subtotal = spec['pages'][-1]['total']
+        _add_tail_sections(generator, invoice, subtotal, total_quantity)
+
+    page_offset = spec['page_offset']
+    total_pages = spec['total_pages']
+    invoice_number = invoice['invoice_info'].get('number', '') or ''
+    consignee = (invoice.get('customer_info') or {}).get('name', '') or ''
+
+    def on_page(canvas, doc):
+        # 页段在规划时已知总页数，直接写出
+        draw_page_frame(canvas, page_offset + canvas.getPageNumber(), invoice_number, consignee,
+                        total_pages=total_pages)
+
+    generator.doc.build(generator.story, onFirstPage=on_page, onLaterPages=on_page)
+    return spec['path'], generator.doc.page
+
+
+def _wait_chunks(futures: List) -> list:
+    """
+    按顺序返回各段的结果；等待期间检查取消，取消或出错时放弃尚未开始的段，
+    并等正在执行的段结束（进程池是共享的，之后才能清理它们写出的部分文件）
+
+    Raises:
+        RenderCancelled: 渲染已取消
+    """
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=DISCONNECT_CHECK_INTERVAL, return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+            check_cancelled()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        raise
+    return [future.result() for future in futures]
+
+
+def _measure_parallel(executor: ProcessPoolExecutor, items, jobs: int, deadline: Optional[float]) -> List[float]:
+    """按行段在工作进程中计算全部项目行的行高"""
+    chunk_size = -(-len(items) // max(1, jobs * 2))
+    futures = [executor.submit(_measure_chunk, {'items': items[start:start + chunk_size], 'start': start + 1,
+                                                'deadline': deadline})
+               for start in range(0, len(items), chunk_size)]
+    row_heights = []
+    for heights in _wait_chunks(futures):
+        row_heights.extend(heights)
+    return row_heights
+
+
+def create_invoice_parallel(output_path: str, jobs: Optional[int] = None,
+                            document_info: Optional[Dict[str, str]] = None, **invoice) -> str:
+    """
+    并行渲染大发票
+
+    Args:
+        output_path: 输出PDF文件路径
+        jobs: 工作进程数（默认使用全部CPU核心）
+        document_info: PDF文档信息（见 reproducible.document_info），提供时输出可复现
+        **invoice: 与 create_invoice 相同的发票参数
+
+    Returns:
+        生成的PDF文件路径
+    """
+    from invoice_generator import create_invoice
+
+    jobs = jobs or os.cpu_count() or 1
+    items = invoice['items']
+    if PdfWriter is None:
+        print("Warning: pypdf is not installed, falling back to serial rendering")
+        return create_invoice(output_path, deterministic=document_info is not None, **invoice)
+
+    executor = _shared_executor(jobs)
+    token = current_token()
+    deadline = token.deadline if token is not None else None
+    try:
+        plan = plan_pages(invoice, _measure_parallel(executor, items, jobs, deadline))
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise RuntimeError('Parallel render process exited unexpectedly')
+    if plan is None:
+        return create_invoice(output_path, deterministic=document_info is not None, **invoice)
+
+    # 逐页累计数量和金额
+    page_specs = []
+    running_quantity = 0
+    running_amount = 0
+    pages = plan['pages']
+    for page_idx, (start, end) in enumerate(pages):
+        brought = (running_quantity, running_amount) if page_idx > 0 else None
+        for item in items[start:end]:
+            _, _, _, _, quantity, _, amount = InvoiceGenerator.item_values(item)
+            running_quantity += quantity
+            running_amount += amount
+        is_last = page_idx == len(pages) - 1
+        page_specs.append({
+            'start': start + 1,
+            'items': items[start:end],
+            'brought': brought,
+            'carried': None if is_last else (running_quantity, running_amount),
+            'total': (running_quantity, running_amount) if is_last else None,
+        })
+
+    total_pages = len(pages) + (1 if plan['tail_on_new_page'] else 0)
+
+    # 将页面分成连续的页段，页段数为进程数的两倍以平衡负载
+    chunk_count = max(1, min(len(page_specs), jobs * 2))
+    chunk_size = -(-len(page_specs) // chunk_count)
+    # 页段只携带渲染需要的字段，避免把全部 items 发送给每个进程
+    shared = {key: value for key, value in invoice.items() if key != 'items'}
+    part_prefix = f"{output_path}.{os.getpid()}.{threading.get_ident()}"
+    specs = []
+    for chunk_idx, page_start in enumerate(range(0, len(page_specs), chunk_size)):
+        chunk_pages = page_specs[page_start:page_start + chunk_size]
+        specs.append({
+            'path': f"{part_prefix}.part{chunk_idx}.pdf",
+            'invoice': shared,
+            'pages': chunk_pages,
+            'first': page_start == 0,
+            'last': page_start + chunk_size >= len(page_specs),
+            'tail_on_new_page': plan['tail_on_new_page'],
+            'page_offset': page_start,
+            'total_pages': total_pages,
+            'document_info': document_info,
+            'deadline': deadline,
+        })
+
+    expected_pages = [len(spec['pages']) + (1 if spec['last'] and plan['tail_on_new_page'] else 0)
+                      for spec in specs]
+    part_paths = [spec['path'] for spec in specs]
+    tmp_path = f"{part_prefix}.tmp"
+    try:
+        try:
+            results = _wait_chunks([executor.submit(_render_chunk, spec) for spec in specs])
+        except BrokenProcessPool:
+            _discard_executor(executor)
+            raise RuntimeError('Parallel render process exited unexpectedly')
+
+        # 页数与计划不一致时页码会出错，此时退回串行渲染
+        if [page_count for _, page_count in results] != expected_pages:
+            print("Warning: parallel page plan mismatch, falling back to serial rendering")
+            return create_invoice(output_path, deterministic=document_info is not None, **invoice)
+
+        writer = PdfWriter()
+        for path in part_paths:
+            writer.append(path)
+        if document_info:
+            writer.add_metadata(pypdf_metadata(document_info))
+        with open(tmp_path, 'wb') as f:
+            writer.write(f)
+        os.replace(tmp_path, output_path)
+    finally:
+        for path in part_paths + [tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    print(f"发票已成功生成: {output_path}（{len(specs)} 个页段并行渲染，共 {total_pages} 页）")
+    return output_path
@@ -0,0 +1,347 @@
+"""
+线上采样分析 - 不需要附加调试器，即可得到生产工作进程处理请求时的调用栈
+
+- 统计采样：后台线程按固定间隔读取 sys._current_frames()，只记录正在处理请求的线程；
+  结果为折叠栈格式（每行 "栈帧;栈帧;... 次数"），flamegraph.pl、speedscope 等可直接生成火焰图
+- 采样窗口：GET /debug/profile?seconds=N 在共享目录中写入控制文件，同一台机器上的所有工作进程
+  在 0.5 秒内开始采样，窗口结束后各自写出结果，由处理该请求的进程合并返回
+- 单个请求：带 X-Profile-Request 请求头（值为令牌）的请求从开始到结束单独以更高频率采样，
+  响应头 X-Profile-Result 给出读取结果的地址
+- 未采样时只有一个每 0.5 秒检查一次控制文件修改时间的后台线程，请求路径上只多一次集合操作
+
+目录结构：
+
+    <root>/window.json                 当前（或上一次）采样窗口
+    <root>/<window_id>/<pid>.folded     各工作进程的窗口采样结果（合并后删除）
+    <root>/requests/<result_id>.folded 单个请求的采样结果（保留 REQUEST_PROFILE_TTL 秒）
+"""
+from collections import Counter
+from typing import Callable, Dict, Iterable, Optional, Tuple
+import hmac
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+CONTROL_FILE = 'window.json'
+# 工作进程检查控制文件的间隔（秒）
+WATCH_INTERVAL = 0.5
+# 单个请求采样的间隔（秒）
+REQUEST_SAMPLE_INTERVAL = 0.002
+# 单个请求的采样结果保留时间（秒）
+REQUEST_PROFILE_TTL = 3600
+# 每个栈最多记录的帧数（超出的部分从根部截断）
+MAX_STACK_DEPTH = 128
+
+# 不采样的端点（静态资源、健康检查和采样接口本身）
+UNPROFILED_ENDPOINTS = {'static', 'asset', 'health_check', 'debug_profile', 'debug_request_profile', None}
+
+_RESULT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def collapse_frame(frame) -> str:
+    """把一个线程的当前栈转换为折叠格式（根在前，每帧为 文件名:函数名）"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def focus_stacks(counts: Dict[str, int], function: str) -> Counter:
+    """
+    只保留经过指定函数的栈，并去掉该函数之上的帧（如 generate_invoice 只看发票生成路径）
+
+    Args:
+        counts: {折叠栈: 次数}
+        function: 函数名
+    """
+    focused = Counter()
+    for stack, count in counts.items():
+        frames = stack.split(';')
+        for index, frame in enumerate(frames):
+            if frame.rsplit(':', 1)[-1] == function:
+                focused[';'.join(frames[index:])] += count
+                break
+    return focused
+
+
+def format_collapsed(counts: Dict[str, int]) -> str:
+    """折叠栈文本，按次数从多到少排列"""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items(), key=lambda kv: -kv[1]))
+
+
+def parse_collapsed(text: str) -> Counter:
+    """format_collapsed 的逆操作"""
+    counts = Counter()
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+class StackSampler(threading.Thread):
+    """按固定间隔采样一组线程的调用栈"""
+
+    def __init__(self, targets: Callable[[], Iterable[int]], interval: float, until: Optional[float] = None):
+        """
+        Args:
+            targets: 返回要采样的线程ID
+            interval: 采样间隔（秒）
+            until: 结束时间（time.time()），为 None 时直到调用 stop
+        """
+        super().__init__(name='stack-sampler', daemon=True)
+        self.targets = targets
+        self.interval = interval
+        self.until = until
+        self.counts = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if self.until is not None and time.time() >= self.until:
+                break
+            frames = sys._current_frames()
+            for ident in self.targets():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.counts[collapse_frame(frame)] += 1
+            self.samples += 1
+            del frames
+
+    def stop(self) -> Counter:
+        """停止采样并返回结果"""
+        self._stop_event.set()
+        self.join()
+        return self.counts
+
+
+class Profiler:
+    """一个工作进程内的采样分析器（各工作进程通过共享目录协调）"""
+
+    def __init__(self, directory: str, token: str, interval_ms: float = 10.0, max_seconds: float = 20.0):
+        """
+        Args:
+            directory: 共享目录（同一台机器上的工作进程使用同一个目录）
+            token: 访问令牌
+            interval_ms: 采样窗口内的采样间隔（毫秒）
+            max_seconds: 采样窗口的最长时间（应小于工作进程的请求超时）
+        """
+        if not token:
+            raise ValueError('Profiler token must not be empty')
+        self.directory = os.path.abspath(directory)
+        self.token = token
+        self.interval = interval_ms / 1000.0
+        self.max_seconds = max_seconds
+        self.control_path = os.path.join(self.directory, CONTROL_FILE)
+        os.makedirs(os.path.join(self.directory, 'requests'), exist_ok=True)
+        self._active = set()  # 正在处理请求的线程
+        self._lock = threading.Lock()
+        self._watcher_pid = None
+
+    def check_token(self, provided: Optional[str]) -> bool:
+        """检查访问令牌（常量时间比较）"""
+        return bool(provided) and hmac.compare_digest(provided.encode('utf-8'), self.token.encode('utf-8'))
+
+    # ---- 请求线程 ----
+
+    def request_started(self):
+        """当前线程开始处理请求"""
+        if self._watcher_pid != os.getpid():
+            # 线程不会随 fork 复制，每个工作进程在第一个请求时启动自己的检查线程
+            self._start_watcher()
+        with self._lock:
+            self._active.add(threading.get_ident())
+
+    def request_finished(self):
+        """当前线程的请求处理结束"""
+        with self._lock:
+            self._active.discard(threading.get_ident())
+
+    def _active_threads(self):
+        with self._lock:
+            return list(self._active)
+
+    # ---- 采样窗口 ----
+
+    def _start_watcher(self):
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name='profile-watcher', daemon=True).start()
+
+    def _watch(self):
+        # 检查控制文件，有新的未结束窗口时在本线程内采样到窗口结束
+        last_mtime = None
+        done = set()
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            try:
+                mtime = os.stat(self.control_path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            try:
+                with open(self.control_path, 'r', encoding='utf-8') as f:
+                    window = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if window['id'] in done or window['until'] <= time.time():
+                continue
+            done.add(window['id'])
+            try:
+                self._sample_window(window)
+            except Exception as e:
+                print(f"Warning: profile window {window['id']} failed: {e}")
+
+    def _sample_window(self, window: Dict):
+        sampler = StackSampler(self._active_threads, window['interval'], until=window['until'])
+        sampler.run()
+        result_dir = os.path.join(self.directory, window['id'])
+        os.makedirs(result_dir, exist_ok=True)
+        header = f"# samples={sampler.samples}\n"
+        _write_atomic(os.path.join(result_dir, f'{os.getpid()}.folded'), header + format_collapsed(sampler.counts))
+
+    def start_window(self, seconds: float) -> Dict:
+        """
+        开始一个采样窗口（本机所有工作进程）
+
+        Args:
+            seconds: 窗口长度，超过 max_seconds 时截断
+
+        Returns:
+            窗口 {'id', 'until', 'interval'}
+        """
+        seconds = min(max(seconds, WATCH_INTERVAL), self.max_seconds)
+        # 窗口从所有工作进程都能看到控制文件之后开始
+        window = {'id': uuid.uuid4().hex, 'until': time.time() + WATCH_INTERVAL + seconds, 'interval': self.interval}
+        _write_atomic(self.control_path, json.dumps(window))
+        return window
+
+    def collect_window(self, window: Dict) -> Tuple[Counter, int, int]:
+        """
+        等待窗口结束并合并各工作进程的结果
+
+        Returns:
+            (合并后的折叠栈计数, 工作进程数, 采样次数)
+        """
+        time.sleep(max(0.0, window['until'] - time.time()) + WATCH_INTERVAL + 0.5)
+        result_dir = os.path.join(self.directory, window['id'])
+        counts = Counter()
+        workers = samples = 0
+        try:
+            names = os.listdir(result_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.folded'):
+                continue
+            with open(os.path.join(result_dir, name), 'r', encoding='utf-8') as f:
+                text = f.read()
+            match = re.match(r'# samples=(\d+)', text)
+            samples += int(match.group(1)) if match else 0
+            counts.update(parse_collapsed(text))
+            workers += 1
+        shutil.rmtree(result_dir, ignore_errors=True)
+        return counts, workers, samples
+
+    # ---- 单个请求 ----
+
+    def start_request_profile(self) -> StackSampler:
+        """开始采样当前线程（当前请求）"""
+        ident = threading.get_ident()
+        sampler = StackSampler(lambda: (ident,), REQUEST_SAMPLE_INTERVAL)
+        sampler.start()
+        return sampler
+
+    def finish_request_profile(self, sampler: StackSampler) -> str:
+        """
+        停止采样并保存结果
+
+        Returns:
+            结果ID（用于 read_request_profile）
+        """
+        counts = sampler.stop()
+        result_id = uuid.uuid4().hex
+        requests_dir = os.path.join(self.directory, 'requests')
+        _write_atomic(os.path.join(requests_dir, f'{result_id}.folded'), format_collapsed(counts))
+        # 顺便清理过期的结果
+        expired = time.time() - REQUEST_PROFILE_TTL
+        for name in os.listdir(requests_dir):
+            path = os.path.join(requests_dir, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+        return result_id
+
+    def read_request_profile(self, result_id: str) -> Optional[Counter]:
+        """读取单个请求的采样结果，不存在时返回 None"""
+        if not _RESULT_ID_PATTERN.match(result_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, 'requests', f'{result_id}.folded'), 'r', encoding='utf-8') as f:
+                return parse_collapsed(f.read())
+        except OSError:
+            return None
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def init_profiler(app, profiler: Profiler) -> Profiler:
+    """
+    为 Flask 应用开启采样分析（记录正在处理请求的线程，支持单个请求采样）
+
+    Args:
+        app: Flask 应用
+        profiler: 采样分析器
+
+    Returns:
+        采样分析器
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _profile_request():
+        if request.endpoint in UNPROFILED_ENDPOINTS or request.method == 'OPTIONS':
+            return
+        profiler.request_started()
+        g.profiled = True
+        if profiler.check_token(request.headers.get('X-Profile-Request')):
+            g.profile_sampler = profiler.start_request_profile()
+
+    @app.after_request
+    def _profile_result(response):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            result_id = profiler.finish_request_profile(sampler)
+            response.headers['X-Profile-Result'] = f'/debug/profile/requests/{result_id}'
+        return response
+
+    @app.teardown_request
+    def _profile_finished(exc):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            # 请求出错时 after_request 不会执行
+            sampler.stop()
+        if g.pop('profiled', False):
+            profiler.request_finished()
+
+    return profiler
@@ -0,0 +1,352 @@
+"""
+公司档案 - 开票方信息、支付信息和 Logo/图章保存在服务端，/generate 用 profile_id 引用
+
+- 档案保存公司信息、发货方信息、支付信息和货币；请求中非空的字段覆盖档案中的值
+- Logo 和图章在保存档案时规范化一次：按发票上的显示尺寸（300 DPI）缩小、校正方向；
+  不透明图片保存为 JPEG（ReportLab 直接嵌入 JPEG 数据，渲染时不需要解码和重新压缩），
+  带透明通道的保存为 PNG
+- 每个档案一个目录，多个工作进程共享；进程内按 profile.json 的修改时间缓存解析结果
+- 更新和删除档案时持有该档案的文件锁（fcntl.flock，Windows 上退化为进程内锁），
+  并发的更新不会互相覆盖
+- 被替换的 Logo/图章不立即删除（正在渲染或排队的发票可能还引用旧文件），
+  profile.json 写入超过 REPLACED_IMAGE_MAX_AGE 秒后由 purge 回收
+
+目录结构：
+
+    <root>/<profile_id>/profile.json
+    <root>/<profile_id>/.lock
+    <root>/<profile_id>/logo-<sha256[:12]>.jpg|png
+    <root>/<profile_id>/stamp-<sha256[:12]>.jpg|png
+"""
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from PIL import Image as PILImage, ImageOps
+
+from invoice_model import COMPANY_FIELDS, PAYMENT_FIELDS, SHIPPER_FIELDS, InvoiceData, _section
+
+# 图片在发票上的显示尺寸（cm，见 InvoiceGenerator.add_header / add_footer）
+IMAGE_DISPLAY_CM = {'logo': 3.0, 'stamp': 2.5}
+# 规范化后的分辨率
+IMAGE_DPI = 300
+JPEG_QUALITY = 95
+# 被替换的图片保留时间（秒）：覆盖渲染超时和渲染队列中任务的等待时间
+REPLACED_IMAGE_MAX_AGE = 24 * 3600
+
+_PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ProfileNotFound(Exception):
+    """档案不存在"""
+
+
+def check_profile_id(profile_id: str) -> str:
+    """
+    检查档案ID格式（防止路径遍历）
+
+    Raises:
+        ProfileNotFound: 格式不合法
+    """
+    if not isinstance(profile_id, str) or not _PROFILE_ID_PATTERN.match(profile_id):
+        raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+    return profile_id
+
+
+def normalize_image(data: bytes, kind: str) -> Tuple[bytes, str, int]:
+    """
+    把上传的图片规范化为渲染使用的格式
+
+    Args:
+        data: 原始图片内容
+        kind: 'logo' 或 'stamp'（决定显示尺寸）
+
+    Returns:
+        (图片内容, 扩展名 'jpg'/'png', 像素数)
+
+    Raises:
+        ValueError: 无法解析图片
+    """
+    max_side = round(IMAGE_DISPLAY_CM[kind] / 2.54 * IMAGE_DPI)
+    try:
+        with PILImage.open(BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+            img.thumbnail((max_side, max_side), PILImage.LANCZOS)
+            if has_alpha and img.getextrema()[3][0] == 255:
+                # 透明通道全部不透明，按不透明图片处理
+                img = img.convert('RGB')
+                has_alpha = False
+            buf = BytesIO()
+            if has_alpha:
+                img.save(buf, 'PNG', optimize=True)
+            else:
+                img.save(buf, 'JPEG', quality=JPEG_QUALITY, subsampling=0)
+            width, height = img.size
+    except Exception as e:
+        raise ValueError(f'Invalid {kind} image: {e}')
+    return buf.getvalue(), 'png' if has_alpha else 'jpg', width * height
+
+
+class Profile:
+    """一个公司档案"""
+
+    __slots__ = ('profile_id', 'company_info', 'shipper_info', 'payment_info', 'currency',
+                 'logo_path', 'stamp_path', 'logo_pixels', 'stamp_pixels', 'revision')
+
+    def __init__(self, profile_id: str, directory: str, record: Dict, revision: str):
+        self.profile_id = profile_id
+        self.company_info = _section(record.get('company_info'), COMPANY_FIELDS)
+        self.shipper_info = _section(record.get('shipper_info'), SHIPPER_FIELDS)
+        payment_info = record.get('payment_info')
+        self.payment_info = _section(payment_info, PAYMENT_FIELDS) if payment_info else None
+        self.currency = record.get('currency') or None
+        self.logo_path = os.path.join(directory, record['logo']) if record.get('logo') else None
+        self.stamp_path = os.path.join(directory, record['stamp']) if record.get('stamp') else None
+        self.logo_pixels = record.get('logo_pixels', 0)
+        self.stamp_pixels = record.get('stamp_pixels', 0)
+        self.revision = revision
+
+    def to_json(self) -> Dict:
+        """档案内容（用于 GET /profiles/<id>）"""
+        return {
+            'profile_id': self.profile_id,
+            'company_info': self.company_info,
+            'shipper_info': self.shipper_info,
+            'payment_info': self.payment_info,
+            'currency': self.currency,
+            'has_logo': self.logo_path is not None,
+            'has_stamp': self.stamp_path is not None,
+            'revision': self.revision
+        }
+
+    def apply(self, invoice: InvoiceData, use_currency: bool = False) -> InvoiceData:
+        """
+        用档案补全发票数据：请求中为空的公司、发货方、支付字段取档案中的值
+
+        Args:
+            invoice: 请求的发票数据（就地修改）
+            use_currency: 使用档案中的货币（请求没有指定货币时）
+
+        Returns:
+            同一个发票数据
+        """
+        for attr in ('company_info', 'shipper_info'):
+            values = getattr(invoice, attr)
+            for field, value in getattr(self, attr).items():
+                if not values.get(field):
+                    values[field] = value
+        if self.payment_info:
+            if invoice.payment_info is None:
+                invoice.payment_info = dict(self.payment_info)
+            else:
+                for field, value in self.payment_info.items():
+                    if not invoice.payment_info.get(field):
+                        invoice.payment_info[field] = value
+        if self.currency and use_currency:
+            invoice.currency = self.currency
+        return invoice
+
+
+class ProfileStore:
+    """公司档案存储（本地目录）"""
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: 档案根目录
+        """
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._cache = {}  # profile_id -> (profile.json 修改时间, Profile)
+        self._lock = threading.Lock()
+        self._local_locks = {}
+        self._saves = 0
+
+    def _directory(self, profile_id: str) -> str:
+        return os.path.join(self.root, check_profile_id(profile_id))
+
+    @contextmanager
+    def _locked(self, profile_id: str):
+        """
+        对档案加跨进程排他锁（读取 profile.json 到写回之间持有）
+
+        Raises:
+            ProfileNotFound: 档案不存在
+        """
+        directory = self._directory(profile_id)
+        if fcntl is None:
+            with self._lock:
+                local_lock = self._local_locks.setdefault(profile_id, threading.Lock())
+            with local_lock:
+                yield directory
+            return
+
+        try:
+            lock_file = open(os.path.join(directory, '.lock'), 'a')
+        except OSError:
+            raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+        with lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield directory
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def get(self, profile_id: str) -> Profile:
+        """
+        读取档案
+
+        Raises:
+            ProfileNotFound: 档案不存在
+        """
+        directory = self._directory(profile_id)
+        record_path = os.path.join(directory, 'profile.json')
+        try:
+            mtime = os.stat(record_path).st_mtime_ns
+        except OSError:
+            raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+        with self._lock:
+            cached = self._cache.get(profile_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(record_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+        profile = Profile(profile_id, directory, json.loads(raw), hashlib.sha256(raw).hexdigest()[:16])
+        with self._lock:
+            self._cache[profile_id] = (mtime, profile)
+        return profile
+
+    def save(self, data: Dict, images: Dict[str, Optional[bytes]], profile_id: Optional[str] = None) -> Profile:
+        """
+        新建或更新档案
+
+        Args:
+            data: {'company_info', 'shipper_info', 'payment_info', 'currency'}；更新时缺少的键保留原值
+            images: {'logo': 原始图片内容, 'stamp': ...}；值为 None 的图片保留原值，b'' 表示删除
+            profile_id: 更新的档案ID，为 None 时新建
+
+        Returns:
+            保存后的档案
+
+        Raises:
+            ProfileNotFound: 更新的档案不存在
+            ValueError: 图片无法解析
+        """
+        if profile_id is None:
+            profile_id = uuid.uuid4().hex
+            os.makedirs(self._directory(profile_id))
+            with self._locked(profile_id) as directory:
+                self._write(directory, {}, data, images)
+        else:
+            with self._locked(profile_id) as directory:
+                try:
+                    with open(os.path.join(directory, 'profile.json'), 'r', encoding='utf-8') as f:
+                        record = json.load(f)
+                except OSError:
+                    raise ProfileNotFound(f'Company profile not found: {profile_id!r}')
+                self._write(directory, record, data, images)
+
+        # 偶尔回收一次被替换的图片，避免目录无限增长
+        self._saves += 1
+        if self._saves % 100 == 0:
+            self.purge()
+        return self.get(profile_id)
+
+    def _write(self, directory: str, record: Dict, data: Dict, images: Dict[str, Optional[bytes]]):
+        """合并更新内容并写回 profile.json（调用方持有档案锁）"""
+        for key, fields in (('company_info', COMPANY_FIELDS), ('shipper_info', SHIPPER_FIELDS)):
+            if key in data:
+                record[key] = _section(data[key], fields)
+        if 'payment_info' in data:
+            record['payment_info'] = _section(data['payment_info'], PAYMENT_FIELDS) if data['payment_info'] else None
+        if 'currency' in data:
+            record['currency'] = (data['currency'] or '').upper() or None
+
+        for kind in ('logo', 'stamp'):
+            content = images.get(kind)
+            if content is None:
+                continue
+            if content == b'':
+                record[kind] = None
+                record[f'{kind}_pixels'] = 0
+                continue
+            normalized, extension, pixels = normalize_image(content, kind)
+            filename = f'{kind}-{hashlib.sha256(normalized).hexdigest()[:12]}.{extension}'
+            _write_atomic(os.path.join(directory, filename), normalized)
+            record[kind] = filename
+            record[f'{kind}_pixels'] = pixels
+
+        _write_atomic(os.path.join(directory, 'profile.json'),
+                      json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+    def delete(self, profile_id: str) -> bool:
+        """删除档案，档案不存在时返回 False"""
+        try:
+            with self._locked(profile_id) as directory:
+                if not os.path.isfile(os.path.join(directory, 'profile.json')):
+                    return False
+                shutil.rmtree(directory, ignore_errors=True)
+        except ProfileNotFound:
+            return False
+        with self._lock:
+            self._cache.pop(profile_id, None)
+        return True
+
+    def purge(self, max_age: float = REPLACED_IMAGE_MAX_AGE) -> int:
+        """
+        删除被替换超过 max_age 秒的图片和遗留的临时文件
+
+        旧图片被替换的时间取 profile.json 的修改时间：之后开始的渲染只会读到新图片
+
+        Returns:
+            删除的文件数
+        """
+        removed = 0
+        cutoff = time.time() - max_age
+        for profile_id in os.listdir(self.root):
+            if not _PROFILE_ID_PATTERN.match(profile_id):
+                continue
+            try:
+                with self._locked(profile_id) as directory:
+                    record_path = os.path.join(directory, 'profile.json')
+                    if os.path.getmtime(record_path) >= cutoff:
+                        continue
+                    with open(record_path, 'r', encoding='utf-8') as f:
+                        record = json.load(f)
+                    keep = {'profile.json', '.lock', record.get('logo'), record.get('stamp')}
+                    for filename in os.listdir(directory):
+                        if filename in keep:
+                            continue
+                        try:
+                            os.remove(os.path.join(directory, filename))
+                            removed += 1
+                        except OSError:
+                            pass
+            except (ProfileNotFound, OSError, ValueError):
+                continue
+        return removed
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,148 @@
+"""
+渲染进程池 - 在固定数量的子进程中渲染发票并提交到存储（ASGI 部署使用，见 asgi.py）
+
+- 进程数固定，同时渲染的发票数不超过进程数，其余渲染排队等待空闲进程
+- 子进程以 spawn 方式启动，不继承事件循环和线程池的状态，也不导入 Web 应用；
+  每个子进程持有自己的分块缓存和段落缓存
+- 子进程直接提交到发票存储，/download 从同一个存储读取（因此需要跨进程共享的存储，不支持 memory://）
+- 子进程异常退出（如被 OOM killer 终止）时当前渲染失败，进程池自动重建
+- 取消（见 cancellation.py）：渲染期限随任务传给子进程；客户端断开通过 Manager 进程中的 Event 通知子进程，
+  子进程在下一个检查点停止。排队中还没开始的渲染直接取消
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+import multiprocessing
+import signal
+import threading
+
+from cancellation import DISCONNECT_CHECK_INTERVAL, CancelToken, RenderCancelled, cancel_scope
+
+# 子进程内的存储和缓存（由 _init_process 设置）
+_storage = None
+_section_cache = None
+
+
+def _init_process(storage_url: str, section_cache_entries: int, text_cache_entries: int):
+    # 由服务器主进程处理 Ctrl+C，子进程在进程池关闭时退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global _storage, _section_cache
+    from section_cache import SectionCache
+    from storage import open_storage
+    from text_cache import text_cache
+
+    _storage = open_storage(storage_url)
+    if section_cache_entries > 0:
+        _section_cache = SectionCache(max_entries=section_cache_entries)
+    text_cache.configure(max_entries=text_cache_entries)
+
+
+def _render(kwargs: Dict, deadline: Optional[float] = None, cancel_event=None) -> str:
+    from invoice_generator import commit_invoice
+
+    # 已经在独立进程中渲染，不再按页段并行
+    kwargs['parallel_jobs'] = 0
+    token = None
+    if deadline is not None or cancel_event is not None:
+        token = CancelToken(deadline=deadline, disconnected=cancel_event.is_set if cancel_event is not None else None)
+    with cancel_scope(token):
+        return commit_invoice(_storage, kwargs.pop('output_path'), section_cache=_section_cache, **kwargs)
+
+
+class RenderPool:
+    """有界渲染进程池"""
+
+    def __init__(self, processes: int, storage_url: str, section_cache_entries: int = 0,
+                 text_cache_entries: int = 0):
+        """
+        Args:
+            processes: 渲染进程数
+            storage_url: 发票存储地址（子进程各自打开）
+            section_cache_entries: 每个子进程的分块缓存条目数（0 表示不缓存）
+            text_cache_entries: 每个子进程的段落缓存条目数
+        """
+        if processes < 1:
+            raise ValueError('Render pool needs at least one process')
+        if storage_url.startswith('memory://'):
+            raise ValueError('Render pool needs a storage shared between processes, not memory://')
+        self.processes = processes
+        self._initargs = (storage_url, section_cache_entries, text_cache_entries)
+        self._lock = threading.Lock()
+        self._pending = 0  # 已提交未完成的渲染（包括正在渲染的）
+        self._executor = self._new_executor()
+        self._manager = None  # 第一次需要通知客户端断开时启动
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_process, initargs=self._initargs)
+
+    def _cancel_event(self):
+        with self._lock:
+            if self._manager is None:
+                self._manager = multiprocessing.get_context('spawn').Manager()
+            return self._manager.Event()
+
+    def render(self, cancel: Optional[CancelToken] = None, **kwargs) -> str:
+        """
+        在渲染进程中渲染并提交到存储（invoice_generator.commit_invoice），阻塞到渲染完成
+
+        Args:
+            cancel: 取消令牌（渲染期限传给子进程，客户端断开时通知子进程停止）
+            **kwargs: create_invoice 的参数，output_path 为存储中的文件名（不包括 storage 和 section_cache，
+                使用子进程自己的）
+
+        Returns:
+            提交的内容摘要
+
+        Raises:
+            RuntimeError: 渲染进程异常退出
+            RenderCancelled: 渲染已取消
+        """
+        cancel_event = None
+        if cancel is not None and cancel.disconnected is not None:
+            cancel_event = self._cancel_event()
+        with self._lock:
+            executor = self._executor
+            self._pending += 1
+        try:
+            future = executor.submit(_render, kwargs, cancel.deadline if cancel is not None else None, cancel_event)
+            if cancel is None:
+                return future.result()
+            while True:
+                try:
+                    return future.result(timeout=DISCONNECT_CHECK_INTERVAL)
+                except FutureTimeoutError:
+                    reason = cancel.cancelled()
+                    if reason is None:
+                        continue
+                    if future.cancel():
+                        # 还在排队，没有占用渲染进程
+                        raise RenderCancelled(reason)
+                    if cancel_event is not None:
+                        cancel_event.set()
+                    # 子进程在下一个检查点抛出 RenderCancelled（期限由子进程自己检查）
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+            executor.shutdown(wait=False)
+            raise RuntimeError('Render process exited unexpectedly')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self) -> Dict[str, int]:
+        """进程数和排队中的渲染数（用于 /health）"""
+        with self._lock:
+            pending = self._pending
+        return {'processes': self.processes, 'active': min(pending, self.processes),
+                'waiting': max(0, pending - self.processes)}
+
+    def close(self):
+        """等待正在进行的渲染完成后关闭子进程"""
+        with self._lock:
+            executor = self._executor
+            manager, self._manager = self._manager, None
+        executor.shutdown(wait=True)
+        if manager is not None:
+            manager.shutdown()
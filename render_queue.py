@@ -0,0 +1,506 @@
+"""
+渲染队列 - Web 节点把规范化的发票数据入队，任意数量的渲染工作进程拉取、渲染并保存结果
+
+- 至少一次投递：任务被领取后在可见性超时内不会被其他工作进程领取，
+  工作进程崩溃或超时未确认的任务会重新变为可领取
+- 工作进程渲染期间定期续租，长任务不会被误判为超时
+- 失败的任务按指数退避重试，超过最大尝试次数后进入死信（state='dead'），可手动重新入队
+- 后端可插拔（见 QUEUE_BACKENDS / open_queue），内置基于 SQLite 文件的实现，
+  单机即可运行，多进程共享同一个数据库文件
+
+命令行（必须指定子命令；--queue 写在子命令之后，省略时使用 $RENDER_QUEUE_URL）：
+
+    python render_queue.py worker --queue sqlite:///path/to/render_queue.db --output generated_invoices
+    python render_queue.py stats --queue sqlite:///path/to/render_queue.db
+    python render_queue.py requeue <job_id> --queue sqlite:///path/to/render_queue.db
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from storage import InvoiceStorage, open_storage
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'
+
+
+class Job:
+    """被领取的任务"""
+
+    def __init__(self, job_id: str, payload: Dict, attempts: int, lease: str, max_attempts: int):
+        self.id = job_id
+        self.payload = payload
+        self.attempts = attempts
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+
+class RenderQueue:
+    """渲染队列接口，具体后端需实现以下方法"""
+
+    def enqueue(self, payload: Dict, job_id: Optional[str] = None) -> str:
+        """入队，返回任务ID"""
+        raise NotImplementedError
+
+    def reserve(self, worker: str = '') -> Optional[Job]:
+        """领取一个可见的任务，没有任务时返回 None"""
+        raise NotImplementedError
+
+    def extend(self, job: Job) -> bool:
+        """续租，返回 False 表示租约已失效（任务已被其他工作进程领取）"""
+        raise NotImplementedError
+
+    def complete(self, job: Job, result: Dict) -> bool:
+        """确认完成"""
+        raise NotImplementedError
+
+    def fail(self, job: Job, error: str) -> str:
+        """标记失败，返回任务的新状态（queued 表示稍后重试，dead 表示进入死信）"""
+        raise NotImplementedError
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """查询任务状态，不存在时返回 None"""
+        raise NotImplementedError
+
+    def requeue(self, job_id: str) -> bool:
+        """把死信任务重新入队"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        """各状态的任务数量"""
+        raise NotImplementedError
+
+
+class SQLiteRenderQueue(RenderQueue):
+    """基于 SQLite 文件的渲染队列（WAL 模式，支持同一主机上的多个进程）"""
+
+    def __init__(self, path: str, visibility_timeout: float = 300.0, max_attempts: int = 3,
+                 retry_delay: float = 5.0, retention: float = 86400.0):
+        """
+        初始化队列
+
+        Args:
+            path: 数据库文件路径
+            visibility_timeout: 任务被领取后的不可见时间（秒）
+            max_attempts: 新入队任务的最大尝试次数，超过后进入死信
+            retry_delay: 失败后第一次重试的等待时间（秒），之后每次翻倍
+            retention: 已完成和死信任务的保留时间（秒）
+        """
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self._enqueued = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    visible_at REAL NOT NULL,
+                    lease TEXT,
+                    worker TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, visible_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每次操作使用独立连接，线程和进程之间互不影响；isolation_level=None 由我们自己控制事务
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, payload: Dict, job_id: Optional[str] = None) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, payload, state, max_attempts, visible_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, json.dumps(payload, ensure_ascii=False), QUEUED, self.max_attempts, now, now, now)
+            )
+        # 偶尔清理一次过期任务，避免数据库无限增长
+        self._enqueued += 1
+        if self._enqueued % 100 == 0:
+            self.purge()
+        return job_id
+
+    def reserve(self, worker: str = '') -> Optional[Job]:
+        now = time.time()
+        lease = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # 超时未确认且已用完尝试次数的任务进入死信
+            conn.execute(
+                "UPDATE jobs SET state = ?, lease = NULL, updated_at = ?, "
+                "error = COALESCE(error, 'visibility timeout expired') "
+                "WHERE state = ? AND visible_at <= ? AND attempts >= max_attempts",
+                (DEAD, now, RUNNING, now)
+            )
+            row = conn.execute(
+                'SELECT id, payload, attempts, max_attempts FROM jobs WHERE state IN (?, ?) AND visible_at <= ? '
+                'ORDER BY created_at LIMIT 1',
+                (QUEUED, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, visible_at = ?, lease = ?, worker = ?, '
+                'updated_at = ? WHERE id = ?',
+                (RUNNING, now + self.visibility_timeout, lease, worker, now, row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return Job(row['id'], json.loads(row['payload']), row['attempts'] + 1, lease, row['max_attempts'])
+
+    def extend(self, job: Job) -> bool:
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET visible_at = ?, updated_at = ? WHERE id = ? AND lease = ? AND state = ?',
+                (now + self.visibility_timeout, now, job.id, job.lease, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job: Job, result: Dict) -> bool:
+        # 至少一次投递下，租约过期后完成的旧工作进程结果同样有效（输出是原子写入的同一个文件）；
+        # 完成后清空请求数据（可能包含图片），只保留结果
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = NULL, lease = NULL, payload = '{}', "
+                "updated_at = ? WHERE id = ? AND state != ?",
+                (DONE, json.dumps(result, ensure_ascii=False), now, job.id, DONE)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job: Job, error: str) -> str:
+        now = time.time()
+        # 最大尝试次数以入队时记录的为准
+        if job.attempts >= job.max_attempts:
+            state, visible_at = DEAD, now
+        else:
+            state, visible_at = QUEUED, now + self.retry_delay * (2 ** (job.attempts - 1))
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET state = ?, visible_at = ?, error = ?, lease = NULL, updated_at = ? '
+                'WHERE id = ? AND lease = ?',
+                (state, visible_at, error, now, job.id, job.lease)
+            )
+        if cursor.rowcount == 0:
+            # 租约已失效，任务已由其他工作进程接手
+            return RUNNING
+        return state
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT id, state, attempts, result, error, created_at, updated_at FROM jobs WHERE id = ?',
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'state': row['state'],
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def requeue(self, job_id: str) -> bool:
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET state = ?, attempts = 0, visible_at = ?, error = NULL, updated_at = ? '
+                'WHERE id = ? AND state = ?',
+                (QUEUED, now, now, job_id, DEAD)
+            )
+        return cursor.rowcount == 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._connection() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) AS count FROM jobs GROUP BY state').fetchall()
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, DEAD: 0}
+        counts.update({row['state']: row['count'] for row in rows})
+        return counts
+
+    def purge(self) -> int:
+        """删除超过保留时间的已完成和死信任务"""
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?',
+                (DONE, DEAD, time.time() - self.retention)
+            )
+        return cursor.rowcount
+
+
+def _open_sqlite(location: str, **options) -> SQLiteRenderQueue:
+    # sqlite:///abs/path.db -> /abs/path.db；sqlite://relative.db -> relative.db
+    return SQLiteRenderQueue(location, **options)
+
+
+# 队列后端注册表：URL 协议 -> 构造函数(location, **options)
+QUEUE_BACKENDS: Dict[str, Callable[..., RenderQueue]] = {
+    'sqlite': _open_sqlite,
+}
+
+
+def open_queue(url: str, **options) -> RenderQueue:
+    """
+    根据URL打开队列
+
+    Args:
+        url: 队列地址，如 sqlite:///var/lib/invoice/render_queue.db；不带协议时视为 SQLite 文件路径
+        **options: 传给后端构造函数的参数（如 visibility_timeout、max_attempts）
+
+    Returns:
+        队列实例
+    """
+    scheme, sep, location = url.partition('://')
+    if not sep:
+        scheme, location = 'sqlite', url
+    if scheme not in QUEUE_BACKENDS:
+        raise ValueError(f"Unsupported render queue backend: {scheme}")
+    return QUEUE_BACKENDS[scheme](location, **options)
+
+
+def _encode_image(path: Optional[str]) -> Optional[Dict[str, str]]:
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    return {'name': os.path.basename(path), 'data': base64.b64encode(data).decode('ascii')}
+
+
+def build_render_job(invoice, filename: str, logo_path: Optional[str] = None,
+                     stamp_path: Optional[str] = None, backend: str = 'platypus',
+                     deterministic: bool = False, linearize: bool = False) -> Dict:
+    """
+    构建任务数据（图片内联为 base64，工作进程不需要访问 Web 节点的文件系统）
+
+    Args:
+        invoice: 发票数据（InvoiceData）
+        filename: 输出文件名
+        logo_path: 上传的 Logo 路径
+        stamp_path: 上传的图章路径
+        backend: 渲染后端
+        deterministic: 可复现输出
+        linearize: 输出线性化PDF
+
+    Returns:
+        可 JSON 序列化的任务数据
+    """
+    return {
+        'invoice': invoice.to_json(),
+        'filename': filename,
+        'logo': _encode_image(logo_path),
+        'stamp': _encode_image(stamp_path),
+        'backend': backend,
+        'deterministic': deterministic,
+        'linearize': linearize
+    }
+
+
+def _write_image(image: Optional[Dict[str, str]], directory: str, prefix: str) -> Optional[str]:
+    if not image:
+        return None
+    path = os.path.join(directory, f"{prefix}_{os.path.basename(image['name'])}")
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(image['data']))
+    return path
+
+
+def render_job(payload: Dict, storage: InvoiceStorage) -> Dict:
+    """
+    执行一个渲染任务
+
+    Args:
+        payload: build_render_job 生成的任务数据
+        storage: 发票存储（与 Web 节点的 /download 使用同一个存储）
+
+    Returns:
+        结果字典 {'filename': ..., 'digest': 提交的内容摘要}
+    """
+    from invoice_generator import commit_invoice
+    from invoice_model import InvoiceData
+
+    invoice = InvoiceData.from_json(payload['invoice'])
+    filename = os.path.basename(payload['filename'])
+    image_dir = tempfile.mkdtemp(prefix='render_job_')
+    try:
+        logo_path = _write_image(payload.get('logo'), image_dir, 'logo')
+        stamp_path = _write_image(payload.get('stamp'), image_dir, 'stamp')
+        digest = commit_invoice(
+            storage,
+            filename,
+            invoice=invoice,
+            logo_path=logo_path,
+            stamp_path=stamp_path,
+            backend=payload.get('backend', 'platypus'),
+            deterministic=payload.get('deterministic', False),
+            linearize=payload.get('linearize', False)
+        )
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+    return {'filename': filename, 'digest': digest}
+
+
+class RenderWorker:
+    """渲染工作进程：循环领取任务、渲染并确认"""
+
+    def __init__(self, queue: RenderQueue, storage: InvoiceStorage, poll_interval: float = 1.0,
+                 heartbeat_interval: Optional[float] = None,
+                 handler: Callable[[Dict, InvoiceStorage], Dict] = render_job):
+        """
+        Args:
+            queue: 渲染队列
+            storage: 发票存储
+            poll_interval: 队列为空时的轮询间隔（秒）
+            heartbeat_interval: 续租间隔（秒），默认为可见性超时的三分之一
+            handler: 任务处理函数
+        """
+        self.queue = queue
+        self.storage = storage
+        self.poll_interval = poll_interval
+        timeout = getattr(queue, 'visibility_timeout', 300.0)
+        self.heartbeat_interval = heartbeat_interval or max(timeout / 3, 0.1)
+        self.handler = handler
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stop_event = threading.Event()
+
+    def _heartbeat(self, job: Job, done: threading.Event):
+        while not done.wait(self.heartbeat_interval):
+            if not self.queue.extend(job):
+                print(f"Warning: lease lost for render job {job.id}")
+                return
+
+    def run_once(self) -> bool:
+        """
+        处理一个任务
+
+        Returns:
+            是否领取到了任务
+        """
+        job = self.queue.reserve(self.worker_id)
+        if job is None:
+            return False
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, done), daemon=True)
+        heartbeat.start()
+        try:
+            result = self.handler(job.payload, self.storage)
+        except Exception as e:
+            state = self.queue.fail(job, f"{type(e).__name__}: {e}")
+            print(f"Render job {job.id} failed (attempt {job.attempts}, now {state}): {e}")
+        else:
+            self.queue.complete(job, result)
+            print(f"Render job {job.id} done: {result.get('filename')}")
+        finally:
+            done.set()
+            heartbeat.join()
+        return True
+
+    def run(self):
+        """循环处理任务，直到 stop() 被调用（当前任务会处理完再退出）"""
+        print(f"Render worker {self.worker_id} started, output: {self.storage}")
+        while not self.stop_event.is_set():
+            if not self.run_once():
+                self.stop_event.wait(self.poll_interval)
+        print(f"Render worker {self.worker_id} stopped")
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+
+def main(argv=None):
+    """命令行入口：worker / stats / requeue"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    # --queue 写在子命令之后（worker --queue ...），每个子命令共用
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--queue', default=os.environ.get('RENDER_QUEUE_URL', ''),
+                        help='queue URL, e.g. sqlite:///path/to/render_queue.db (default: $RENDER_QUEUE_URL)')
+    parser = argparse.ArgumentParser(description='Invoice render queue')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', parents=[common], help='run a render worker')
+    worker_parser.add_argument('--output', default=os.environ.get('INVOICE_STORAGE_URL',
+                                                                  os.path.join(base_dir, 'generated_invoices')),
+                               help='invoice storage directory or URL, shared with the web nodes '
+                                    '(default: $INVOICE_STORAGE_URL or generated_invoices)')
+    worker_parser.add_argument('--visibility-timeout', type=float,
+                               default=float(os.environ.get('RENDER_QUEUE_VISIBILITY_TIMEOUT', 300)))
+    worker_parser.add_argument('--max-attempts', type=int,
+                               default=int(os.environ.get('RENDER_QUEUE_MAX_ATTEMPTS', 3)))
+    worker_parser.add_argument('--poll-interval', type=float, default=1.0)
+
+    subparsers.add_parser('stats', parents=[common], help='show job counts by state')
+    requeue_parser = subparsers.add_parser('requeue', parents=[common],
+                                           help='move a dead-lettered job back to the queue')
+    requeue_parser.add_argument('job_id')
+
+    args = parser.parse_args(argv)
+    if not args.queue:
+        parser.error('--queue or RENDER_QUEUE_URL is required')
+    command = args.command
+
+    if command == 'worker':
+        queue = open_queue(args.queue, visibility_timeout=args.visibility_timeout,
+                           max_attempts=args.max_attempts)
+        worker = RenderWorker(queue, open_storage(args.output), poll_interval=args.poll_interval)
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        worker.run()
+    elif command == 'stats':
+        print(json.dumps(open_queue(args.queue).stats()))
+    elif command == 'requeue':
+        if not open_queue(args.queue).requeue(args.job_id):
+            print(f"Job {args.job_id} is not dead-lettered")
+            return 1
+        print(f"Job {args.job_id} requeued")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
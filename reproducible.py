@@ -0,0 +1,104 @@
+"""
+可复现输出 - 相同的 create_invoice 输入渲染出逐字节相同的PDF
+
+- 不写入当前时间：使用 ReportLab 的 invariant 模式，创建/修改时间固定为 2000-01-01 UTC
+- 文档信息（标题、作者、主题、关键字）取自输入；关键字中写入输入指纹，
+  ReportLab 按这些信息计算文档ID，因此ID随输入变化且可复现
+- 图片按内容（而不是上传文件的随机路径）命名和引用
+- 并行渲染的页段合并时写入同样的文档信息
+
+PDF 中的输入指纹可以用 read_fingerprint 读出，不需要重新渲染就能确认缓存的文件是否对应给定输入。
+"""
+from typing import Dict, Optional
+import re
+
+from section_cache import SectionCache, read_image
+
+# 关键字中输入指纹的前缀
+FINGERPRINT_PREFIX = 'invoice-input-sha256:'
+DOCUMENT_CREATOR = 'Invoice Generator'
+
+# ReportLab invariant 模式使用的固定时间（合并页段时写入同样的值）
+INVARIANT_PDF_DATE = "D:20000101000000+00'00'"
+
+_KEYWORDS_PATTERN = re.compile(rb'/Keywords\s*\(((?:[^()\\]|\\.)*)\)')
+_FINGERPRINT_PATTERN = re.compile(re.escape(FINGERPRINT_PREFIX) + '([0-9a-f]{64})')
+# 文档信息字典在文件末尾附近，只读取最后这么多字节
+_TAIL_BYTES = 64 * 1024
+
+
+def input_fingerprint(logo_path: Optional[str] = None, stamp_path: Optional[str] = None, **invoice) -> str:
+    """
+    计算渲染输入的指纹
+
+    Args:
+        logo_path: Logo 图片路径（按内容参与计算）
+        stamp_path: 图章图片路径（按内容参与计算）
+        **invoice: create_invoice 的其他内容参数（company_info、items 等）
+
+    Returns:
+        十六进制 SHA-256
+    """
+    inputs = []
+    for name in sorted(invoice):
+        inputs.extend((name, invoice[name]))
+    return SectionCache.make_key('document', read_image(logo_path), read_image(stamp_path), *inputs)
+
+
+def document_info(fingerprint: str, invoice_info: Optional[Dict[str, str]] = None,
+                  company_info: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    由输入生成PDF文档信息
+
+    Args:
+        fingerprint: input_fingerprint 的结果
+        invoice_info: 发票信息
+        company_info: 公司信息
+
+    Returns:
+        {'title', 'author', 'subject', 'keywords', 'creator'}
+    """
+    number = (invoice_info or {}).get('number', '') or ''
+    return {
+        'title': f'Commercial Invoice {number}'.strip(),
+        'author': (company_info or {}).get('name', '') or '',
+        'subject': 'Commercial Invoice',
+        'keywords': FINGERPRINT_PREFIX + fingerprint,
+        'creator': DOCUMENT_CREATOR,
+    }
+
+
+def pypdf_metadata(info: Dict[str, str]) -> Dict[str, str]:
+    """转换为 pypdf PdfWriter.add_metadata 使用的键（并补上与 ReportLab 相同的固定时间）"""
+    metadata = {f'/{key.capitalize()}': value for key, value in info.items()}
+    metadata['/CreationDate'] = metadata['/ModDate'] = INVARIANT_PDF_DATE
+    return metadata
+
+
+def _find_fingerprint(data: bytes) -> Optional[str]:
+    for match in _KEYWORDS_PATTERN.finditer(data):
+        # pypdf 把 '-'、':' 等写成八进制转义
+        keywords = re.sub(rb'\\([0-7]{1,3})', lambda m: bytes([int(m.group(1), 8)]), match.group(1))
+        found = _FINGERPRINT_PATTERN.search(keywords.decode('latin-1'))
+        if found:
+            return found.group(1)
+    return None
+
+
+def read_fingerprint(pdf_path: str) -> Optional[str]:
+    """
+    读取可复现模式生成的PDF中记录的输入指纹
+
+    Returns:
+        十六进制 SHA-256，文件中没有指纹时返回 None
+    """
+    with open(pdf_path, 'rb') as f:
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - _TAIL_BYTES))
+        tail = f.read()
+    fingerprint = _find_fingerprint(tail)
+    if fingerprint is None:
+        # 并行渲染合并后的文档信息位置不固定，退回读取整个文件
+        with open(pdf_path, 'rb') as f:
+            fingerprint = _find_fingerprint(f.read())
+    return fingerprint
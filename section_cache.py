@@ -0,0 +1,122 @@
+"""
+分块 flowable 缓存 - 编辑后重新生成同一张发票时，只重建输入发生变化的部分
+
+InvoiceGenerator 的每个部分（页眉、收发货方、运输、项目表、总计、页脚）生成的 flowable
+按该部分输入的哈希缓存。同样的 flowable 可以被多次 doc.build 使用且输出相同，
+但 build 过程中会修改 flowable 的排版状态，因此条目采用借出/归还：
+借出期间条目不在缓存中，并发的相同请求会自行重建，不会共享同一组对象。
+
+缓存是进程内的；图片按内容哈希参与键计算，flowable 引用内存中的图片数据而不是上传文件路径
+（上传文件在渲染后即被删除）。
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import hashlib
+import json
+import threading
+
+from invoice_model import ItemTable
+
+DEFAULT_MAX_ENTRIES = 256
+# 行数超过该值的项目表不缓存（platypus 每行约 6.5KB，见 memory_guard.ROW_BASE_BYTES）
+DEFAULT_MAX_ROWS = 2000
+
+
+def _update_digest(digest, value):
+    if isinstance(value, ItemTable):
+        digest.update(b'items\0')
+        digest.update(value.digest())
+    elif isinstance(value, (bytes, bytearray)):
+        digest.update(b'%d:' % len(value))
+        digest.update(value)
+    else:
+        digest.update(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    digest.update(b'\0')
+
+
+def read_image(path: Optional[str]) -> Optional[bytes]:
+    """
+    读取图片文件内容（用于计算缓存键，并让缓存的 flowable 不依赖上传文件）
+
+    Returns:
+        文件内容，没有文件或读取失败时返回 None
+    """
+    if not path:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class SectionCache:
+    """按输入哈希缓存的发票分块 flowable（LRU）"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_rows: int = DEFAULT_MAX_ROWS):
+        """
+        Args:
+            max_entries: 最多缓存的分块数
+            max_rows: 可缓存的项目表最大行数
+        """
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    @staticmethod
+    def make_key(section: str, *inputs) -> str:
+        """
+        计算分块的缓存键
+
+        Args:
+            section: 分块名
+            inputs: 该分块的全部输入（字典、字符串、数字、ItemTable、图片字节）
+
+        Returns:
+            十六进制 SHA-256 摘要
+        """
+        digest = hashlib.sha256(section.encode('utf-8') + b'\0')
+        for value in inputs:
+            _update_digest(digest, value)
+        return digest.hexdigest()
+
+    def cacheable(self, items) -> bool:
+        """项目表是否可以缓存"""
+        return len(items) <= self.max_rows
+
+    def checkout(self, section: str, key: str) -> Optional[List]:
+        """
+        借出一个分块；借出后条目不在缓存中，直到 checkin
+
+        Returns:
+            flowable 列表，未命中时返回 None
+        """
+        with self._lock:
+            flowables = self._entries.pop(key, None)
+            counter = self.misses if flowables is None else self.hits
+            counter[section] = counter.get(section, 0) + 1
+        return flowables
+
+    def checkin(self, key: str, flowables: List):
+        """归还（或新增）一个分块，超出容量时淘汰最久未使用的条目"""
+        for flowable in flowables:
+            # doc.build 给推迟到下一页的 flowable 设置 _postponed 且不会清除，
+            # 不去掉的话下次 build 会把它当作放不下而报 LayoutError
+            flowable.__dict__.pop('_postponed', None)
+        with self._lock:
+            self._entries[key] = flowables
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """各分块的命中/未命中次数和当前条目数"""
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': dict(self.hits), 'misses': dict(self.misses)}
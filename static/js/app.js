@@ -0,0 +1,300 @@
+// 设置默认日期
+document.addEventListener('DOMContentLoaded', function() {
+    const today = new Date().toISOString().split('T')[0];
+    
+    document.getElementById('invoice_date').value = today;
+
+    // 初始化项目计数
+    let itemCount = 1;
+
+    // 幂等键：表单内容不变时重复提交（双击、重试）复用同一个键
+    let idempotencyKey = null;
+    function newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+    function resetIdempotencyKey() {
+        idempotencyKey = null;
+    }
+    document.getElementById('invoiceForm').addEventListener('input', resetIdempotencyKey);
+    document.getElementById('invoiceForm').addEventListener('change', resetIdempotencyKey);
+    document.getElementById('invoiceForm').setAttribute('data-item-count', itemCount);
+
+    // 添加项目
+    document.getElementById('addItemBtn').addEventListener('click', function() {
+        const container = document.getElementById('itemsContainer');
+        const newItem = container.firstElementChild.cloneNode(true);
+        const index = itemCount;
+        
+        newItem.setAttribute('data-item-index', index);
+        newItem.querySelector('input[name^="item_product_name"]').name = `item_product_name_${index}`;
+        newItem.querySelector('input[name^="item_product_name"]').value = '';
+        newItem.querySelector('input[name^="item_product_number"]').name = `item_product_number_${index}`;
+        newItem.querySelector('input[name^="item_product_number"]').value = '';
+        newItem.querySelector('input[name^="item_item_number"]').name = `item_item_number_${index}`;
+        newItem.querySelector('input[name^="item_item_number"]').value = '';
+        newItem.querySelector('input[name^="item_hs_code"]').name = `item_hs_code_${index}`;
+        newItem.querySelector('input[name^="item_hs_code"]').value = '';
+        newItem.querySelector('input[name^="item_description"]').name = `item_description_${index}`;
+        newItem.querySelector('input[name^="item_description"]').value = '';
+        newItem.querySelector('input[name^="item_quantity"]').name = `item_quantity_${index}`;
+        newItem.querySelector('input[name^="item_quantity"]').value = '';
+        newItem.querySelector('input[name^="item_unit_price"]').name = `item_unit_price_${index}`;
+        newItem.querySelector('input[name^="item_unit_price"]').value = '';
+        newItem.querySelector('input[name^="item_amount"]').name = `item_amount_${index}`;
+        newItem.querySelector('input[name^="item_amount"]').value = '';
+        // 更新新项目的标签
+        updateCurrencyLabels(newItem);
+        newItem.querySelector('.remove-item').style.display = 'block';
+        
+        container.appendChild(newItem);
+        itemCount++;
+        resetIdempotencyKey();
+        document.getElementById('invoiceForm').setAttribute('data-item-count', itemCount);
+        
+        attachItemListeners(newItem);
+    });
+
+    // 删除项目
+    document.getElementById('itemsContainer').addEventListener('click', function(e) {
+        if (e.target.classList.contains('remove-item')) {
+            const itemRow = e.target.closest('.item-row');
+            if (document.getElementById('itemsContainer').children.length > 1) {
+                itemRow.remove();
+                itemCount--;
+                resetIdempotencyKey();
+                document.getElementById('invoiceForm').setAttribute('data-item-count', itemCount);
+                updateSummary();
+            }
+        }
+    });
+
+    // 自动计算金额
+    function attachItemListeners(itemRow) {
+        const quantityInput = itemRow.querySelector('input[name^="item_quantity"]');
+        const priceInput = itemRow.querySelector('input[name^="item_unit_price"]');
+        const amountInput = itemRow.querySelector('input[name^="item_amount"]');
+        
+        function calculateAmount() {
+            const qty = parseFloat(quantityInput.value) || 0;
+            const price = parseFloat(priceInput.value) || 0;
+            amountInput.value = (qty * price).toFixed(2);
+            updateSummary();
+        }
+        
+        quantityInput.addEventListener('input', calculateAmount);
+        priceInput.addEventListener('input', calculateAmount);
+    }
+
+    // 为所有项目添加监听器
+    document.querySelectorAll('.item-row').forEach(item => {
+        attachItemListeners(item);
+    });
+
+    // 获取货币符号
+    function getCurrencySymbol() {
+        const currency = document.getElementById('currency').value;
+        return currency === 'USD' ? '$' : '¥';
+    }
+    
+    // 更新货币标签
+    function updateCurrencyLabels(element = null) {
+        const currency = document.getElementById('currency').value;
+        const currencyText = currency === 'USD' ? 'USD' : 'CNY';
+        const elements = element ? [element] : document.querySelectorAll('.item-row');
+        
+        elements.forEach(row => {
+            const unitPriceLabel = row.querySelector('.unit-price-label');
+            const amountLabel = row.querySelector('.amount-label');
+            if (unitPriceLabel) {
+                unitPriceLabel.innerHTML = `Unit Price (${currencyText}) <span class="required">*</span>`;
+            }
+            if (amountLabel) {
+                amountLabel.innerHTML = `Amount (${currencyText})`;
+            }
+        });
+    }
+    
+    // 监听货币变化
+    document.getElementById('currency').addEventListener('change', function() {
+        updateCurrencyLabels();
+        updateSummary();
+    });
+    
+    // 初始化货币标签
+    updateCurrencyLabels();
+
+    // 更新总计
+    function updateSummary() {
+        let subtotal = 0;
+        document.querySelectorAll('input[name^="item_amount"]').forEach(input => {
+            subtotal += parseFloat(input.value) || 0;
+        });
+
+        const taxRate = parseFloat(document.getElementById('tax_rate').value) || 0;
+        const discount = parseFloat(document.getElementById('discount').value) || 0;
+        const taxAmount = subtotal * (taxRate / 100);
+        const total = subtotal - discount + taxAmount;
+        
+        const symbol = getCurrencySymbol();
+
+        document.getElementById('subtotal').textContent = symbol + subtotal.toFixed(2);
+        document.getElementById('discount-display').textContent = '-' + symbol + discount.toFixed(2);
+        document.getElementById('tax-amount').textContent = symbol + taxAmount.toFixed(2);
+        document.getElementById('total').textContent = symbol + total.toFixed(2);
+    }
+
+    // 监听税率和折扣变化
+    document.getElementById('tax_rate').addEventListener('input', updateSummary);
+    document.getElementById('discount').addEventListener('input', updateSummary);
+
+    // 预览总计
+    document.getElementById('previewBtn').addEventListener('click', function() {
+        updateSummary();
+        showMessage('总计已更新', 'success');
+    });
+
+    // 表单提交
+    document.getElementById('invoiceForm').addEventListener('submit', function(e) {
+        e.preventDefault();
+        
+        const formData = new FormData(this);
+        formData.append('item_count', itemCount);
+
+        // 显示加载状态
+        const submitBtn = this.querySelector('button[type="submit"]');
+        const originalText = submitBtn.textContent;
+        submitBtn.disabled = true;
+        submitBtn.textContent = '生成中...';
+
+        // 检查是否有文件上传
+        const logoFile = document.getElementById('company_logo').files[0];
+        const stampFile = document.getElementById('company_stamp').files[0];
+        
+        if (logoFile) {
+            console.log('Logo file selected:', logoFile.name, 'Size:', logoFile.size, 'Type:', logoFile.type);
+        }
+        if (stampFile) {
+            console.log('Stamp file selected:', stampFile.name, 'Size:', stampFile.size, 'Type:', stampFile.type);
+        }
+
+        if (!idempotencyKey) {
+            idempotencyKey = newIdempotencyKey();
+        }
+
+        fetch('/generate', {
+            method: 'POST',
+            headers: { 'Idempotency-Key': idempotencyKey },
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                return response.json().then(data => {
+                    throw new Error(data.error || `HTTP error! status: ${response.status}`);
+                });
+            }
+            return response.json();
+        })
+        .then(data => data.queued ? waitForJob(data.status_url) : data)
+        .then(data => {
+            if (data.success) {
+                showMessage('Invoice generated successfully! Downloading...', 'success');
+                // 自动下载
+                setTimeout(() => {
+                    window.location.href = data.download_url;
+                    submitBtn.disabled = false;
+                    submitBtn.textContent = originalText;
+                }, 500);
+            } else {
+                showMessage('Generation failed: ' + (data.error || 'Unknown error'), 'error');
+                submitBtn.disabled = false;
+                submitBtn.textContent = originalText;
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showMessage('Error: ' + error.message, 'error');
+            submitBtn.disabled = false;
+            submitBtn.textContent = originalText;
+        });
+    });
+
+    // 轮询排队渲染的任务，直到完成或失败
+    function waitForJob(statusUrl) {
+        return new Promise((resolve, reject) => {
+            const poll = () => {
+                fetch(statusUrl)
+                    .then(response => response.json())
+                    .then(data => {
+                        if (data.state === 'done' || data.success === false) {
+                            resolve(data);
+                        } else {
+                            setTimeout(poll, 1000);
+                        }
+                    })
+                    .catch(reject);
+            };
+            poll();
+        });
+    }
+
+    // 显示消息
+    function showMessage(text, type) {
+        const messageDiv = document.getElementById('message');
+        messageDiv.textContent = text;
+        messageDiv.className = 'message ' + type;
+        messageDiv.style.display = 'block';
+        
+        setTimeout(() => {
+            messageDiv.style.display = 'none';
+        }, 3000);
+    }
+
+    // Logo图片预览
+    document.getElementById('company_logo').addEventListener('change', function(e) {
+        const file = e.target.files[0];
+        const preview = document.getElementById('logo-preview');
+        
+        if (file) {
+            if (file.size > 16 * 1024 * 1024) {
+                showMessage('图片文件过大，请选择小于16MB的图片', 'error');
+                e.target.value = '';
+                preview.innerHTML = '';
+                return;
+            }
+            
+            const reader = new FileReader();
+            reader.onload = function(e) {
+                preview.innerHTML = `<img src="${e.target.result}" alt="Logo预览" style="max-width: 200px; max-height: 200px; margin-top: 10px; border: 1px solid #ddd; border-radius: 4px;">`;
+            };
+            reader.readAsDataURL(file);
+        } else {
+            preview.innerHTML = '';
+        }
+    });
+
+    // 图章图片预览
+    document.getElementById('company_stamp').addEventListener('change', function(e) {
+        const file = e.target.files[0];
+        const preview = document.getElementById('stamp-preview');
+        
+        if (file) {
+            if (file.size > 16 * 1024 * 1024) {
+                showMessage('图片文件过大，请选择小于16MB的图片', 'error');
+                e.target.value = '';
+                preview.innerHTML = '';
+                return;
+            }
+            
+            const reader = new FileReader();
+            reader.onload = function(e) {
+                preview.innerHTML = `<img src="${e.target.result}" alt="图章预览" style="max-width: 200px; max-height: 200px; margin-top: 10px; border: 1px solid #ddd; border-radius: 4px;">`;
+            };
+            reader.readAsDataURL(file);
+        } else {
+            preview.innerHTML = '';
+        }
+    });
+});
@@ -0,0 +1,398 @@
+"""
+发票PDF存储 - create_invoice 的输出和 /download 的读取都通过这里
+
+- 写入：渲染到存储内的临时文件，完成后 fsync 并原子地重命名，
+  读者只会看到完整的文件；同一发票号并发渲染时后完成的结果生效，不会交错写坏
+- 内容寻址：PDF 按 SHA-256 保存为 blob，内容相同的 PDF 只保存一份；
+  发票文件名（如 invoice_001.pdf）是指向 blob 的别名
+- 分片：blob 和别名都按哈希前缀分到两级子目录（blobs/ab/cd/...），单个目录不会积累大量文件
+- 按内容读取：提交返回内容摘要，之后可以用摘要读取这一次写入的内容（open_blob），
+  即使同名别名已被新的渲染覆盖
+- 后端可插拔（见 STORAGE_BACKENDS / open_storage）：本地文件系统（生产）和内存（测试）
+
+本地目录结构：
+
+    <root>/blobs/ab/cd/<sha256>.pdf
+    <root>/aliases/<sha256(文件名)[:2]>/<[2:4]>/<文件名>   内容为 blob 的 SHA-256
+    <root>/tmp/                                             渲染中的临时文件
+"""
+from io import BytesIO
+from typing import BinaryIO, Callable, Dict, Optional
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# 读取文件计算哈希时的块大小
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def file_digest(path: str) -> str:
+    """计算文件内容的 SHA-256（十六进制）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_name(name: str) -> str:
+    """
+    检查发票文件名（不允许路径分隔符和上级目录）
+
+    Raises:
+        ValueError: 文件名不合法
+    """
+    if not name or name in ('.', '..') or '/' in name or '\\' in name or '\0' in name:
+        raise ValueError(f"Invalid invoice file name: {name!r}")
+    return name
+
+
+def is_digest(value: Optional[str]) -> bool:
+    """是否为合法的内容摘要（64位小写十六进制 SHA-256）"""
+    return bool(value) and _DIGEST_PATTERN.match(value) is not None
+
+
+class StorageWriter:
+    """
+    一次写入：渲染器写入 with 得到的临时路径，正常退出时提交为 name，异常时丢弃；
+    提交后 digest 为这一次写入内容的 SHA-256
+    """
+
+    def __init__(self, storage: 'InvoiceStorage', name: str):
+        self.storage = storage
+        self.name = check_name(name)
+        self.path = storage._tmp_path()
+        self.digest = None
+
+    def __enter__(self) -> str:
+        return self.path
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.digest = self.storage.commit(self.name, self.path)
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        return False
+
+
+class InvoiceStorage:
+    """发票存储接口"""
+
+    def writer(self, name: str) -> StorageWriter:
+        """
+        打开一个写入位置：with storage.writer(name) as tmp_path，渲染器写入 tmp_path，
+        正常退出时提交为 name，异常时丢弃
+
+        Args:
+            name: 发票文件名
+
+        Returns:
+            写入对象（提交后 digest 为内容摘要）
+        """
+        return StorageWriter(self, name)
+
+    def _tmp_path(self) -> str:
+        raise NotImplementedError
+
+    def commit(self, name: str, path: str) -> str:
+        """
+        把已写完的文件保存为 name（文件被移走或删除）
+
+        Returns:
+            内容的 SHA-256
+        """
+        raise NotImplementedError
+
+    def resolve(self, name: str) -> Optional[str]:
+        """别名指向的 blob 的 SHA-256，不存在时返回 None"""
+        raise NotImplementedError
+
+    def path(self, name: str) -> Optional[str]:
+        """发票文件在本地磁盘上的路径；不在本地磁盘上（或不存在）时返回 None，使用 open 读取"""
+        return None
+
+    def open(self, name: str) -> Optional[BinaryIO]:
+        """打开发票文件（二进制只读），不存在时返回 None"""
+        raise NotImplementedError
+
+    def size(self, name: str) -> Optional[int]:
+        """发票文件字节数，不存在时返回 None"""
+        raise NotImplementedError
+
+    def delete(self, name: str) -> bool:
+        """删除别名（blob 由 purge 回收）"""
+        raise NotImplementedError
+
+    def exists(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def blob_path(self, digest: str) -> Optional[str]:
+        """内容摘要对应的文件在本地磁盘上的路径；不在本地磁盘上时返回 None（文件可能已被 purge 回收）"""
+        return None
+
+    def open_blob(self, digest: str) -> Optional[BinaryIO]:
+        """按内容摘要打开文件（二进制只读），摘要不合法或已被回收时返回 None"""
+        raise NotImplementedError
+
+    def has_blob(self, digest: str) -> bool:
+        """内容摘要对应的文件是否还在"""
+        raise NotImplementedError
+
+
+def _fsync_dir(path: str):
+    # 让重命名本身落盘；Windows 不支持打开目录，跳过
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fsync_file(path: str):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+class LocalStorage(InvoiceStorage):
+    """本地文件系统存储（多个工作进程可共享同一目录）"""
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: 存储根目录；目录中原有的平铺 PDF（旧版本的输出）仍可按文件名读取
+        """
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'LocalStorage({self.root!r})'
+
+    @staticmethod
+    def _shard(digest: str) -> str:
+        return os.path.join(digest[:2], digest[2:4])
+
+    def blob_path(self, digest: str) -> Optional[str]:
+        if not is_digest(digest):
+            return None
+        return os.path.join(self.root, 'blobs', self._shard(digest), f'{digest}.pdf')
+
+    def open_blob(self, digest: str) -> Optional[BinaryIO]:
+        path = self.blob_path(digest)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except OSError:
+            return None
+
+    def has_blob(self, digest: str) -> bool:
+        path = self.blob_path(digest)
+        return path is not None and os.path.isfile(path)
+
+    def alias_path(self, name: str) -> str:
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'aliases', self._shard(digest), name)
+
+    def _tmp_path(self) -> str:
+        return os.path.join(self.tmp_dir, f'{uuid.uuid4().hex}.pdf')
+
+    def commit(self, name: str, path: str) -> str:
+        check_name(name)
+        _fsync_file(path)
+        digest = file_digest(path)
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            # 内容相同的 PDF 已保存：丢弃新文件，刷新修改时间避免被 purge 当作过期回收
+            os.remove(path)
+            os.utime(blob_path, None)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(path, blob_path)
+            _fsync_dir(os.path.dirname(blob_path))
+
+        alias_path = self.alias_path(name)
+        alias_dir = os.path.dirname(alias_path)
+        os.makedirs(alias_dir, exist_ok=True)
+        tmp_alias = f"{alias_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_alias, 'w', encoding='ascii') as f:
+            f.write(digest)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_alias, alias_path)
+        _fsync_dir(alias_dir)
+        return digest
+
+    def resolve(self, name: str) -> Optional[str]:
+        try:
+            with open(self.alias_path(check_name(name)), 'r', encoding='ascii') as f:
+                return f.read().strip() or None
+        except (OSError, ValueError):
+            return None
+
+    def path(self, name: str) -> Optional[str]:
+        """
+        发票文件在磁盘上的路径（可直接交给 send_file）
+
+        Returns:
+            blob 路径；没有别名时回退到根目录下同名的旧文件；都不存在时返回 None
+        """
+        digest = self.resolve(name)
+        if digest is not None:
+            blob_path = self.blob_path(digest)
+            return blob_path if blob_path is not None and os.path.isfile(blob_path) else None
+        try:
+            legacy_path = os.path.join(self.root, check_name(name))
+        except ValueError:
+            return None
+        return legacy_path if os.path.isfile(legacy_path) else None
+
+    def open(self, name: str) -> Optional[BinaryIO]:
+        path = self.path(name)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except OSError:
+            return None
+
+    def size(self, name: str) -> Optional[int]:
+        path = self.path(name)
+        if path is None:
+            return None
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def delete(self, name: str) -> bool:
+        try:
+            os.remove(self.alias_path(check_name(name)))
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def purge(self, max_age: float) -> int:
+        """
+        删除超过 max_age 秒未写入的别名和 blob，以及遗留的临时文件
+
+        别名写入时会刷新所指 blob 的修改时间，blob 总是不早于指向它的别名过期
+
+        Returns:
+            删除的文件数
+        """
+        removed = 0
+        cutoff = time.time() - max_age
+        for directory in ('aliases', 'blobs', 'tmp'):
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, directory)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+
+class MemoryStorage(InvoiceStorage):
+    """进程内存储（测试用），接口与 LocalStorage 相同"""
+
+    def __init__(self):
+        self.blobs = {}    # sha256 -> bytes
+        self.aliases = {}  # 文件名 -> sha256
+        self._lock = threading.Lock()
+        self.tmp_dir = tempfile.mkdtemp(prefix='invoice_storage_')
+
+    def __repr__(self):
+        return 'MemoryStorage()'
+
+    def _tmp_path(self) -> str:
+        return os.path.join(self.tmp_dir, f'{uuid.uuid4().hex}.pdf')
+
+    def commit(self, name: str, path: str) -> str:
+        check_name(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self.blobs.setdefault(digest, data)
+            self.aliases[name] = digest
+        return digest
+
+    def resolve(self, name: str) -> Optional[str]:
+        with self._lock:
+            return self.aliases.get(name)
+
+    def open(self, name: str) -> Optional[BinaryIO]:
+        with self._lock:
+            digest = self.aliases.get(name)
+            data = self.blobs.get(digest) if digest else None
+        return BytesIO(data) if data is not None else None
+
+    def open_blob(self, digest: str) -> Optional[BinaryIO]:
+        with self._lock:
+            data = self.blobs.get(digest)
+        return BytesIO(data) if data is not None else None
+
+    def has_blob(self, digest: str) -> bool:
+        with self._lock:
+            return digest in self.blobs
+
+    def size(self, name: str) -> Optional[int]:
+        with self._lock:
+            digest = self.aliases.get(name)
+            data = self.blobs.get(digest) if digest else None
+        return len(data) if data is not None else None
+
+    def delete(self, name: str) -> bool:
+        with self._lock:
+            digest = self.aliases.pop(name, None)
+            if digest is not None and digest not in self.aliases.values():
+                del self.blobs[digest]
+        return digest is not None
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+# 存储后端注册表：URL 协议 -> 构造函数(location)
+STORAGE_BACKENDS: Dict[str, Callable[[str], InvoiceStorage]] = {
+    'file': LocalStorage,
+    'memory': lambda location: MemoryStorage(),
+}
+
+
+def open_storage(url: str) -> InvoiceStorage:
+    """
+    根据URL打开存储
+
+    Args:
+        url: 存储地址，如 file:///var/lib/invoice/generated_invoices 或 memory://；
+             不带协议时视为本地目录
+
+    Returns:
+        存储实例
+    """
+    scheme, sep, location = url.partition('://')
+    if not sep:
+        scheme, location = 'file', url
+    if scheme not in STORAGE_BACKENDS:
+        raise ValueError(f"Unsupported invoice storage backend: {scheme}")
+    return STORAGE_BACKENDS[scheme](location)
@@ -0,0 +1,42 @@
+"""
+合成测试图片 - 压测和渲染开销标定使用的 Logo/图章
+
+- 与真实上传接近：Logo 为白底彩色色块的 PNG，图章为透明底的圆形 PNG
+- 相同的类型和尺寸总是生成相同的图片（随机数种子取自参数），标定结果可复现
+- 只依赖 Pillow，压测工具和 estimator.calibrate 都从这里导入
+"""
+from typing import Tuple
+import io
+import random
+
+from PIL import Image as PILImage, ImageDraw
+
+
+def synthetic_image(kind: str, size: Tuple[int, int]) -> bytes:
+    """
+    生成一张接近真实上传的图片
+
+    Args:
+        kind: 'logo'（白底 PNG）或 'stamp'（透明底圆形 PNG）
+        size: (宽, 高)
+
+    Returns:
+        PNG 字节
+    """
+    width, height = size
+    rng = random.Random(f"{kind}-{width}x{height}")
+    if kind == 'stamp':
+        img = PILImage.new('RGBA', size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((4, 4, width - 4, height - 4), outline=(200, 20, 20, 255), width=max(4, width // 40))
+        draw.ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4), fill=(200, 20, 20, 160))
+    else:
+        img = PILImage.new('RGB', size, (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            draw.rectangle((x0, y0, x0 + rng.randrange(10, 80), y0 + rng.randrange(10, 40)),
+                           fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
@@ -0,0 +1,174 @@
+"""
+段落排版缓存 - 进程内共享，重复出现的文字在第一次渲染之后不再重新解析和换行
+
+- 解析：段落标记（<b>、<br/> 等）解析得到的片段按 (文字, 样式) 缓存
+- 换行：换行结果和段落高度按 (文字, 样式, 可用宽度) 缓存；Table 在计算行高和绘制时
+  会对同一单元格多次 wrap，第二次起直接命中
+- 样式按影响排版的属性值比较，每次渲染新建的同值 ParagraphStyle 共享同一批条目
+
+条目在各次渲染、各线程之间共享且只读使用：ReportLab 绘制时不修改片段和换行结果，
+拆分段落时复制换行结果生成新段落，也不会修改缓存中的对象。
+"""
+from collections import OrderedDict
+from typing import Dict, Optional
+import threading
+
+from reportlab.platypus import Paragraph
+from reportlab.platypus.paragraph import _FUZZ, cleanBlockQuotedText, textTransformFrags
+from reportlab.platypus.paraparser import ParaParser
+
+DEFAULT_MAX_ENTRIES = 20000
+# 超过该长度的文字（通常是备注等一次性内容）不缓存
+DEFAULT_MAX_TEXT_LENGTH = 2000
+
+# 不影响排版的样式属性，不参与样式键
+_IGNORED_STYLE_ATTRS = ('name', 'parent')
+
+# Paragraph.wrap（含 breakLines）设置的属性，缓存命中时原样恢复
+_WRAP_ATTRS = ('width', 'height', 'blPara', 'frags', '_wrapWidths', '_width_max',
+               '_splitLongWordCount', '_hyphenations')
+
+
+def style_key(style) -> tuple:
+    """
+    计算段落样式的缓存键（影响排版的全部属性值），结果保存在样式对象上
+
+    Args:
+        style: ParagraphStyle
+
+    Returns:
+        可哈希的样式键
+    """
+    key = style.__dict__.get('_text_cache_key')
+    if key is None:
+        key = tuple(
+            (attr, repr(getattr(style, attr, None)))
+            for attr in sorted(style.defaults)
+            if attr not in _IGNORED_STYLE_ATTRS
+        )
+        style.__dict__['_text_cache_key'] = key
+    return key
+
+
+class TextCache:
+    """段落解析和换行结果的缓存（LRU）"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_text_length: int = DEFAULT_MAX_TEXT_LENGTH):
+        """
+        Args:
+            max_entries: 最多缓存的条目数（解析和换行结果合计，0 表示不缓存）
+            max_text_length: 可缓存的文字最大长度
+        """
+        self.max_entries = max_entries
+        self.max_text_length = max_text_length
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {'parse': 0, 'wrap': 0}
+        self.misses = {'parse': 0, 'wrap': 0}
+
+    def enabled_for(self, text) -> bool:
+        """这段文字是否使用缓存"""
+        return self.max_entries > 0 and isinstance(text, str) and len(text) <= self.max_text_length
+
+    def get(self, kind: str, key):
+        """
+        查找条目并计数
+
+        Args:
+            kind: 'parse' 或 'wrap'
+            key: 条目键
+
+        Returns:
+            缓存的值，未命中时返回 None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+                self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """新增条目，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def configure(self, max_entries: Optional[int] = None, max_text_length: Optional[int] = None):
+        """修改容量（缩小时立即淘汰多出的条目）"""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_text_length is not None:
+                self.max_text_length = max_text_length
+            while len(self._entries) > max(self.max_entries, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """条目数，以及解析和换行各自的命中/未命中次数和命中率"""
+        with self._lock:
+            result = {'entries': len(self._entries), 'max_entries': self.max_entries}
+            for kind in ('parse', 'wrap'):
+                hits, misses = self.hits[kind], self.misses[kind]
+                result[kind] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0
+                }
+            return result
+
+
+# 进程内共享的缓存（多个工作进程各自一份）
+text_cache = TextCache()
+
+
+class CachedParagraph(Paragraph):
+    """解析和换行结果取自 text_cache 的 Paragraph，用法与 Paragraph 相同"""
+
+    def __init__(self, text, style=None, bulletText=None, frags=None, caseSensitive=1, encoding='utf8'):
+        self._text_key = None
+        if frags is not None or bulletText is not None or style is None or not text_cache.enabled_for(text):
+            # 拆分段落时 ReportLab 以 frags 创建新段落，这类段落不使用缓存
+            super().__init__(text, style, bulletText, frags, caseSensitive, encoding)
+            return
+
+        key = ('parse', text, style_key(style), caseSensitive)
+        parsed = text_cache.get('parse', key)
+        if parsed is None:
+            # 与 Paragraph._setup 的解析过程相同
+            cleaned = cleanBlockQuotedText(text)
+            parser = ParaParser()
+            parser.caseSensitive = caseSensitive
+            _, parsed_frags, bullet_frags = parser.parse(cleaned, style)
+            if parsed_frags is None:
+                raise ValueError("xml parser error (%s) in paragraph beginning\n'%s'"
+                                 % (parser.errors[0], cleaned[:min(30, len(cleaned))]))
+            textTransformFrags(parsed_frags, style)
+            parsed = (cleaned, parsed_frags, bullet_frags or getattr(style, 'bulletText', None))
+            text_cache.put(key, parsed)
+
+        cleaned, parsed_frags, bullet_text = parsed
+        self.caseSensitive = caseSensitive
+        self.encoding = encoding
+        self._setup(cleaned, style, bullet_text, parsed_frags, cleanBlockQuotedText)
+        self._text_key = key[1:]
+
+    def wrap(self, availWidth, availHeight):
+        if self._text_key is None or availWidth < _FUZZ:
+            return super().wrap(availWidth, availHeight)
+        key = ('wrap', availWidth) + self._text_key
+        state = text_cache.get('wrap', key)
+        if state is None:
+            result = super().wrap(availWidth, availHeight)
+            state = {name: self.__dict__[name] for name in _WRAP_ATTRS if name in self.__dict__}
+            text_cache.put(key, state)
+            return result
+        self.__dict__.update(state)
+        return self.width, self.height
@@ -0,0 +1,295 @@
+"""
+请求追踪 - 每个请求写出一条 JSON Lines 记录，包含各阶段耗时、输入规模和输出大小
+
+- 代码中用 span('name') 标记阶段，嵌套的阶段名用 '.' 连接（如 render.items）；
+  当前请求没有开启追踪时 span 只做一次 ContextVar 查找
+- 记录按采样率写出；设置了慢请求阈值时，超过阈值的请求总是写出
+- 写文件由后台线程完成，请求线程只把记录放入有界队列（队列满时丢弃并计数），
+  日志不会给请求增加 I/O 延迟
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import atexit
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+
+# 当前线程（上下文）正在记录的追踪
+_current_trace = ContextVar('invoice_trace', default=None)
+
+# 客户端传入的 X-Request-ID 只接受这种格式，否则重新生成
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# 不追踪的端点（静态资源、健康检查）
+UNTRACED_ENDPOINTS = {'static', 'asset', 'health_check', None}
+
+
+class Trace:
+    """一次请求的追踪数据"""
+
+    __slots__ = ('request_id', 'name', 'started_at', 'start', 'spans', 'attrs', '_stack')
+
+    def __init__(self, name: str, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []   # [(阶段名, 相对开始时间ms, 耗时ms)]
+        self.attrs = {}
+        self._stack = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def to_record(self, duration_ms: float) -> Dict:
+        """转换为写出的日志记录"""
+        record = dict(self.attrs)
+        record.update({
+            'ts': datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(timespec='milliseconds'),
+            'request_id': self.request_id,
+            'name': self.name,
+            'pid': os.getpid(),
+            'duration_ms': round(duration_ms, 3),
+            'spans': [
+                {'name': name, 'start_ms': start_ms, 'duration_ms': span_ms}
+                for name, start_ms, span_ms in self.spans
+            ]
+        })
+        return record
+
+
+@contextmanager
+def span(name: str):
+    """
+    记录一个阶段的耗时
+
+    Args:
+        name: 阶段名
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace._stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        path = '.'.join(trace._stack)
+        trace._stack.pop()
+        trace.spans.append((path, round((start - trace.start) * 1000, 3), round((end - start) * 1000, 3)))
+
+
+def annotate(**attrs):
+    """给当前追踪添加属性（输入规模、输出大小等），没有开启追踪时忽略"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+class TraceWriter:
+    """后台线程批量写 JSON Lines 文件"""
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 256):
+        """
+        Args:
+            path: 日志文件路径（多个工作进程可以写同一个文件，每批记录一次追加写入）
+            max_queue: 队列上限，超出时丢弃新记录
+            batch_size: 每次写入的最大记录数
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # 线程不会跟随 fork 复制到子进程，按进程号检查并在需要时重新启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, record: Dict) -> bool:
+        """
+        提交一条记录（不阻塞）
+
+        Returns:
+            是否已放入队列
+        """
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _drain(self, first) -> List:
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, records: List):
+        lines = ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in records)
+        # O_APPEND 单次写入，多进程同时追加时各批记录不会交错
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            batch = self._drain(record)
+            stop = None in batch
+            records = [item for item in batch if item is not None]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.append({'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+                                'name': 'trace.dropped', 'pid': os.getpid(), 'dropped': dropped})
+            if records:
+                try:
+                    self._write(records)
+                except Exception as e:
+                    print(f"Warning: Could not write trace log {self.path}: {e}")
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """等待队列中的记录全部写出"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self, timeout: float = 2.0):
+        """写出剩余记录并停止后台线程"""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+class Tracer:
+    """创建追踪并按采样规则写出"""
+
+    def __init__(self, path: str, sample_rate: float = 1.0, slow_threshold_ms: float = 0,
+                 writer: Optional[TraceWriter] = None):
+        """
+        Args:
+            path: 日志文件路径
+            sample_rate: 写出比例（0~1）
+            slow_threshold_ms: 耗时超过该值的请求总是写出（0 表示不启用）
+            writer: 自定义写出器（默认写 path）
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self.writer = writer or TraceWriter(path)
+
+    def start(self, name: str, request_id: Optional[str] = None):
+        """
+        开始追踪并设为当前追踪
+
+        Returns:
+            (追踪, ContextVar token)
+        """
+        trace = Trace(name, request_id)
+        return trace, _current_trace.set(trace)
+
+    def finish(self, trace: Trace, token=None, **attrs) -> Optional[Dict]:
+        """
+        结束追踪，满足采样条件时提交写出
+
+        Returns:
+            写出的记录，未采样时返回 None
+        """
+        if token is not None:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                _current_trace.set(None)
+        duration_ms = trace.elapsed_ms()
+        trace.attrs.update(attrs)
+        sampled = (
+            (self.sample_rate > 0 and random.random() < self.sample_rate)
+            or (self.slow_threshold_ms > 0 and duration_ms >= self.slow_threshold_ms)
+        )
+        if not sampled:
+            return None
+        record = trace.to_record(duration_ms)
+        self.writer.submit(record)
+        return record
+
+
+def init_tracing(app, tracer: Tracer) -> Tracer:
+    """
+    为 Flask 应用的每个请求开启追踪
+
+    请求ID取自 X-Request-ID 请求头（格式不合法时重新生成），并在响应头中返回
+
+    Args:
+        app: Flask 应用
+        tracer: 追踪器
+
+    Returns:
+        追踪器
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_trace():
+        if request.endpoint in UNTRACED_ENDPOINTS or request.method == 'OPTIONS':
+            return
+        request_id = request.headers.get('X-Request-ID', '')
+        if not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = None
+        g.trace, g.trace_token = tracer.start(f"{request.method} {request.path}", request_id)
+        g.trace.attrs['request_bytes'] = request.content_length or 0
+
+    @app.after_request
+    def _tag_response(response):
+        trace = g.get('trace')
+        if trace is not None:
+            response.headers['X-Request-ID'] = trace.request_id
+            trace.attrs['status'] = response.status_code
+            if response.content_length is not None:
+                trace.attrs['response_bytes'] = response.content_length
+        return response
+
+    @app.teardown_request
+    def _finish_trace(exc):
+        trace = g.pop('trace', None)
+        if trace is None:
+            return
+        token = g.pop('trace_token', None)
+        if exc is not None:
+            trace.attrs['error'] = repr(exc)
+        tracer.finish(trace, token)
+
+    return tracer
@@ -0,0 +1,291 @@
+"""
+上传图片的流式校验 - 在 multipart 请求体解析过程中检查每个上传文件，不合格时立即中止解析
+
+- 第一个数据块到达时按文件头（magic bytes）识别格式，不是允许的图片格式直接拒绝
+- 文件头累积到足够长度后用 Pillow 读取宽高（只解析文件头，不解码像素），
+  超过像素上限的图片（如解压炸弹 PNG）在请求体的其余部分读取之前被拒绝
+- 每个文件的字节数在写入时累计，超过上限立即拒绝
+
+拒绝时抛出 UploadRejected，请求体剩余部分不再读取，也不会进入 ReportLab 解码。
+
+ASGI 入口先在事件循环上读完请求体再交给 Flask，读取时用 MultipartImageValidator
+对到达的数据块做同样的检查，不合格的上传同样在请求体读完之前被拒绝。
+"""
+from io import BytesIO
+from typing import Dict, Optional
+import warnings
+
+from flask import Request
+from PIL import Image as PILImage
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# 文件头 -> Pillow 格式名
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+)
+# 识别格式需要的最少字节数（WEBP 为 RIFF....WEBP）
+SIGNATURE_BYTES = 12
+# 在文件头累积到这些长度时尝试读取宽高；JPEG 的尺寸在 SOF 段，前面可能有较大的 EXIF/ICC 段
+PROBE_SIZES = (1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024)
+
+DEFAULT_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+DEFAULT_MAX_IMAGE_PIXELS = 20 * 1000 * 1000
+
+
+class UploadRejected(Exception):
+    """上传文件未通过校验"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def sniff_image_format(head: bytes) -> Optional[str]:
+    """
+    按文件头识别图片格式
+
+    Args:
+        head: 文件开头的字节（至少 SIGNATURE_BYTES 字节时结果可靠）
+
+    Returns:
+        Pillow 格式名，无法识别时返回 None
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def read_image_header(data) -> Optional[Dict]:
+    """
+    从（可能不完整的）文件开头读取图片格式和宽高，不解码像素
+
+    Args:
+        data: 文件开头的字节，或已定位到开头的文件对象
+
+    Returns:
+        {'format', 'width', 'height'}；数据不足以解析文件头时返回 None
+    """
+    try:
+        with warnings.catch_warnings():
+            # 像素数由调用方按自己的上限检查，忽略 Pillow 的解压炸弹警告
+            warnings.simplefilter('ignore', PILImage.DecompressionBombWarning)
+            with PILImage.open(BytesIO(data) if isinstance(data, (bytes, bytearray)) else data) as img:
+                width, height = img.size
+                return {'format': img.format, 'width': width, 'height': height}
+    except PILImage.DecompressionBombError:
+        # 超过 Pillow 自身上限的图片一定也超过我们的上限
+        return {'format': None, 'width': 0, 'height': 0, 'bomb': True}
+    except Exception:
+        return None
+
+
+class ValidatingImageStream:
+    """包装 multipart 解析器的文件容器，写入时校验图片"""
+
+    def __init__(self, container, filename: str, max_bytes: int, max_pixels: int):
+        """
+        Args:
+            container: 实际保存数据的文件对象
+            filename: 上传的文件名（用于错误信息）
+            max_bytes: 单个文件的字节上限
+            max_pixels: 单个图片的像素上限
+        """
+        self._container = container
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.size = 0
+        self.image_info = None
+        self._head = bytearray()
+        self._probes = iter(PROBE_SIZES)
+        self._next_probe = next(self._probes)
+        self._finished = False
+
+    def _reject(self, message: str, status_code: int):
+        raise UploadRejected(f'Upload {self.filename!r} rejected: {message}', status_code)
+
+    def _check_header(self, info: Dict):
+        if info.get('bomb'):
+            self._reject('image dimensions are too large', 413)
+        expected = sniff_image_format(bytes(self._head[:SIGNATURE_BYTES]))
+        if info['format'] != expected:
+            self._reject('file content does not match its image header', 415)
+        pixels = info['width'] * info['height']
+        if pixels <= 0:
+            self._reject('image has no pixels', 415)
+        if self.max_pixels > 0 and pixels > self.max_pixels:
+            self._reject(f"{info['width']}x{info['height']} image exceeds the limit of "
+                         f"{self.max_pixels} pixels", 413)
+        self.image_info = info
+        # 文件头已校验，不再保留
+        self._head = self._head[:SIGNATURE_BYTES]
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_bytes > 0 and self.size > self.max_bytes:
+            self._reject(f'file exceeds the limit of {self.max_bytes // 1024}KB', 413)
+
+        if self.image_info is None and self._next_probe is not None:
+            previous = len(self._head)
+            self._head += data
+            if previous < SIGNATURE_BYTES <= len(self._head) and sniff_image_format(bytes(self._head)) is None:
+                self._reject('not a PNG, JPEG, GIF, BMP or WEBP image', 415)
+            if len(self._head) >= self._next_probe:
+                info = read_image_header(bytes(self._head))
+                if info is not None:
+                    self._check_header(info)
+                else:
+                    while self._next_probe is not None and self._next_probe <= len(self._head):
+                        self._next_probe = next(self._probes, None)
+                    if self._next_probe is None:
+                        # 文件头超出探测范围，剩余检查在文件接收完后进行
+                        self._head = self._head[:SIGNATURE_BYTES]
+        return self._container.write(data)
+
+    def _finish(self):
+        """文件接收完成（解析器 seek(0)）时完成尚未完成的检查"""
+        self._finished = True
+        if self.size == 0 or self.image_info is not None:
+            return
+        if sniff_image_format(bytes(self._head[:SIGNATURE_BYTES])) is None:
+            self._reject('not a PNG, JPEG, GIF, BMP or WEBP image', 415)
+        position = self._container.tell()
+        self._container.seek(0)
+        try:
+            info = read_image_header(self._container)
+        finally:
+            self._container.seek(position)
+        if info is None:
+            self._reject('image header could not be read', 415)
+        self._check_header(info)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if not self._finished and offset == 0 and whence == 0:
+            self._finish()
+        return self._container.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self._container, name)
+
+    def __iter__(self):
+        return iter(self._container)
+
+
+class ValidatedRequest(Request):
+    """上传文件在解析时即被校验的请求类"""
+
+    max_image_bytes = DEFAULT_MAX_IMAGE_BYTES
+    max_image_pixels = DEFAULT_MAX_IMAGE_PIXELS
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        container = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if not filename:
+            # 表单中未选择文件的字段（filename 为空、内容为空）
+            return container
+        if content_length and self.max_image_bytes > 0 and content_length > self.max_image_bytes:
+            raise UploadRejected(f'Upload {filename!r} rejected: file exceeds the limit of '
+                                 f'{self.max_image_bytes // 1024}KB', 413)
+        return ValidatingImageStream(container, filename, self.max_image_bytes, self.max_image_pixels)
+
+
+class _DiscardingContainer:
+    """只计数不保存的文件容器（MultipartImageValidator 只校验，数据由 Flask 解析时保存）"""
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+class MultipartImageValidator:
+    """
+    在 multipart 请求体逐块到达时校验其中的上传文件（不保存数据）
+
+    格式、像素和大小检查与 ValidatingImageStream 相同；文件头超出探测范围的图片在 Flask 解析时
+    完成剩余检查。请求体格式错误时停止校验，交给 Flask 按原有方式处理。
+    """
+
+    def __init__(self, boundary: bytes, max_bytes: int, max_pixels: int):
+        """
+        Args:
+            boundary: multipart 分隔符
+            max_bytes: 单个文件的字节上限
+            max_pixels: 单个图片的像素上限
+        """
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self._decoder = MultipartDecoder(boundary)
+        self._stream = None
+        self._malformed = False
+
+    @classmethod
+    def for_request(cls, content_type: str, request_class) -> Optional['MultipartImageValidator']:
+        """
+        按请求的 Content-Type 和应用的请求类创建校验器
+
+        Returns:
+            不是 multipart 请求或应用未启用上传校验（见 init_upload_guard）时返回 None
+        """
+        if not issubclass(request_class, ValidatedRequest):
+            return None
+        mimetype, options = parse_options_header(content_type)
+        if mimetype != 'multipart/form-data' or not options.get('boundary'):
+            return None
+        return cls(options['boundary'].encode('latin-1'), request_class.max_image_bytes,
+                   request_class.max_image_pixels)
+
+    def feed(self, chunk: bytes, final: bool = False):
+        """
+        校验新到达的一块请求体
+
+        Args:
+            chunk: 数据块
+            final: 是否为最后一块
+
+        Raises:
+            UploadRejected: 上传文件未通过校验
+        """
+        if self._malformed:
+            return
+        try:
+            self._decoder.receive_data(chunk)
+            if final:
+                self._decoder.receive_data(None)
+            event = self._decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, File):
+                    # 与 ValidatedRequest 相同：未选择文件的字段不校验
+                    self._stream = (ValidatingImageStream(_DiscardingContainer(), event.filename,
+                                                          self.max_bytes, self.max_pixels)
+                                    if event.filename else None)
+                elif isinstance(event, Field):
+                    self._stream = None
+                elif isinstance(event, Data) and self._stream is not None:
+                    self._stream.write(event.data)
+                elif isinstance(event, Epilogue):
+                    return
+                event = self._decoder.next_event()
+        except ValueError:
+            self._malformed = True
+
+
+def init_upload_guard(app, max_image_bytes: int = DEFAULT_MAX_IMAGE_BYTES,
+                      max_image_pixels: int = DEFAULT_MAX_IMAGE_PIXELS):
+    """
+    让 Flask 应用在解析请求体时校验上传的图片
+
+    Args:
+        app: Flask 应用
+        max_image_bytes: 单个图片的字节上限（0 表示不限制）
+        max_image_pixels: 单个图片的像素上限（0 表示不限制）
+    """
+    app.request_class = type('ValidatedRequest', (ValidatedRequest,), {
+        'max_image_bytes': max_image_bytes,
+        'max_image_pixels': max_image_pixels,
+    })